@@ -1,12 +1,43 @@
 from __future__ import annotations
 
-from flask import Flask, jsonify
+from flask import Flask, jsonify, request
+from werkzeug.exceptions import RequestEntityTooLarge, UnsupportedMediaType
 
-from .config import BASE_INSTRUCTIONS, GPT5_CODEX_INSTRUCTIONS
-from .http import build_cors_headers
+from .buffers import configure_stream_buffers, stream_buffer_stats
+from .config import BASE_INSTRUCTIONS, CHATGPT_RESPONSES_URL, GPT5_CODEX_INSTRUCTIONS
+from .fastjson import ChatMockJSONProvider, configure_json
+from .http import (
+    DEFAULT_MAX_BODY_BYTES,
+    BodyDecodeError,
+    build_cors_headers,
+    configure_request_bodies,
+    json_error,
+    request_body_stats,
+)
 from .routes_openai import openai_bp
 from .routes_ollama import ollama_bp
 from .routes_claude_code import claude_code_bp
+from .session import DEFAULT_PERSIST_SESSIONS, configure_session_cache, session_cache_stats
+from .translate import (
+    DEFAULT_MAX_RESPONSE_BYTES,
+    DEFAULT_STREAM_COALESCE_BYTES,
+    DEFAULT_STREAM_COALESCE_MS,
+    configure_coalescing,
+    configure_response_limit,
+    translation_stats,
+)
+from .transport import (
+    DEFAULT_PREWARM_CONNECTIONS,
+    DEFAULT_PREWARM_INTERVAL,
+    DEFAULT_UPSTREAM_HTTP2,
+    HTTP2UpstreamClient,
+    configure_upstream_client,
+    start_upstream_warmer,
+    upstream_client_stats,
+    upstream_warm_state,
+)
+from .usage import usage_stats
+from .utils import DEFAULT_BACKGROUND_TOKEN_REFRESH, start_token_refresher
 
 
 def create_app(
@@ -17,8 +48,43 @@ def create_app(
     debug_model: str | None = None,
     expose_reasoning_models: bool = False,
     default_web_search: bool = False,
+    upstream_pool_size: int | None = None,
+    upstream_http2: bool = DEFAULT_UPSTREAM_HTTP2,
+    upstream_prewarm: int = DEFAULT_PREWARM_CONNECTIONS,
+    upstream_prewarm_interval: float = DEFAULT_PREWARM_INTERVAL,
+    background_token_refresh: bool = DEFAULT_BACKGROUND_TOKEN_REFRESH,
+    session_cache_size: int | None = None,
+    session_cache_ttl: float | None = None,
+    persist_sessions: bool = DEFAULT_PERSIST_SESSIONS,
+    stream_coalesce_ms: float = DEFAULT_STREAM_COALESCE_MS,
+    stream_coalesce_bytes: int = DEFAULT_STREAM_COALESCE_BYTES,
+    json_backend: str | None = None,
+    max_response_bytes: int = DEFAULT_MAX_RESPONSE_BYTES,
+    stream_buffer_bytes: int | None = None,
+    stream_memory_budget: int | None = None,
+    reasoning_tail_bytes: int | None = None,
+    max_body_bytes: int | None = None,
+    max_decompression_ratio: int | None = None,
 ) -> Flask:
+    """
+    Build the ChatMock server. Options left out behave as ``chatmock serve`` does without the
+    matching flag, CHATGPT_LOCAL_* environment variables included, so embedding it (as gui.py
+    does) keeps connection warming, background token refresh and stream settings. The reasoning
+    and model options are the exception: they take the defaults shown, not the environment.
+    """
+    json_codec = configure_json(json_backend)
     app = Flask(__name__)
+    app.json = ChatMockJSONProvider(app)
+    upstream_client = configure_upstream_client(pool_size=upstream_pool_size, http2=upstream_http2)
+    if upstream_prewarm > 0:
+        start_upstream_warmer(CHATGPT_RESPONSES_URL, upstream_prewarm, upstream_prewarm_interval)
+    if background_token_refresh:
+        start_token_refresher()
+    configure_session_cache(max_entries=session_cache_size, ttl=session_cache_ttl, persist=persist_sessions)
+    configure_coalescing(window_ms=stream_coalesce_ms, max_bytes=stream_coalesce_bytes)
+    configure_response_limit(max_response_bytes)
+    configure_stream_buffers(stream_buffer_bytes, stream_memory_budget, reasoning_tail_bytes)
+    configure_request_bodies(max_decompression_ratio)
 
     app.config.update(
         VERBOSE=bool(verbose),
@@ -30,12 +96,43 @@ def create_app(
         GPT5_CODEX_INSTRUCTIONS=GPT5_CODEX_INSTRUCTIONS,
         EXPOSE_REASONING_MODELS=bool(expose_reasoning_models),
         DEFAULT_WEB_SEARCH=bool(default_web_search),
+        UPSTREAM_POOL_SIZE=upstream_client.pool_size,
+        UPSTREAM_HTTP2=isinstance(upstream_client, HTTP2UpstreamClient),
+        JSON_BACKEND=json_codec,
+        MAX_CONTENT_LENGTH=max(int(DEFAULT_MAX_BODY_BYTES if max_body_bytes is None else max_body_bytes), 0) or None,
     )
 
+    @app.before_request
+    def _limit_body():
+        # Refuse a declared oversized body before any of it is read; a chunked body is stopped
+        # by http.read_body once it reaches the limit.
+        limit = app.config["MAX_CONTENT_LENGTH"]
+        if limit and (request.content_length or 0) > limit:
+            raise RequestEntityTooLarge(f"Request body exceeds the {limit}-byte limit")
+
+    @app.errorhandler(RequestEntityTooLarge)
+    @app.errorhandler(UnsupportedMediaType)
+    @app.errorhandler(BodyDecodeError)
+    def _body_error(exc):
+        return json_error(exc.description, exc.code)
+
     @app.get("/")
     @app.get("/health")
     def health():
-        return jsonify({"status": "ok"})
+        return jsonify({"status": "ok", "upstream_warm_pool": upstream_warm_state()})
+
+    @app.get("/stats")
+    def stats():
+        return jsonify(
+            {
+                "upstream": upstream_client_stats(),
+                "sessions": session_cache_stats(),
+                "prompt_cache": usage_stats(),
+                "translation": translation_stats(),
+                "stream_buffers": stream_buffer_stats(),
+                "request_bodies": request_body_stats(),
+            }
+        )
 
     @app.after_request
     def _cors(resp):
@@ -0,0 +1,146 @@
+from __future__ import annotations
+
+import queue
+import threading
+from collections import deque
+from typing import Any, Deque, Dict, Tuple
+
+from .config import env_int
+
+# Upstream bytes read ahead of a streaming client, per stream and across all streams. Once a
+# stream is over either bound its upstream is not read until the client catches up, so TCP (or
+# HTTP/2) flow control pushes back on the upstream instead of the process buffering the answer.
+DEFAULT_STREAM_BUFFER_BYTES = env_int("CHATGPT_LOCAL_STREAM_BUFFER_BYTES", 1 << 20)
+DEFAULT_STREAM_MEMORY_BUDGET = env_int("CHATGPT_LOCAL_STREAM_MEMORY_BUDGET", 64 << 20)
+# Streams keep only this much of the latest reasoning text, for the partial_reasoning of an error.
+DEFAULT_REASONING_TAIL_BYTES = env_int("CHATGPT_LOCAL_REASONING_TAIL_BYTES", 64 << 10)
+
+
+class StreamBuffers:
+    """
+    Accounting for bytes read from upstream streams but not yet consumed by their request thread.
+
+    A stream that holds nothing is always allowed one more read, so every stream keeps making
+    progress and the budget can be overshot by at most one read per stream.
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self.stream_bytes = DEFAULT_STREAM_BUFFER_BYTES
+        self.budget_bytes = DEFAULT_STREAM_MEMORY_BUDGET
+        self.reasoning_tail_bytes = DEFAULT_REASONING_TAIL_BYTES
+        self.buffered = 0
+        self.peak = 0
+        self.paused_reads = 0
+
+    def add(self, n: int) -> None:
+        if n:
+            with self._lock:
+                self.buffered += n
+                if self.buffered > self.peak:
+                    self.peak = self.buffered
+
+    def release(self, n: int) -> None:
+        if n:
+            with self._lock:
+                self.buffered -= n
+
+    def full(self, held: int) -> bool:
+        """Whether a stream already holding ``held`` buffered bytes should stop reading upstream."""
+        if held <= 0:
+            return False
+        if self.stream_bytes and held >= self.stream_bytes:
+            return True
+        return bool(self.budget_bytes) and self.buffered >= self.budget_bytes
+
+    def paused(self) -> None:
+        with self._lock:
+            self.paused_reads += 1
+
+    def snapshot(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "buffered_bytes": self.buffered,
+                "peak_buffered_bytes": self.peak,
+                "paused_reads": self.paused_reads,
+                "stream_buffer_bytes": self.stream_bytes,
+                "memory_budget_bytes": self.budget_bytes,
+                "reasoning_tail_bytes": self.reasoning_tail_bytes,
+            }
+
+
+_BUFFERS = StreamBuffers()
+
+
+def stream_buffers() -> StreamBuffers:
+    return _BUFFERS
+
+
+def stream_buffer_stats() -> Dict[str, int]:
+    return _BUFFERS.snapshot()
+
+
+def configure_stream_buffers(
+    stream_bytes: int | None = None,
+    budget_bytes: int | None = None,
+    reasoning_tail_bytes: int | None = None,
+) -> StreamBuffers:
+    """Set the per-stream and total read-ahead bounds and the reasoning tail; 0 means unbounded."""
+    if stream_bytes is not None:
+        _BUFFERS.stream_bytes = max(int(stream_bytes), 0)
+    if budget_bytes is not None:
+        _BUFFERS.budget_bytes = max(int(budget_bytes), 0)
+    if reasoning_tail_bytes is not None:
+        _BUFFERS.reasoning_tail_bytes = max(int(reasoning_tail_bytes), 0)
+    return _BUFFERS
+
+
+class ByteQueue:
+    """
+    Hands items from an upstream reader thread to the request thread. ``put`` blocks while the
+    queue holds more than the stream buffers allow, until the consumer takes something or the
+    queue is closed.
+    """
+
+    def __init__(self) -> None:
+        self._cond = threading.Condition()
+        self._items: Deque[Tuple[Any, int]] = deque()
+        self._bytes = 0
+        self._closed = False
+
+    def put(self, item: Any, size: int = 0) -> bool:
+        """Queue ``item``, accounted as ``size`` bytes; returns False once the queue is closed."""
+        with self._cond:
+            if _BUFFERS.full(self._bytes) and not self._closed:
+                _BUFFERS.paused()
+                while _BUFFERS.full(self._bytes) and not self._closed:
+                    self._cond.wait()
+            if self._closed:
+                return False
+            self._items.append((item, size))
+            self._bytes += size
+            _BUFFERS.add(size)
+            self._cond.notify_all()
+            return True
+
+    def get(self, timeout: float) -> Any:
+        """The next item; raises queue.Empty if none arrives within ``timeout`` seconds."""
+        with self._cond:
+            if not self._items:
+                self._cond.wait_for(lambda: self._items, timeout)
+                if not self._items:
+                    raise queue.Empty
+            item, size = self._items.popleft()
+            self._bytes -= size
+            _BUFFERS.release(size)
+            self._cond.notify_all()
+            return item
+
+    def close(self) -> None:
+        """Drop whatever is queued and release a blocked ``put``."""
+        with self._cond:
+            self._closed = True
+            self._items.clear()
+            _BUFFERS.release(self._bytes)
+            self._bytes = 0
+            self._cond.notify_all()
@@ -9,10 +9,22 @@ import webbrowser
 from datetime import datetime
 
 from .app import create_app
+from .buffers import DEFAULT_REASONING_TAIL_BYTES, DEFAULT_STREAM_BUFFER_BYTES, DEFAULT_STREAM_MEMORY_BUDGET
 from .config import CLIENT_ID_DEFAULT
+from .http import DEFAULT_MAX_BODY_BYTES, DEFAULT_MAX_DECOMPRESSION_RATIO
 from .limits import RateLimitWindow, compute_reset_at, load_rate_limit_snapshot
 from .oauth import OAuthHTTPServer, OAuthHandler, REQUIRED_PORT, URL_BASE
-from .utils import eprint, get_home_dir, load_chatgpt_tokens, parse_jwt_claims, read_auth_file
+from .session import DEFAULT_MAX_ENTRIES, DEFAULT_PERSIST_SESSIONS, DEFAULT_TTL_SECONDS
+from .translate import DEFAULT_MAX_RESPONSE_BYTES, DEFAULT_STREAM_COALESCE_BYTES, DEFAULT_STREAM_COALESCE_MS
+from .transport import DEFAULT_POOL_SIZE, DEFAULT_PREWARM_CONNECTIONS, DEFAULT_PREWARM_INTERVAL, DEFAULT_UPSTREAM_HTTP2
+from .utils import (
+    DEFAULT_BACKGROUND_TOKEN_REFRESH,
+    eprint,
+    get_home_dir,
+    load_chatgpt_tokens,
+    parse_jwt_claims,
+    read_auth_file,
+)
 
 
 _STATUS_LIMIT_BAR_SEGMENTS = 30
@@ -269,6 +281,23 @@ def cmd_serve(
     debug_model: str | None,
     expose_reasoning_models: bool,
     default_web_search: bool,
+    upstream_pool_size: int | None = None,
+    upstream_http2: bool = DEFAULT_UPSTREAM_HTTP2,
+    upstream_prewarm: int = DEFAULT_PREWARM_CONNECTIONS,
+    upstream_prewarm_interval: float = DEFAULT_PREWARM_INTERVAL,
+    background_token_refresh: bool = DEFAULT_BACKGROUND_TOKEN_REFRESH,
+    session_cache_size: int | None = None,
+    session_cache_ttl: float | None = None,
+    persist_sessions: bool = DEFAULT_PERSIST_SESSIONS,
+    stream_coalesce_ms: float = DEFAULT_STREAM_COALESCE_MS,
+    stream_coalesce_bytes: int = DEFAULT_STREAM_COALESCE_BYTES,
+    json_backend: str | None = None,
+    max_response_bytes: int = DEFAULT_MAX_RESPONSE_BYTES,
+    stream_buffer_bytes: int | None = None,
+    stream_memory_budget: int | None = None,
+    reasoning_tail_bytes: int | None = None,
+    max_body_bytes: int | None = None,
+    max_decompression_ratio: int | None = None,
 ) -> int:
     app = create_app(
         verbose=verbose,
@@ -278,6 +307,23 @@ def cmd_serve(
         debug_model=debug_model,
         expose_reasoning_models=expose_reasoning_models,
         default_web_search=default_web_search,
+        upstream_pool_size=upstream_pool_size,
+        upstream_http2=upstream_http2,
+        upstream_prewarm=upstream_prewarm,
+        upstream_prewarm_interval=upstream_prewarm_interval,
+        background_token_refresh=background_token_refresh,
+        session_cache_size=session_cache_size,
+        session_cache_ttl=session_cache_ttl,
+        persist_sessions=persist_sessions,
+        stream_coalesce_ms=stream_coalesce_ms,
+        stream_coalesce_bytes=stream_coalesce_bytes,
+        json_backend=json_backend,
+        max_response_bytes=max_response_bytes,
+        stream_buffer_bytes=stream_buffer_bytes,
+        stream_memory_budget=stream_memory_budget,
+        reasoning_tail_bytes=reasoning_tail_bytes,
+        max_body_bytes=max_body_bytes,
+        max_decompression_ratio=max_decompression_ratio,
     )
 
     app.run(host=host, debug=False, use_reloader=False, port=port, threaded=True)
@@ -347,6 +393,135 @@ def main() -> None:
         default=False,
         help="Disable web search tool"
     )
+    p_serve.add_argument(
+        "--upstream-pool-size",
+        type=int,
+        default=DEFAULT_POOL_SIZE,
+        help=(
+            "Maximum keep-alive connections held open to the ChatGPT backend (default: 64). "
+            "Size it to the number of concurrent requests you serve."
+        ),
+    )
+    p_serve.add_argument(
+        "--upstream-http2",
+        action="store_true",
+        default=DEFAULT_UPSTREAM_HTTP2,
+        help=(
+            "Multiplex upstream streams over HTTP/2 instead of one HTTP/1.1 socket per stream. "
+            "Requires 'pip install httpx[http2]'; falls back to HTTP/1.1 when unavailable."
+        ),
+    )
+    p_serve.add_argument(
+        "--upstream-prewarm",
+        type=int,
+        default=DEFAULT_PREWARM_CONNECTIONS,
+        help="Upstream connections to open at startup and keep warm while idle; 0 disables (default: 2)",
+    )
+    p_serve.add_argument(
+        "--upstream-prewarm-interval",
+        type=float,
+        default=DEFAULT_PREWARM_INTERVAL,
+        help="Seconds of idleness after which warm upstream connections are checked and re-opened (default: 60)",
+    )
+    p_serve.add_argument(
+        "--disable-token-refresher",
+        action="store_true",
+        default=not DEFAULT_BACKGROUND_TOKEN_REFRESH,
+        help="Do not renew the access token in the background; refresh only when a request finds it expiring",
+    )
+    p_serve.add_argument(
+        "--session-cache-size",
+        type=int,
+        default=DEFAULT_MAX_ENTRIES,
+        help="Conversation prefixes remembered for prompt-cache session ids, least recently used evicted first (default: 10000)",
+    )
+    p_serve.add_argument(
+        "--session-cache-ttl",
+        type=float,
+        default=DEFAULT_TTL_SECONDS,
+        help="Forget a conversation prefix after this many idle seconds; 0 keeps it until evicted (default: 0)",
+    )
+    p_serve.add_argument(
+        "--persist-sessions",
+        action="store_true",
+        default=DEFAULT_PERSIST_SESSIONS,
+        help=(
+            "Keep prompt-cache session ids in sessions.sqlite3 under the ChatMock home so they survive "
+            "restarts and are shared by workers using the same CHATGPT_LOCAL_HOME."
+        ),
+    )
+    p_serve.add_argument(
+        "--stream-coalesce-ms",
+        type=float,
+        default=DEFAULT_STREAM_COALESCE_MS,
+        help=(
+            "Merge streamed text/reasoning deltas arriving within this many milliseconds into one frame; "
+            "tool calls, finish and errors are never delayed. 0 sends every delta as it arrives (default: 0)"
+        ),
+    )
+    p_serve.add_argument(
+        "--stream-coalesce-bytes",
+        type=int,
+        default=DEFAULT_STREAM_COALESCE_BYTES,
+        help="With --stream-coalesce-ms, also flush a merged frame once it holds this many bytes of text (default: 4096)",
+    )
+    p_serve.add_argument(
+        "--json-backend",
+        choices=["auto", "orjson", "json"],
+        default=(os.getenv("CHATGPT_LOCAL_JSON_BACKEND") or "auto").strip().lower(),
+        help="JSON encoder/decoder: orjson when installed ('auto'), or the standard library ('json') (default: auto)",
+    )
+    p_serve.add_argument(
+        "--max-response-bytes",
+        type=int,
+        default=DEFAULT_MAX_RESPONSE_BYTES,
+        help=(
+            "Fail a non-streaming request with 502 once its answer plus reasoning exceeds this many bytes; "
+            "0 means no limit (default: 0)"
+        ),
+    )
+    p_serve.add_argument(
+        "--stream-buffer-bytes",
+        type=int,
+        default=DEFAULT_STREAM_BUFFER_BYTES,
+        help=(
+            "Upstream bytes a stream may read ahead of its client before reading pauses until the "
+            "client catches up; 0 means no limit (default: 1048576)"
+        ),
+    )
+    p_serve.add_argument(
+        "--stream-memory-budget",
+        type=int,
+        default=DEFAULT_STREAM_MEMORY_BUDGET,
+        help=(
+            "Read-ahead bytes allowed across all streams; streams holding buffered data pause while "
+            "it is exceeded. 0 means no limit (default: 67108864)"
+        ),
+    )
+    p_serve.add_argument(
+        "--reasoning-tail-bytes",
+        type=int,
+        default=DEFAULT_REASONING_TAIL_BYTES,
+        help=(
+            "Reasoning text a stream keeps for the partial_reasoning of an interrupted response; "
+            "0 keeps all of it (default: 65536)"
+        ),
+    )
+    p_serve.add_argument(
+        "--max-body-bytes",
+        type=int,
+        default=DEFAULT_MAX_BODY_BYTES,
+        help="Refuse request bodies larger than this many bytes with 413; 0 means no limit (default: 134217728)",
+    )
+    p_serve.add_argument(
+        "--max-decompression-ratio",
+        type=int,
+        default=DEFAULT_MAX_DECOMPRESSION_RATIO,
+        help=(
+            "Refuse a gzip/deflate/zstd request body that expands to more than this many times its "
+            "compressed size; 0 leaves only --max-body-bytes (default: 1000)"
+        ),
+    )
 
     p_info = sub.add_parser("info", help="Print current stored tokens and derived account id")
     p_info.add_argument("--json", action="store_true", help="Output raw auth.json contents")
@@ -372,6 +547,23 @@ def main() -> None:
                 debug_model=args.debug_model,
                 expose_reasoning_models=args.expose_reasoning_models,
                 default_web_search=default_web_search,
+                upstream_pool_size=args.upstream_pool_size,
+                upstream_http2=args.upstream_http2,
+                upstream_prewarm=args.upstream_prewarm,
+                upstream_prewarm_interval=args.upstream_prewarm_interval,
+                background_token_refresh=not args.disable_token_refresher,
+                session_cache_size=args.session_cache_size,
+                session_cache_ttl=args.session_cache_ttl,
+                persist_sessions=args.persist_sessions,
+                stream_coalesce_ms=args.stream_coalesce_ms,
+                stream_coalesce_bytes=args.stream_coalesce_bytes,
+                json_backend=args.json_backend,
+                max_response_bytes=args.max_response_bytes,
+                stream_buffer_bytes=args.stream_buffer_bytes,
+                stream_memory_budget=args.stream_memory_budget,
+                reasoning_tail_bytes=args.reasoning_tail_bytes,
+                max_body_bytes=args.max_body_bytes,
+                max_decompression_ratio=args.max_decompression_ratio,
             )
         )
     elif args.command == "info":
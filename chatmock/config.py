@@ -3,6 +3,7 @@ from __future__ import annotations
 import os
 import sys
 from pathlib import Path
+from typing import Any, Callable
 
 
 CLIENT_ID_DEFAULT = os.getenv("CHATGPT_LOCAL_CLIENT_ID") or "app_EMoamEEZ73f0CkXaXp7hrann"
@@ -12,6 +13,32 @@ OAUTH_TOKEN_URL = f"{OAUTH_ISSUER_DEFAULT}/oauth/token"
 CHATGPT_RESPONSES_URL = "https://chatgpt.com/backend-api/codex/responses"
 
 
+def env_flag(name: str) -> bool:
+    """A switch set in the environment as 1, true, yes or on."""
+    return (os.getenv(name) or "").strip().lower() in ("1", "true", "yes", "on")
+
+
+def env_int(name: str, default: int) -> int:
+    """An integer setting from the environment; a malformed value warns and keeps ``default``."""
+    return _env_number(name, default, int, "an integer")
+
+
+def env_float(name: str, default: float) -> float:
+    """A float setting from the environment; a malformed value warns and keeps ``default``."""
+    return _env_number(name, default, float, "a number")
+
+
+def _env_number(name: str, default: Any, parse: Callable[[str], Any], expected: str) -> Any:
+    raw = (os.getenv(name) or "").strip()
+    if not raw:
+        return default
+    try:
+        return parse(raw)
+    except ValueError:
+        print(f"WARNING: ignoring {name}={raw!r}, expected {expected}; using {default}.", file=sys.stderr)
+        return default
+
+
 def _read_prompt_text(filename: str) -> str | None:
     candidates = [
         Path(__file__).parent.parent / filename,
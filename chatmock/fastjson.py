@@ -0,0 +1,140 @@
+from __future__ import annotations
+
+import json
+import os
+import sys
+from typing import Any, Callable
+
+from flask.json.provider import DefaultJSONProvider
+
+try:
+    import orjson
+except ImportError:  # optional accelerator
+    orjson = None
+
+BACKENDS = ("auto", "orjson", "json")
+
+# What json.dumps(str) calls under the default options (ensure_ascii=True).
+_encode_str_ascii = json.encoder.encode_basestring_ascii
+
+
+class StdlibCodec:
+    """The standard library ``json`` module, with its default separators and ASCII escapes."""
+
+    name = "json"
+    key_sep = ": "
+    item_sep = ", "
+
+    def loads(self, data: str | bytes | bytearray | memoryview) -> Any:
+        if not isinstance(data, str):
+            # json.loads on bytes re-detects the encoding each call; everything here is UTF-8.
+            data = bytes(data).decode("utf-8", errors="ignore")
+        return json.loads(data)
+
+    def dumps(self, obj: Any, default: Callable[[Any], Any] | None = None) -> str:
+        return json.dumps(obj, default=default)
+
+    def dumpb(self, obj: Any, default: Callable[[Any], Any] | None = None) -> bytes:
+        return json.dumps(obj, default=default).encode("utf-8")
+
+    def quote(self, text: str) -> bytes:
+        """``text`` as a JSON string literal."""
+        return _encode_str_ascii(text).encode("ascii")
+
+
+class OrjsonCodec:
+    """
+    ``orjson``: compact separators and raw UTF-8.
+
+    Input orjson refuses but the stdlib accepts (NaN literals, lone surrogate escapes, invalid
+    UTF-8) and values it cannot write (lone surrogates, integers beyond 64 bits) fall back to
+    the stdlib. Two differences remain: integers beyond 64 bits are read as floats, and
+    NaN/Infinity are written as null.
+    """
+
+    name = "orjson"
+    key_sep = ":"
+    item_sep = ","
+
+    def __init__(self) -> None:
+        self._options = orjson.OPT_NON_STR_KEYS
+        self._app_options = self._options | orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_PASSTHROUGH_DATACLASS
+
+    def loads(self, data: str | bytes | bytearray | memoryview) -> Any:
+        try:
+            return orjson.loads(data)
+        except orjson.JSONDecodeError:
+            return _STDLIB.loads(data)
+
+    def dumps(self, obj: Any, default: Callable[[Any], Any] | None = None) -> str:
+        return self.dumpb(obj, default).decode("utf-8")
+
+    def dumpb(self, obj: Any, default: Callable[[Any], Any] | None = None) -> bytes:
+        try:
+            if default is None:
+                return orjson.dumps(obj, option=self._options)
+            # Leave dates and dataclasses to ``default`` so Flask formats them as it always has.
+            return orjson.dumps(obj, default=default, option=self._app_options)
+        except TypeError:
+            return json.dumps(obj, default=default, separators=(",", ":")).encode("utf-8")
+
+    def quote(self, text: str) -> bytes:
+        try:
+            return orjson.dumps(text)
+        except TypeError:
+            return _STDLIB.quote(text)
+
+
+_STDLIB = StdlibCodec()
+_codec: StdlibCodec | OrjsonCodec = _STDLIB
+
+
+def configure_json(backend: str | None = None) -> str:
+    """
+    Select the JSON codec used for upstream events, stream chunks and Flask responses.
+
+    ``backend`` is "auto" (orjson when installed), "orjson" or "json"; it defaults to
+    CHATGPT_LOCAL_JSON_BACKEND. Returns the name of the codec in use.
+    """
+    global _codec
+    choice = (backend or os.getenv("CHATGPT_LOCAL_JSON_BACKEND") or "auto").strip().lower()
+    if choice not in BACKENDS:
+        raise ValueError(f"Unknown JSON backend {choice!r}; expected one of {', '.join(BACKENDS)}")
+    if choice == "orjson" and orjson is None:
+        print("WARNING: --json-backend orjson requested but orjson is not installed; using json.", file=sys.stderr)
+    _codec = OrjsonCodec() if choice != "json" and orjson is not None else _STDLIB
+    return _codec.name
+
+
+def get_codec() -> StdlibCodec | OrjsonCodec:
+    return _codec
+
+
+def loads(data: str | bytes | bytearray | memoryview) -> Any:
+    return _codec.loads(data)
+
+
+def dumps(obj: Any) -> str:
+    return _codec.dumps(obj)
+
+
+def dumpb(obj: Any) -> bytes:
+    return _codec.dumpb(obj)
+
+
+class ChatMockJSONProvider(DefaultJSONProvider):
+    """Flask JSON provider backed by the selected codec; keys keep their insertion order."""
+
+    sort_keys = False
+
+    def dumps(self, obj: Any, **kwargs: Any) -> str:
+        codec = _codec
+        # jsonify passes separators=(",", ":") unless it is pretty-printing; orjson is always compact.
+        if codec is not _STDLIB and kwargs.get("separators") == (",", ":") and len(kwargs) == 1:
+            return codec.dumps(obj, default=self.default)
+        return super().dumps(obj, **kwargs)
+
+    def loads(self, s: str | bytes, **kwargs: Any) -> Any:
+        if kwargs or _codec is _STDLIB:
+            return super().loads(s, **kwargs)
+        return _codec.loads(s)
@@ -1,6 +1,89 @@
 from __future__ import annotations
 
-from flask import Response, jsonify, request
+import json
+import threading
+import zlib
+from typing import Any, Dict
+
+from flask import Response, has_request_context, jsonify, request
+from werkzeug.exceptions import BadRequest, RequestEntityTooLarge, UnsupportedMediaType
+
+from . import fastjson
+from .config import env_int
+
+try:
+    import zstandard
+except ImportError:  # optional: zstd request bodies
+    zstandard = None
+
+# Request bodies larger than this are refused with 413 before they are read; 0 means no limit.
+DEFAULT_MAX_BODY_BYTES = env_int("CHATGPT_LOCAL_MAX_BODY_BYTES", 128 << 20)
+# A compressed body may expand to at most this many times its size, and never past the body
+# limit; 0 leaves only the body limit.
+DEFAULT_MAX_DECOMPRESSION_RATIO = env_int("CHATGPT_LOCAL_MAX_DECOMPRESSION_RATIO", 1000)
+
+_UNPARSED = object()
+_DECODED_BODY = "chatmock.decoded_body"
+
+
+class BodyDecodeError(BadRequest):
+    """A compressed request body that could not be decompressed."""
+
+
+class _Expanded(Exception):
+    """A compressed body produced more than its output bound."""
+
+
+class _BodyStats:
+    """Compressed request bodies: bytes received and bytes they expanded to, per encoding."""
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self.max_ratio = DEFAULT_MAX_DECOMPRESSION_RATIO
+        self._encodings: Dict[str, Dict[str, int]] = {}
+        self._counts = {"rejected": 0, "invalid": 0, "unsupported": 0}
+
+    def record(self, encoding: str, compressed: int, decoded: int) -> None:
+        with self._lock:
+            entry = self._encodings.setdefault(encoding, {"requests": 0, "compressed_bytes": 0, "decoded_bytes": 0})
+            entry["requests"] += 1
+            entry["compressed_bytes"] += compressed
+            entry["decoded_bytes"] += decoded
+
+    def incr(self, name: str) -> None:
+        with self._lock:
+            self._counts[name] += 1
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            encodings = {name: dict(entry) for name, entry in self._encodings.items()}
+            out: Dict[str, Any] = dict(self._counts)
+        compressed = sum(entry["compressed_bytes"] for entry in encodings.values())
+        decoded = sum(entry["decoded_bytes"] for entry in encodings.values())
+        out.update(
+            {
+                "requests": sum(entry["requests"] for entry in encodings.values()),
+                "compressed_bytes": compressed,
+                "decoded_bytes": decoded,
+                "ratio": round(decoded / compressed, 2) if compressed else 0.0,
+                "encodings": encodings,
+                "max_decompression_ratio": self.max_ratio,
+            }
+        )
+        return out
+
+
+_BODY_STATS = _BodyStats()
+
+
+def request_body_stats() -> Dict[str, Any]:
+    return _BODY_STATS.snapshot()
+
+
+def configure_request_bodies(max_decompression_ratio: int | None = None) -> None:
+    """Set how far a compressed request body may expand; 0 leaves only the body size limit."""
+    if max_decompression_ratio is not None:
+        _BODY_STATS.max_ratio = max(int(max_decompression_ratio), 0)
 
 
 def build_cors_headers() -> dict:
@@ -22,3 +105,160 @@ def json_error(message: str, status: int = 400) -> Response:
         response.headers.setdefault(k, v)
     return response
 
+
+def decode_json_body(raw: bytes) -> Dict[str, Any]:
+    """
+    A request body decoded as a JSON object straight from its bytes; an empty body is ``{}``.
+
+    Raw control characters inside strings (text pasted by some clients) are accepted. Raises
+    ValueError saying where the body is invalid.
+    """
+    if not raw:
+        return {}
+    payload: Any = _UNPARSED
+    orjson = fastjson.orjson
+    if orjson is not None and fastjson.get_codec().name == "orjson":
+        try:
+            payload = orjson.loads(raw)
+        except orjson.JSONDecodeError:
+            pass
+    if payload is _UNPARSED:
+        # The standard library needs text; invalid UTF-8 becomes U+FFFD, as werkzeug decodes it.
+        payload = json.loads(raw.decode("utf-8", errors="replace"), strict=False)
+    if not isinstance(payload, dict):
+        raise ValueError("expected a JSON object")
+    return payload
+
+
+def _inflate(data: bytes, wbits: int, max_out: int) -> bytes:
+    parts = []
+    size = 0
+    while True:
+        inflater = zlib.decompressobj(wbits)
+        try:
+            # Asking for one byte past the bound is enough to tell a body that is too large.
+            part = inflater.decompress(data, max_out - size + 1 if max_out else 0)
+        except zlib.error as exc:
+            raise BodyDecodeError(f"Could not decompress the request body: {exc}") from exc
+        size += len(part)
+        parts.append(part)
+        if max_out and size > max_out:
+            raise _Expanded
+        if not inflater.eof:
+            raise BodyDecodeError("Could not decompress the request body: it is truncated")
+        data = inflater.unused_data
+        # gzip allows several members back to back; anything else after the end is garbage.
+        if not data or wbits != 16 + zlib.MAX_WBITS:
+            break
+    if data:
+        raise BodyDecodeError("Could not decompress the request body: unexpected data after the end")
+    return parts[0] if len(parts) == 1 else b"".join(parts)
+
+
+def _unzstd(data: bytes, max_out: int) -> bytes:
+    if zstandard is None:
+        raise UnsupportedMediaType("zstd request bodies need the zstandard package (pip install zstandard)")
+    dctx = zstandard.ZstdDecompressor()
+    parts = []
+    try:
+        if max_out:
+            # A frame may declare any size, and decompressobj has no output bound; count the
+            # output with a reader first, which stops at the bound, and keep none of it.
+            size = 0
+            with dctx.stream_reader(data, read_across_frames=True) as reader:
+                while size <= max_out:
+                    chunk = reader.read(min(max_out - size + 1, 1 << 20))
+                    if not chunk:
+                        break
+                    size += len(chunk)
+            if size > max_out:
+                raise _Expanded
+        while data:
+            frame = dctx.decompressobj()
+            parts.append(frame.decompress(data))
+            if not frame.eof:
+                raise BodyDecodeError("Could not decompress the request body: it is truncated")
+            data = frame.unused_data
+    except zstandard.ZstdError as exc:
+        raise BodyDecodeError(f"Could not decompress the request body: {exc}") from exc
+    return parts[0] if len(parts) == 1 else b"".join(parts)
+
+
+def _decompress(data: bytes, encoding: str, max_out: int) -> bytes:
+    if encoding in ("gzip", "x-gzip"):
+        return _inflate(data, 16 + zlib.MAX_WBITS, max_out)
+    if encoding == "deflate":
+        # HTTP deflate is zlib-wrapped, but some clients send a bare deflate stream.
+        wrapped = len(data) >= 2 and data[0] & 0x0F == 8 and ((data[0] << 8) | data[1]) % 31 == 0
+        return _inflate(data, zlib.MAX_WBITS if wrapped else -zlib.MAX_WBITS, max_out)
+    if encoding == "zstd":
+        return _unzstd(data, max_out)
+    raise UnsupportedMediaType(f"Unsupported Content-Encoding {encoding!r}; use gzip, deflate or zstd")
+
+
+def _decode_body(raw: bytes, header: str, limit: int | None) -> bytes:
+    encodings = [part.strip().lower() for part in header.split(",")]
+    encodings = [name for name in encodings if name and name != "identity"]
+    if not encodings or not raw:
+        return raw
+    ratio = _BODY_STATS.max_ratio
+    bounds = [bound for bound in (limit, ratio * len(raw) if ratio else 0) if bound]
+    max_out = min(bounds) if bounds else 0
+    body = raw
+    try:
+        # Encodings are listed in the order they were applied.
+        for encoding in reversed(encodings):
+            body = _decompress(body, encoding, max_out)
+    except _Expanded:
+        _BODY_STATS.incr("rejected")
+        if limit and max_out == limit:
+            raise RequestEntityTooLarge(f"Request body exceeds the {limit}-byte limit once decompressed")
+        raise RequestEntityTooLarge(f"Compressed request body expands more than {ratio} times")
+    except UnsupportedMediaType:
+        _BODY_STATS.incr("unsupported")
+        raise
+    except BodyDecodeError:
+        _BODY_STATS.incr("invalid")
+        raise
+    _BODY_STATS.record("+".join(encodings), len(raw), len(body))
+    return body
+
+
+def read_body(cache: bool = True) -> bytes:
+    """
+    The current request's body, decompressed per its Content-Encoding; raises
+    RequestEntityTooLarge past MAX_CONTENT_LENGTH. Without ``cache`` the bytes are not kept on
+    the request, so they can be freed once parsed.
+    """
+    decoded = request.environ.get(_DECODED_BODY)
+    if decoded is not None:
+        return decoded
+    raw = request.get_data(cache=cache)
+    limit = request.max_content_length
+    # werkzeug cuts a chunked body off at the limit without saying so; one more byte from the
+    # server's stream tells a truncated body from one exactly at the limit.
+    if limit and request.content_length is None and len(raw) >= limit and request.environ["wsgi.input"].read(1):
+        raise RequestEntityTooLarge(f"Request body exceeds the {limit}-byte limit")
+    header = request.headers.get("Content-Encoding")
+    if header:
+        raw = _decode_body(raw, header, limit)
+        if cache:
+            request.environ[_DECODED_BODY] = raw
+    return raw
+
+
+def read_json_body() -> Dict[str, Any]:
+    """The current request's body, as decode_json_body parses it."""
+    return decode_json_body(read_body(cache=False))
+
+
+def body_preview(limit: int = 2000) -> str:
+    """The start of the current request's body, for verbose logging."""
+    return read_body()[:limit].decode("utf-8", errors="replace")
+
+
+def client_socket() -> Any:
+    """The socket of the client being served, when the WSGI server exposes it (werkzeug does)."""
+    if not has_request_context():
+        return None
+    return request.environ.get("werkzeug.socket")
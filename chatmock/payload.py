@@ -0,0 +1,146 @@
+from __future__ import annotations
+
+import threading
+from collections import OrderedDict
+from typing import Any, Iterator, List, Mapping, Tuple
+
+from . import fastjson
+from .rawjson import RawJSONObject
+
+# Instruction texts are tens of kilobytes but come in a handful of variants (one per model
+# family, plus client system prompts that repeat across a conversation).
+_MAX_FRAGMENTS = 32
+
+
+class _FragmentCache:
+    """Encoded JSON string literals of recently used instruction texts."""
+
+    def __init__(self, max_entries: int = _MAX_FRAGMENTS) -> None:
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[Tuple[str, str], bytes]" = OrderedDict()
+        self.max_entries = max_entries
+
+    def quote(self, text: str) -> bytes:
+        codec = fastjson.get_codec()
+        key = (codec.name, text)
+        with self._lock:
+            fragment = self._entries.get(key)
+            if fragment is not None:
+                self._entries.move_to_end(key)
+                return fragment
+        fragment = codec.quote(text)
+        with self._lock:
+            self._entries[key] = fragment
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return fragment
+
+
+_FRAGMENTS = _FragmentCache()
+
+
+def encode_instructions(text: str) -> bytes:
+    """``text`` as a JSON string literal, cached across requests."""
+    return _FRAGMENTS.quote(text)
+
+
+# Encoded values at least this large are sent as their own chunk instead of being copied into
+# the rest of the body.
+_CHUNK_BYTES = 64 << 10
+
+
+class RequestBody:
+    """
+    An encoded JSON object request body, kept as the chunks it was written in so large values
+    (images, long histories) are never copied into one buffer. Both transports send it like
+    bytes, with a Content-Length. It is immutable, so a request and its resumes share it.
+    """
+
+    __slots__ = ("_chunks", "_empty")
+
+    def __init__(self, chunks: Tuple[bytes | memoryview, ...], empty: bool) -> None:
+        # The last chunk is always small and holds the closing brace.
+        self._chunks = chunks
+        self._empty = empty
+
+    @classmethod
+    def wrap(cls, body: bytes) -> "RequestBody":
+        """A view of an already encoded JSON object."""
+        end = body.rindex(b"}")
+        last = end - 1
+        while last >= 0 and body[last] in b" \t\r\n":
+            last -= 1
+        return cls((memoryview(body)[:end], body[end:]), body[last] == ord("{"))
+
+    def __len__(self) -> int:
+        return sum(len(chunk) for chunk in self._chunks)
+
+    def __iter__(self) -> Iterator[bytes | memoryview]:
+        # A fresh iterator each time, so a retried request sends the whole body again.
+        return iter(self._chunks)
+
+    def tobytes(self) -> bytes:
+        return b"".join(self._chunks)
+
+    def with_members(self, members: Mapping[str, Any]) -> "RequestBody":
+        """This body with ``members`` appended; only the small closing chunk is copied."""
+        codec = fastjson.get_codec()
+        key_sep = codec.key_sep.encode()
+        item_sep = codec.item_sep.encode()
+        added = item_sep.join(codec.quote(key) + key_sep + codec.dumpb(value) for key, value in members.items())
+        if not added:
+            return self
+        if not self._empty:
+            added = item_sep + added
+        last = bytes(self._chunks[-1])
+        end = last.rindex(b"}")
+        return RequestBody(self._chunks[:-1] + (last[:end] + added + last[end:],), False)
+
+
+def encode_payload(payload: Mapping[str, Any]) -> RequestBody:
+    """
+    The JSON body for an upstream Responses request, written with the configured codec.
+
+    The instructions member is spliced in from the fragment cache instead of being escaped
+    again; every other member is encoded as usual, in the payload's order.
+    """
+    codec = fastjson.get_codec()
+    key_sep = codec.key_sep.encode()
+    item_sep = codec.item_sep.encode()
+    chunks: List[bytes] = []
+    pending: List[bytes] = [b"{"]
+    for index, (key, value) in enumerate(payload.items()):
+        if key == "instructions" and isinstance(value, str):
+            fragment = _FRAGMENTS.quote(value)
+        else:
+            fragment = codec.dumpb(value)
+        if index:
+            pending.append(item_sep)
+        pending.append(codec.quote(key) + key_sep)
+        if len(fragment) >= _CHUNK_BYTES:
+            chunks.append(b"".join(pending))
+            chunks.append(fragment)
+            pending = []
+        else:
+            pending.append(fragment)
+    pending.append(b"}")
+    chunks.append(b"".join(pending))
+    return RequestBody(tuple(chunks), not payload)
+
+
+def resume_body(body: bytes | RequestBody, token: str | None) -> bytes | RequestBody:
+    """The request body that reconnects to a stream at ``token``, or restarts it without one."""
+    if isinstance(body, bytes):
+        if b'"range_start_token"' in body:
+            # Only a client body that already names a position is re-written; this is rare.
+            edited = RawJSONObject(body)
+            if token:
+                edited.set("range_start_token", token)
+            else:
+                edited.pop("range_start_token")
+            return edited.tobytes()
+        if not token:
+            return body
+        body = RequestBody.wrap(body)
+    # Encoded payloads never carry a position of their own.
+    return body.with_members({"range_start_token": token}) if token else body
@@ -0,0 +1,446 @@
+from __future__ import annotations
+
+import select
+import selectors
+import socket
+import ssl
+import threading
+import time
+import zlib
+from typing import Any, Callable, Iterator, Tuple
+
+from .buffers import stream_buffers
+
+# After the consumer stops reading, wait this long for the end of the body so the connection
+# can go back to the pool (mirrors the bounded drain in transport._PooledResponse).
+_RELEASE_WAIT_SECONDS = 0.05
+_RECV_SIZE = 65536
+# Only the pump thread reads sockets, so one receive buffer serves every stream.
+_RECV_VIEW = memoryview(bytearray(_RECV_SIZE))
+_MSG_DONTWAIT = getattr(socket, "MSG_DONTWAIT", 0)
+
+
+class ClientDisconnected(Exception):
+    """The downstream client closed its connection while its upstream body was being pumped."""
+
+
+def _peek_peer(sock: Any) -> bool | None:
+    """True if the peer of ``sock`` has closed it, False if it sent data, None if nothing is pending."""
+    try:
+        if not _MSG_DONTWAIT:
+            readable, _, _ = select.select([sock], [], [], 0)
+            if not readable:
+                return None
+        # Bypass any TLS wrapper: only whether the peer hung up matters, not what it sent.
+        data = socket.socket.recv(sock, 1, socket.MSG_PEEK | _MSG_DONTWAIT)
+    except (BlockingIOError, InterruptedError):
+        return None
+    except (OSError, ValueError):
+        return True
+    return not data
+
+
+def peer_closed(sock: Any) -> bool:
+    """Whether the other end of the (client) socket ``sock`` has gone away."""
+    return _peek_peer(sock) is True
+
+
+class _ChunkedDecoder:
+    """Incremental decoder for a Transfer-Encoding: chunked body."""
+
+    def __init__(self) -> None:
+        self._buf = bytearray()
+        self._left = 0  # bytes left in the current chunk, plus its trailing CRLF
+        self._in_trailers = False
+        self.done = False
+
+    def feed(self, data: bytes) -> bytes:
+        buf = self._buf
+        buf += data
+        out = bytearray()
+        pos = 0
+        while not self.done:
+            if self._left:
+                take = min(self._left, len(buf) - pos)
+                if take <= 0:
+                    break
+                body_left = self._left - 2
+                if body_left > 0:
+                    out += buf[pos : pos + min(take, body_left)]
+                pos += take
+                self._left -= take
+                continue
+            eol = buf.find(b"\r\n", pos)
+            if eol < 0:
+                break
+            line = bytes(buf[pos:eol])
+            pos = eol + 2
+            if self._in_trailers:
+                if not line:
+                    self.done = True
+                continue
+            try:
+                size = int(line.split(b";", 1)[0].strip(), 16)
+            except ValueError:
+                raise ConnectionError("Malformed chunked upstream body") from None
+            if size == 0:
+                self._in_trailers = True
+            else:
+                self._left = size + 2
+        del buf[:pos]
+        return bytes(out)
+
+
+class PumpedStream:
+    """
+    One upstream HTTP/1.1 body whose socket is watched by the shared pump thread.
+
+    The pump thread only moves bytes from the socket into ``_raw``; framing and content decoding
+    run in the consuming request thread when it wakes up. While ``_raw`` is over the stream
+    buffer bounds the socket is not watched, until the request thread has taken what is there.
+    """
+
+    def __init__(self, response: Any, sock: Any, prefetched: bytes) -> None:
+        self._response = response
+        self._sock = sock
+        self._cond = threading.Condition()
+        self._raw = bytearray(prefetched)
+        self._eof = False
+        self._error: BaseException | None = None
+        self._closed = False
+        headers = getattr(response, "headers", {}) or {}
+        encoding = (headers.get("Transfer-Encoding") or "").lower()
+        self._chunked = _ChunkedDecoder() if "chunked" in encoding else None
+        length = headers.get("Content-Length")
+        self._remaining: int | None = int(length) if self._chunked is None and length and length.isdigit() else None
+        coding = (headers.get("Content-Encoding") or "").strip().lower()
+        self._inflate = None
+        if coding in ("gzip", "x-gzip"):
+            self._inflate = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        elif coding == "deflate":
+            self._inflate = zlib.decompressobj()
+        self._body_done = False
+        self._timeout: float | None = None
+        self._client: Any = None
+        self._client_gone = False
+        self._paused = False
+        self._buffers = stream_buffers()
+        self._buffers.add(len(self._raw))
+
+    # -- pump thread side -------------------------------------------------------------------
+
+    def _on_readable(self) -> bool:
+        """Read whatever the socket has; returns False once the stream no longer needs watching."""
+        finished = paused = False
+        error: BaseException | None = None
+        with self._cond:
+            raw = self._raw
+            try:
+                while True:
+                    if self._buffers.full(len(raw)):
+                        paused = True
+                        break
+                    try:
+                        n = self._sock.recv_into(_RECV_VIEW)
+                    except (ssl.SSLWantReadError, BlockingIOError, InterruptedError):
+                        break
+                    if not n:
+                        finished = True
+                        break
+                    raw += _RECV_VIEW[:n]
+                    self._buffers.add(n)
+                    if isinstance(self._sock, ssl.SSLSocket) and not self._sock.pending():
+                        break
+            except (OSError, ssl.SSLError) as exc:
+                error = exc
+            if finished:
+                self._eof = True
+            if error is not None:
+                self._error = error
+            if paused:
+                self._paused = True
+            self._cond.notify_all()
+        if paused:
+            self._buffers.paused()
+        return not (finished or paused or error is not None)
+
+    def _on_client_readable(self) -> bool:
+        """The client socket became readable; returns False once it no longer needs watching."""
+        state = _peek_peer(self._client)
+        if state is None:
+            return True
+        if state:
+            with self._cond:
+                self._client_gone = True
+                self._cond.notify_all()
+        # Either way there is nothing left to learn: a client pipelining its next request is alive.
+        return False
+
+    # -- consumer side ----------------------------------------------------------------------
+
+    def _take(self) -> bytes:
+        """
+        The next slice of what the pump has buffered (called with ``_cond`` held). Slices are
+        small so a backlog is not turned into SSE events all at once.
+        """
+        raw = self._raw
+        n = min(len(raw), _RECV_SIZE)
+        data = bytes(raw[:n])
+        del raw[:n]
+        self._buffers.release(n)
+        if self._paused and not self._closed and not self._buffers.full(len(raw)):
+            # The client caught up: read the upstream again.
+            self._paused = False
+            _PUMP.register(self)
+        return data
+
+    def _decode(self, data: bytes) -> bytes:
+        if self._chunked is not None:
+            data = self._chunked.feed(data)
+            if self._chunked.done:
+                self._body_done = True
+        elif self._remaining is not None:
+            if len(data) >= self._remaining:
+                data = data[: self._remaining]
+                self._body_done = True
+            self._remaining -= len(data)
+        if self._inflate is not None and data:
+            data = self._inflate.decompress(data)
+        return data
+
+    def iter_chunks(self, keepalive_interval: float | Callable[[], float]) -> Iterator[bytes | None]:
+        """
+        Yield decoded body bytes, or None whenever ``keepalive_interval`` passes without data.
+
+        ``keepalive_interval`` may be a callable, asked again before every wait. Raises
+        ClientDisconnected as soon as a socket passed to ``watch_client`` is closed by its peer.
+        """
+        while not self._body_done:
+            interval = keepalive_interval() if callable(keepalive_interval) else keepalive_interval
+            with self._cond:
+                deadline = time.monotonic() + interval
+                while not self._raw and not self._eof and self._error is None and not self._client_gone:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                if self._client_gone:
+                    raise ClientDisconnected()
+                data = self._take()
+                # End of body or an error only counts once everything before it was handed out.
+                eof, error = (self._eof, self._error) if not self._raw else (False, None)
+            if not data and not eof and error is None:
+                yield None
+                continue
+            if data:
+                decoded = self._decode(data)
+                if decoded:
+                    yield decoded
+            if self._body_done:
+                break
+            if error is not None:
+                raise ConnectionError(f"Upstream stream error: {error}")
+            if eof:
+                if self._chunked is not None or self._remaining:
+                    raise ConnectionError("Upstream stream closed before the end of the body")
+                break
+
+    def watch_client(self, sock: Any) -> None:
+        """Also watch the downstream client's socket, so a hang-up wakes ``iter_chunks`` at once."""
+        if sock is None or self._closed or self._client is not None:
+            return
+        self._client = sock
+        _PUMP.watch(self)
+
+    def close(self, drain: bool = True) -> None:
+        """
+        Stop watching the socket and hand the connection back to the pool if the body ended.
+
+        With ``drain`` False the rest of the body is not waited for and the connection is closed
+        right away, which is what a cancelled stream wants.
+        """
+        if self._closed:
+            return
+        self._closed = True
+        if drain and not self._body_done and self._error is None:
+            deadline = time.monotonic() + _RELEASE_WAIT_SECONDS
+            with self._cond:
+                while not self._body_done and not self._eof and self._error is None:
+                    if self._raw:
+                        data = self._take()
+                        try:
+                            self._decode(data)
+                        except Exception:
+                            break
+                        continue
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+        unregistered = _PUMP.unregister(self)
+        with self._cond:
+            self._buffers.release(len(self._raw))
+            leftover = bool(self._raw)
+            self._raw.clear()
+        raw = getattr(self._response, "raw", None)
+        httplib_response = getattr(raw, "_fp", None)
+        reusable = unregistered and self._body_done and not leftover and self._error is None
+        try:
+            if reusable:
+                self._sock.setblocking(True)
+                self._sock.settimeout(getattr(self, "_timeout", None))
+                if httplib_response is not None:
+                    httplib_response.close()
+                raw.release_conn()
+            else:
+                raw.close()
+        except Exception:
+            try:
+                raw.close()
+            except Exception:
+                pass
+
+
+class _ClientWatch:
+    """Selector key data for a client socket watched on behalf of a pumped stream."""
+
+    __slots__ = ("stream",)
+
+    def __init__(self, stream: PumpedStream) -> None:
+        self.stream = stream
+
+    def _on_readable(self) -> bool:
+        return self.stream._on_client_readable()
+
+
+class _Pump:
+    """A single selector thread shared by every pumped upstream stream."""
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._selector: selectors.BaseSelector | None = None
+        self._thread: threading.Thread | None = None
+        self._wake_r: socket.socket | None = None
+        self._wake_w: socket.socket | None = None
+        self._changes: list[Tuple[str, PumpedStream, threading.Event]] = []
+
+    def _ensure_started(self) -> None:
+        if self._thread is not None:
+            return
+        self._selector = selectors.DefaultSelector()
+        self._wake_r, self._wake_w = socket.socketpair()
+        self._wake_r.setblocking(False)
+        self._wake_w.setblocking(False)
+        self._selector.register(self._wake_r, selectors.EVENT_READ, None)
+        self._thread = threading.Thread(target=self._run, name="chatmock-stream-pump", daemon=True)
+        self._thread.start()
+
+    def _submit(self, op: str, stream: PumpedStream) -> threading.Event:
+        applied = threading.Event()
+        with self._lock:
+            self._ensure_started()
+            self._changes.append((op, stream, applied))
+            wake = self._wake_w
+        try:
+            wake.send(b"\0")
+        except (BlockingIOError, OSError):
+            pass
+        return applied
+
+    def register(self, stream: PumpedStream) -> None:
+        self._submit("add", stream)
+
+    def watch(self, stream: PumpedStream) -> None:
+        self._submit("watch", stream)
+
+    def unregister(self, stream: PumpedStream) -> bool:
+        """Stop watching ``stream``; returns once the pump thread can no longer touch its socket."""
+        return self._submit("remove", stream).wait(5.0)
+
+    def _apply_changes(self, selector: selectors.BaseSelector) -> None:
+        with self._lock:
+            changes, self._changes = self._changes, []
+        for op, stream, applied in changes:
+            try:
+                if op == "add":
+                    selector.register(stream._sock, selectors.EVENT_READ, stream)
+                    # TLS may already hold decrypted bytes the fd will never signal.
+                    if not stream._on_readable():
+                        selector.unregister(stream._sock)
+                elif op == "watch":
+                    if not stream._closed:
+                        selector.register(stream._client, selectors.EVENT_READ, _ClientWatch(stream))
+                else:
+                    if stream._client is not None:
+                        try:
+                            selector.unregister(stream._client)
+                        except (KeyError, ValueError, OSError):
+                            pass
+                    selector.unregister(stream._sock)
+            except (KeyError, ValueError, OSError):
+                pass
+            applied.set()
+
+    def _run(self) -> None:
+        selector = self._selector
+        assert selector is not None and self._wake_r is not None
+        while True:
+            for key, _ in selector.select():
+                stream = key.data
+                if stream is None:
+                    try:
+                        while self._wake_r.recv(4096):
+                            pass
+                    except (BlockingIOError, OSError):
+                        pass
+                    continue
+                if not stream._on_readable():
+                    try:
+                        selector.unregister(key.fileobj)
+                    except (KeyError, ValueError):
+                        pass
+            self._apply_changes(selector)
+
+
+_PUMP = _Pump()
+
+
+def pump_response(response: Any) -> PumpedStream | None:
+    """
+    Take over reading an unread HTTP/1.1 streaming ``requests`` response. Returns None when the
+    response is not a plain socket-backed urllib3 body (HTTP/2, unknown content coding, already
+    partially consumed), in which case the caller keeps reading it the usual way.
+    """
+    raw = getattr(response, "raw", None)
+    httplib_response = getattr(raw, "_fp", None)
+    fp = getattr(httplib_response, "fp", None)
+    conn = getattr(raw, "_connection", None)
+    sock = getattr(conn, "sock", None)
+    if fp is None or sock is None or getattr(response, "_content_consumed", False):
+        return None
+    coding = (response.headers.get("Content-Encoding") or "identity").strip().lower()
+    if coding not in ("identity", "gzip", "x-gzip", "deflate"):
+        return None
+    if getattr(raw, "_decoded_buffer", None) is not None and len(raw._decoded_buffer):
+        return None
+    try:
+        timeout = sock.gettimeout()
+        sock.setblocking(False)
+    except (OSError, ValueError):
+        return None
+    try:
+        # Body bytes that arrived together with the headers sit in the reader's buffer.
+        prefetched = fp.peek(1 << 20) if hasattr(fp, "peek") else b""
+    except OSError:
+        prefetched = b""
+    except ValueError:
+        sock.settimeout(timeout)
+        return None
+    if prefetched:
+        prefetched = fp.read(len(prefetched))
+    stream = PumpedStream(response, sock, prefetched or b"")
+    stream._timeout = timeout
+    # requests must not drain or read the body itself from here on.
+    response._content_consumed = True
+    _PUMP.register(stream)
+    return stream
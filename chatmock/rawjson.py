@@ -0,0 +1,113 @@
+from __future__ import annotations
+
+import json
+from json.decoder import WHITESPACE, scanstring
+from json.scanner import make_scanner
+from typing import Any, Dict, List, Tuple
+
+from . import fastjson
+
+_scan_value = make_scanner(json.JSONDecoder())
+_skip_ws = WHITESPACE.match
+_MISSING = object()
+
+
+class RawJSONObject:
+    """
+    A JSON object request body whose top-level members can be read, replaced and removed while
+    every other member is forwarded as the exact bytes the client sent.
+
+    The body is validated by the standard library's C scanner (on a latin-1 view, so string
+    offsets are byte offsets) only to locate the members; nothing is re-serialized except the
+    members that change. Raises ValueError for anything that is not a UTF-8 JSON object.
+    """
+
+    def __init__(self, body: bytes) -> None:
+        if not body.isascii():
+            body.decode("utf-8")  # UnicodeDecodeError is a ValueError
+        self._body = body
+        self._spans: Dict[str, Tuple[int, int]] = {}
+        self._changes: Dict[str, bytes | None] = {}
+        text = body.decode("latin-1")
+        try:
+            self._scan(text)
+        except (IndexError, StopIteration) as exc:
+            raise ValueError("Invalid JSON object") from exc
+
+    def _scan(self, s: str) -> None:
+        i = _skip_ws(s, 0).end()
+        if s[i] != "{":
+            raise ValueError("Not a JSON object")
+        i = _skip_ws(s, i + 1).end()
+        if s[i] == "}":
+            i += 1
+        else:
+            while True:
+                if s[i] != '"':
+                    raise ValueError(f"Expecting property name at byte {i}")
+                key, end = scanstring(s, i + 1)
+                if not key.isascii():
+                    key = json.loads(self._body[i:end].decode("utf-8"))
+                i = _skip_ws(s, end).end()
+                if s[i] != ":":
+                    raise ValueError(f"Expecting ':' at byte {i}")
+                i = _skip_ws(s, i + 1).end()
+                _, end = _scan_value(s, i)
+                self._spans[key] = (i, end)
+                i = _skip_ws(s, end).end()
+                if s[i] == "}":
+                    i += 1
+                    break
+                if s[i] != ",":
+                    raise ValueError(f"Expecting ',' at byte {i}")
+                i = _skip_ws(s, i + 1).end()
+        if _skip_ws(s, i).end() != len(s):
+            raise ValueError("Extra data after the JSON object")
+
+    def __contains__(self, key: str) -> bool:
+        change = self._changes.get(key, _MISSING)
+        return key in self._spans if change is _MISSING else change is not None
+
+    def raw(self, key: str) -> bytes | None:
+        """The member's value as JSON bytes, or None when it is absent."""
+        change = self._changes.get(key, _MISSING)
+        if change is not _MISSING:
+            return change
+        span = self._spans.get(key)
+        return self._body[span[0] : span[1]] if span is not None else None
+
+    def get(self, key: str, default: Any = None) -> Any:
+        value = self.raw(key)
+        return fastjson.loads(value) if value is not None else default
+
+    def set(self, key: str, value: Any) -> None:
+        self._changes[key] = fastjson.dumpb(value)
+
+    def set_raw(self, key: str, value: bytes) -> None:
+        """Replace ``key`` with ``value``, already encoded as JSON."""
+        self._changes[key] = value
+
+    def pop(self, key: str) -> bool:
+        """Remove ``key``; returns whether it was present."""
+        present = key in self
+        if present:
+            self._changes[key] = None
+        return present
+
+    def tobytes(self) -> bytes:
+        """The edited body: members in their original order, then added ones."""
+        if not self._changes:
+            return self._body
+        body = self._body
+        parts: List[bytes] = []
+        for key, (start, end) in self._spans.items():
+            if key in self._changes:
+                value = self._changes[key]
+                if value is not None:
+                    parts.append(fastjson.dumpb(key) + b":" + value)
+            else:
+                parts.append(fastjson.dumpb(key) + b":" + body[start:end])
+        for key, value in self._changes.items():
+            if key not in self._spans and value is not None:
+                parts.append(fastjson.dumpb(key) + b":" + value)
+        return b"{" + b",".join(parts) + b"}"
@@ -5,11 +5,12 @@ import time
 import uuid
 from typing import Any, Dict, List
 
-from flask import Blueprint, Response, current_app, jsonify, make_response, request
+from flask import Blueprint, Response, current_app, jsonify, make_response
 
+from . import fastjson
 from .config import BASE_INSTRUCTIONS
 from .limits import record_rate_limits_from_response
-from .http import build_cors_headers
+from .http import body_preview, build_cors_headers, read_json_body
 from .reasoning import build_reasoning_param, extract_reasoning_from_model_name
 from .transform import (
     CLAUDE_CODE_DEFAULT_MAX_TOKENS,
@@ -18,36 +19,23 @@ from .transform import (
     finalize_claude_response,
     prepare_claude_code_conversation,
 )
+from .session import peek_session
+from .translate import Encoder, StreamState, ToolCall, aggregate, translate
 from .upstream import normalize_model_name, start_upstream_request
+from .usage import last_session_input_tokens
 from .utils import convert_chat_messages_to_responses_input
 
 claude_code_bp = Blueprint("claude_code", __name__, url_prefix="/claude")
 
 
-def _extract_usage(evt: Dict[str, Any]) -> Dict[str, int] | None:
-    try:
-        usage = (evt.get("response") or {}).get("usage")
-    except Exception:
-        usage = None
-    if not isinstance(usage, dict):
+def _claude_usage(usage: Dict[str, Any] | None) -> Dict[str, int] | None:
+    if not usage:
         return None
-    try:
-        prompt_tokens = int(usage.get("input_tokens") or 0)
-        completion_tokens = int(usage.get("output_tokens") or 0)
-    except Exception:
-        prompt_tokens = usage.get("input_tokens") or 0
-        completion_tokens = usage.get("output_tokens") or 0
-    total_tokens = usage.get("total_tokens")
-    if not isinstance(total_tokens, int):
-        try:
-            total_tokens = int(total_tokens)
-        except Exception:
-            total_tokens = prompt_tokens + completion_tokens
-    return {
-        "prompt_tokens": prompt_tokens,
-        "completion_tokens": completion_tokens,
-        "total_tokens": total_tokens,
-    }
+    usage = dict(usage)
+    details = usage.pop("prompt_tokens_details", None)
+    if isinstance(details, dict):
+        usage["cache_read_input_tokens"] = details.get("cached_tokens") or 0
+    return usage
 
 
 def _convert_tool_item(item: Any) -> tuple[Dict[str, Any] | None, Dict[str, Any] | None]:
@@ -82,6 +70,66 @@ def _convert_tool_item(item: Any) -> tuple[Dict[str, Any] | None, Dict[str, Any]
     return call_payload, stream_delta
 
 
+class ClaudeStreamEncoder(Encoder):
+    """Claude-style ``message_delta`` / ``message_stop`` server-sent events."""
+
+    name = "claude.messages/stream"
+    events = frozenset(
+        {
+            "response.output_text.delta",
+            "response.reasoning_summary_text.delta",
+            "response.reasoning_text.delta",
+            "response.output_item.added",
+            "response.function_call_arguments.delta",
+            "response.output_item.done",
+        }
+    )
+    default_response_id = "claude-msg"
+    keepalive = ": keepalive\n\n"
+
+    def __init__(self, model: str) -> None:
+        self.model = model
+
+    def content(self, state: StreamState, text: str) -> List[str]:
+        chunk = format_claude_stream_chunk(response_id=state.response_id, model=self.model, content_delta=text)
+        return [f"data: {fastjson.dumps(chunk)}\n\n"]
+
+    def reasoning(self, state: StreamState, text: str, summary: bool) -> List[str]:
+        chunk = format_claude_stream_chunk(response_id=state.response_id, model=self.model, reasoning_delta=text)
+        return [f"data: {fastjson.dumps(chunk)}\n\n"]
+
+    def tool_call_arguments(self, state: StreamState, call: ToolCall, delta: str) -> List[str]:
+        # Partial input JSON as it is generated; the complete tool_use still follows on item_done.
+        chunk = format_claude_stream_chunk(
+            response_id=state.response_id,
+            model=self.model,
+            tool_call_delta={"type": "input_json_delta", "id": call.call_id, "name": call.name, "partial_json": delta},
+        )
+        return [f"data: {fastjson.dumps(chunk)}\n\n"]
+
+    def item_done(self, state: StreamState, item: Any) -> List[str]:
+        _, tool_delta = _convert_tool_item(item)
+        if not tool_delta:
+            return []
+        chunk = format_claude_stream_chunk(
+            response_id=state.response_id,
+            model=self.model,
+            content_delta=None,
+            tool_call_delta=tool_delta,
+        )
+        return [f"data: {fastjson.dumps(chunk)}\n\n"]
+
+    def finish(self, state: StreamState) -> List[str]:
+        stop_chunk = format_claude_stream_chunk(
+            response_id=state.response_id,
+            model=self.model,
+            usage=_claude_usage(state.usage),
+            stop_reason="end_turn",
+            done=True,
+        )
+        return [f"data: {fastjson.dumps(stop_chunk)}\n\n", "data: [DONE]\n\n"]
+
+
 def _claude_instructions(model: str) -> str:
     base = current_app.config.get("BASE_INSTRUCTIONS", BASE_INSTRUCTIONS)
     return base
@@ -106,13 +154,12 @@ def claude_chat() -> Response:
     reasoning_summary = current_app.config.get("REASONING_SUMMARY", "auto")
     reasoning_compat = current_app.config.get("REASONING_COMPAT", "think-tags")
 
-    raw = request.get_data(cache=True, as_text=True) or ""
+    if verbose:
+        print("IN POST /claude/v1/chat/completions\n" + body_preview())
     try:
-        payload = json.loads(raw) if raw else {}
-        if verbose:
-            print("IN POST /claude/v1/chat/completions\n" + raw[:2000])
-    except Exception:
-        return jsonify({"error": {"message": "Invalid JSON body"}}), 400
+        payload = read_json_body()
+    except ValueError as e:
+        return jsonify({"error": {"message": f"Invalid JSON body: {e}"}}), 400
 
     requested_model = payload.get("model")
     normalized_model = normalize_model_name(requested_model, current_app.config.get("DEBUG_MODEL"))
@@ -200,69 +247,8 @@ def claude_chat() -> Response:
         )
 
     if payload.get("stream"):
-        def _event_stream():
-            response_id = "claude-msg"
-            client_disconnected = False
-            try:
-                for raw_line in upstream.iter_lines(decode_unicode=False):
-                    if not raw_line:
-                        continue
-                    line = raw_line.decode("utf-8", errors="ignore") if isinstance(raw_line, (bytes, bytearray)) else raw_line
-                    if not line.startswith("data: "):
-                        continue
-                    data = line[len("data: "):].strip()
-                    if not data:
-                        continue
-                    if data == "[DONE]":
-                        break
-                    try:
-                        evt = json.loads(data)
-                    except Exception:
-                        continue
-                    kind = evt.get("type")
-                    if isinstance(evt.get("response"), dict) and isinstance(evt["response"].get("id"), str):
-                        response_id = evt["response"].get("id") or response_id
-                    if kind == "response.output_text.delta":
-                        chunk = format_claude_stream_chunk(
-                            response_id=response_id,
-                            model=requested_model,
-                            content_delta=evt.get("delta") or "",
-                        )
-                        yield f"data: {json.dumps(chunk)}\n\n"
-                    elif kind in ("response.reasoning_summary_text.delta", "response.reasoning_text.delta"):
-                        delta = evt.get("delta") or ""
-                        chunk = format_claude_stream_chunk(
-                            response_id=response_id,
-                            model=requested_model,
-                            reasoning_delta=delta,
-                        )
-                        yield f"data: {json.dumps(chunk)}\n\n"
-                    elif kind == "response.output_item.done":
-                        tool_payload, tool_delta = _convert_tool_item(evt.get("item"))
-                        if tool_delta:
-                            chunk = format_claude_stream_chunk(
-                                response_id=response_id,
-                                model=requested_model,
-                                content_delta=None,
-                                tool_call_delta=tool_delta,
-                            )
-                            yield f"data: {json.dumps(chunk)}\n\n"
-            except GeneratorExit:
-                client_disconnected = True
-            finally:
-                upstream.close()
-            if client_disconnected:
-                return
-            stop_chunk = format_claude_stream_chunk(
-                response_id=response_id,
-                model=requested_model,
-                stop_reason="end_turn",
-                done=True,
-            )
-            yield f"data: {json.dumps(stop_chunk)}\n\n"
-            yield "data: [DONE]\n\n"
         resp = Response(
-            _event_stream(),
+            translate(upstream, ClaudeStreamEncoder(requested_model)),
             status=200,
             mimetype="text/event-stream",
             headers={"Cache-Control": "no-cache", "Connection": "keep-alive"},
@@ -271,49 +257,17 @@ def claude_chat() -> Response:
             resp.headers.setdefault(k, v)
         return resp
 
-    full_text = ""
-    reasoning_text = ""
-    usage_obj: Dict[str, int] | None = None
+    result = aggregate(upstream, "claude.messages", "claude-msg")
+    full_text = result.text
+    reasoning_text = result.reasoning
     tool_calls: List[Dict[str, Any]] = []
-    response_id = "claude-msg"
-    error_message: str | None = None
-    try:
-        for raw_line in upstream.iter_lines(decode_unicode=False):
-            if not raw_line:
-                continue
-            line = raw_line.decode("utf-8", errors="ignore") if isinstance(raw_line, (bytes, bytearray)) else raw_line
-            if not line.startswith("data: "):
-                continue
-            data = line[len("data: "):].strip()
-            if not data:
-                continue
-            if data == "[DONE]":
-                break
-            try:
-                evt = json.loads(data)
-            except Exception:
-                continue
-            kind = evt.get("type")
-            usage_delta = _extract_usage(evt)
-            if usage_delta:
-                usage_obj = usage_delta
-            if isinstance(evt.get("response"), dict) and isinstance(evt["response"].get("id"), str):
-                response_id = evt["response"].get("id") or response_id
-            if kind == "response.output_text.delta":
-                full_text += evt.get("delta") or ""
-            elif kind in ("response.reasoning_summary_text.delta", "response.reasoning_text.delta"):
-                reasoning_text += evt.get("delta") or ""
-            elif kind == "response.output_item.done":
-                call_payload, _ = _convert_tool_item(evt.get("item"))
-                if call_payload:
-                    tool_calls.append(call_payload)
-            elif kind == "response.failed":
-                error_message = evt.get("response", {}).get("error", {}).get("message", "response.failed")
-                break
-            elif kind == "response.completed":
-                break
-    finally:
-        upstream.close()
+    for item in result.items:
+        call_payload, _ = _convert_tool_item(item)
+        if call_payload:
+            tool_calls.append(call_payload)
+    usage_obj = _claude_usage(result.usage)
+    response_id = result.response_id
+    error_message = result.error
 
     if error_message:
         resp = make_response(jsonify({"error": {"message": error_message}}), 502)
@@ -338,13 +292,12 @@ def claude_chat() -> Response:
 @claude_code_bp.route("/v1/messages/count_tokens", methods=["POST"])
 def claude_count_tokens() -> Response:
     verbose = bool(current_app.config.get("VERBOSE"))
-    raw = request.get_data(cache=True, as_text=True) or ""
+    if verbose:
+        print("IN POST /claude/v1/messages/count_tokens\n" + body_preview())
     try:
-        payload = json.loads(raw) if raw else {}
-        if verbose:
-            print("IN POST /claude/v1/messages/count_tokens\n" + raw[:2000])
-    except Exception:
-        return jsonify({"error": {"message": "Invalid JSON body"}}), 400
+        payload = read_json_body()
+    except ValueError as e:
+        return jsonify({"error": {"message": f"Invalid JSON body: {e}"}}), 400
 
     requested_model = payload.get("model")
     instructions, messages = prepare_claude_code_conversation(
@@ -353,10 +306,18 @@ def claude_count_tokens() -> Response:
     )
     input_items = convert_chat_messages_to_responses_input(messages)
     approx_tokens = _estimate_claude_token_count(instructions, input_items)
+    # The upstream prompt cache holds whatever the matching conversation last sent; estimate how
+    # much of this prompt that covers from the share of leading items already seen.
+    cache_read = 0
+    session_id, matched_items, total_items = peek_session(instructions, input_items)
+    if session_id and matched_items and total_items:
+        last_input = last_session_input_tokens(session_id)
+        if last_input:
+            cache_read = min(last_input, approx_tokens * matched_items // total_items)
     body = {
         "input_tokens": approx_tokens,
         "cache_create_input_tokens": 0,
-        "cache_read_input_tokens": 0,
+        "cache_read_input_tokens": cache_read,
     }
     resp = jsonify(body)
     for k, v in build_cors_headers().items():
@@ -5,13 +5,15 @@ import datetime
 import time
 from typing import Any, Dict, List
 
-from flask import Blueprint, Response, current_app, jsonify, make_response, request, stream_with_context
+from flask import Blueprint, Response, current_app, jsonify, make_response, stream_with_context
 
+from . import fastjson
 from .config import BASE_INSTRUCTIONS, GPT5_CODEX_INSTRUCTIONS
 from .limits import record_rate_limits_from_response
-from .http import build_cors_headers
+from .http import body_preview, build_cors_headers, read_json_body
 from .reasoning import build_reasoning_param, extract_reasoning_from_model_name
 from .transform import convert_ollama_messages, normalize_ollama_tools
+from .translate import Encoder, StreamState, TextBuffer, aggregate, function_call, translate
 from .upstream import normalize_model_name, start_upstream_request
 from .utils import convert_chat_messages_to_responses_input, convert_tools_chat_to_responses
 
@@ -38,6 +40,65 @@ _OLLAMA_FAKE_EVAL = {
 }
 
 
+class OllamaChatStreamEncoder(Encoder):
+    """Ollama /api/chat newline-delimited JSON; reasoning only shows up as content."""
+
+    name = "ollama.chat/stream"
+    events = frozenset(
+        {
+            "response.reasoning_summary_text.delta",
+            "response.reasoning_text.delta",
+            "response.output_text.delta",
+            "response.output_item.done",
+        }
+    )
+
+    def __init__(self, model: str, created_at: str, compat: str) -> None:
+        self.model = model
+        self.created_at = created_at
+        self.compat = compat
+        self.full_text = TextBuffer()
+
+    def _line(self, content: str, done: bool = False, tool_calls: List[Dict[str, Any]] | None = None) -> str:
+        message: Dict[str, Any] = {"role": "assistant", "content": content}
+        if tool_calls:
+            message["tool_calls"] = tool_calls
+        return fastjson.dumps(
+            {
+                "model": self.model,
+                "created_at": self.created_at,
+                "message": message,
+                "done": done,
+            }
+        ) + "\n"
+
+    def content(self, state: StreamState, text: str) -> List[str]:
+        if not text:
+            return []
+        self.full_text.append(text)
+        return [self._line(text)]
+
+    def reasoning(self, state: StreamState, text: str, summary: bool) -> List[str]:
+        return self.content(state, text) if self.compat == "o3" else []
+
+    def item_done(self, state: StreamState, item: Any) -> List[str]:
+        # Ollama has no partial tool calls; each one goes out whole once its arguments are complete.
+        call = function_call(item)
+        return [self._line("", tool_calls=[call])] if call is not None else []
+
+    def finish(self, state: StreamState) -> List[str]:
+        out = list(self.close_think(state))
+        done_obj = {
+            "model": self.model,
+            "created_at": self.created_at,
+            "message": {"role": "assistant", "content": self.full_text.getvalue()},
+            "done": True,
+        }
+        done_obj.update(_OLLAMA_FAKE_EVAL)
+        out.append(fastjson.dumps(done_obj) + "\n")
+        return out
+
+
 @ollama_bp.route("/api/tags", methods=["GET"])
 def ollama_tags() -> Response:
     if bool(current_app.config.get("VERBOSE")):
@@ -86,13 +147,12 @@ def ollama_show() -> Response:
     verbose = bool(current_app.config.get("VERBOSE"))
     try:
         if verbose:
-            body_preview = (request.get_data(cache=True, as_text=True) or "")[:2000]
-            print("IN POST /api/show\n" + body_preview)
+            print("IN POST /api/show\n" + body_preview())
     except Exception:
         pass
     try:
-        payload = request.get_json(silent=True) or {}
-    except Exception:
+        payload = read_json_body()
+    except ValueError:
         payload = {}
     model = payload.get("model")
     if not isinstance(model, str) or not model.strip():
@@ -129,13 +189,12 @@ def ollama_chat() -> Response:
     reasoning_summary = current_app.config.get("REASONING_SUMMARY", "auto")
     reasoning_compat = current_app.config.get("REASONING_COMPAT", "think-tags")
 
+    if verbose:
+        print("IN POST /api/chat\n" + body_preview())
     try:
-        raw = request.get_data(cache=True, as_text=True) or ""
-        if verbose:
-            print("IN POST /api/chat\n" + (raw[:2000] if isinstance(raw, str) else ""))
-        payload = json.loads(raw) if raw else {}
-    except Exception:
-        return jsonify({"error": "Invalid JSON body"}), 400
+        payload = read_json_body()
+    except ValueError as e:
+        return jsonify({"error": f"Invalid JSON body: {e}"}), 400
 
     model = payload.get("model")
     raw_messages = payload.get("messages")
@@ -248,168 +307,9 @@ def ollama_chat() -> Response:
     model_out = model if isinstance(model, str) and model.strip() else normalized_model
 
     if stream_req:
-        def _gen():
-            compat = (current_app.config.get("REASONING_COMPAT", "think-tags") or "think-tags").strip().lower()
-            think_open = False
-            think_closed = False
-            saw_any_summary = False
-            pending_summary_paragraph = False
-            full_parts: List[str] = []
-            try:
-                for raw_line in upstream.iter_lines(decode_unicode=False):
-                    if not raw_line:
-                        continue
-                    line = raw_line.decode("utf-8", errors="ignore") if isinstance(raw_line, (bytes, bytearray)) else raw_line
-                    if not line.startswith("data: "):
-                        continue
-                    data = line[len("data: "):].strip()
-                    if not data:
-                        continue
-                    if data == "[DONE]":
-                        break
-                    try:
-                        evt = json.loads(data)
-                    except Exception:
-                        continue
-                    kind = evt.get("type")
-                    if kind == "response.reasoning_summary_part.added":
-                        if compat in ("think-tags", "o3"):
-                            if saw_any_summary:
-                                pending_summary_paragraph = True
-                            else:
-                                saw_any_summary = True
-                    elif kind in ("response.reasoning_summary_text.delta", "response.reasoning_text.delta"):
-                        delta_txt = evt.get("delta") or ""
-                        if compat == "o3":
-                            if kind == "response.reasoning_summary_text.delta" and pending_summary_paragraph:
-                                yield (
-                                    json.dumps(
-                                        {
-                                            "model": model_out,
-                                            "created_at": created_at,
-                                            "message": {"role": "assistant", "content": "\n"},
-                                            "done": False,
-                                        }
-                                    )
-                                    + "\n"
-                                )
-                                full_parts.append("\n")
-                                pending_summary_paragraph = False
-                            if delta_txt:
-                                yield (
-                                    json.dumps(
-                                        {
-                                            "model": model_out,
-                                            "created_at": created_at,
-                                            "message": {"role": "assistant", "content": delta_txt},
-                                            "done": False,
-                                        }
-                                    )
-                                    + "\n"
-                                )
-                                full_parts.append(delta_txt)
-                        elif compat == "think-tags":
-                            if not think_open and not think_closed:
-                                yield (
-                                    json.dumps(
-                                        {
-                                            "model": model_out,
-                                            "created_at": created_at,
-                                            "message": {"role": "assistant", "content": "<think>"},
-                                            "done": False,
-                                        }
-                                    )
-                                    + "\n"
-                                )
-                                full_parts.append("<think>")
-                                think_open = True
-                            if think_open and not think_closed:
-                                if kind == "response.reasoning_summary_text.delta" and pending_summary_paragraph:
-                                    yield (
-                                        json.dumps(
-                                            {
-                                                "model": model_out,
-                                                "created_at": created_at,
-                                                "message": {"role": "assistant", "content": "\n"},
-                                                "done": False,
-                                            }
-                                        )
-                                        + "\n"
-                                    )
-                                    full_parts.append("\n")
-                                    pending_summary_paragraph = False
-                                if delta_txt:
-                                    yield (
-                                        json.dumps(
-                                            {
-                                                "model": model_out,
-                                                "created_at": created_at,
-                                                "message": {"role": "assistant", "content": delta_txt},
-                                                "done": False,
-                                            }
-                                        )
-                                        + "\n"
-                                    )
-                                    full_parts.append(delta_txt)
-                        else:
-                            pass
-                    elif kind == "response.output_text.delta":
-                        delta = evt.get("delta") or ""
-                        if compat == "think-tags" and think_open and not think_closed:
-                            yield (
-                                json.dumps(
-                                    {
-                                        "model": model_out,
-                                        "created_at": created_at,
-                                        "message": {"role": "assistant", "content": "</think>"},
-                                        "done": False,
-                                    }
-                                )
-                                + "\n"
-                            )
-                            full_parts.append("</think>")
-                            think_open = False
-                            think_closed = True
-                        if delta:
-                            yield (
-                                json.dumps(
-                                    {
-                                        "model": model_out,
-                                        "created_at": created_at,
-                                        "message": {"role": "assistant", "content": delta},
-                                        "done": False,
-                                    }
-                                )
-                                + "\n"
-                            )
-                            full_parts.append(delta)
-                    elif kind == "response.completed":
-                        break
-            finally:
-                upstream.close()
-                if compat == "think-tags" and think_open and not think_closed:
-                    yield (
-                        json.dumps(
-                            {
-                                "model": model_out,
-                                "created_at": created_at,
-                                "message": {"role": "assistant", "content": "</think>"},
-                                "done": False,
-                            }
-                        )
-                        + "\n"
-                    )
-                    full_parts.append("</think>")
-                done_obj = {
-                    "model": model_out,
-                    "created_at": created_at,
-                    "message": {"role": "assistant", "content": "".join(full_parts)},
-                    "done": True,
-                }
-                done_obj.update(_OLLAMA_FAKE_EVAL)
-                yield json.dumps(done_obj) + "\n"
+        compat = (current_app.config.get("REASONING_COMPAT", "think-tags") or "think-tags").strip().lower()
         resp = current_app.response_class(
-            stream_with_context(_gen()),
+            stream_with_context(translate(upstream, OllamaChatStreamEncoder(model_out, created_at, compat))),
             status=200,
             mimetype="application/x-ndjson",
         )
@@ -417,51 +317,16 @@ def ollama_chat() -> Response:
             resp.headers.setdefault(k, v)
         return resp
 
-    full_text = ""
-    reasoning_summary_text = ""
-    reasoning_full_text = ""
-    tool_calls: List[Dict[str, Any]] = []
-    try:
-        for raw in upstream.iter_lines(decode_unicode=False):
-            if not raw:
-                continue
-            line = raw.decode("utf-8", errors="ignore") if isinstance(raw, (bytes, bytearray)) else raw
-            if not line.startswith("data: "):
-                continue
-            data = line[len("data: "):].strip()
-            if not data:
-                continue
-            if data == "[DONE]":
-                break
-            try:
-                evt = json.loads(data)
-            except Exception:
-                continue
-            kind = evt.get("type")
-            if kind == "response.output_text.delta":
-                full_text += evt.get("delta") or ""
-            elif kind == "response.reasoning_summary_text.delta":
-                reasoning_summary_text += evt.get("delta") or ""
-            elif kind == "response.reasoning_text.delta":
-                reasoning_full_text += evt.get("delta") or ""
-            elif kind == "response.output_item.done":
-                item = evt.get("item") or {}
-                if isinstance(item, dict) and item.get("type") == "function_call":
-                    call_id = item.get("call_id") or item.get("id") or ""
-                    name = item.get("name") or ""
-                    args = item.get("arguments") or ""
-                    if isinstance(call_id, str) and isinstance(name, str) and isinstance(args, str):
-                        tool_calls.append(
-                            {
-                                "id": call_id,
-                                "type": "function",
-                                "function": {"name": name, "arguments": args},
-                            }
-                        )
-            elif kind == "response.completed":
-                break
-    finally:
-        upstream.close()
+    result = aggregate(upstream, "ollama.chat", "")
+    if result.too_large:
+        resp = make_response(jsonify({"error": result.error}), 502)
+        for k, v in build_cors_headers().items():
+            resp.headers.setdefault(k, v)
+        return resp
+    full_text = result.text
+    reasoning_summary_text = result.reasoning_summary
+    reasoning_full_text = result.reasoning_full
+    tool_calls = result.function_calls()
 
     if (current_app.config.get("REASONING_COMPAT", "think-tags") or "think-tags").strip().lower() == "think-tags":
         rtxt_parts = []
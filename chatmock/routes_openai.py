@@ -10,9 +10,14 @@ from flask import Blueprint, Response, current_app, jsonify, make_response, requ
 
 from .config import BASE_INSTRUCTIONS, GPT5_CODEX_INSTRUCTIONS, CHATGPT_RESPONSES_URL
 from .limits import record_rate_limits_from_response
-from .http import build_cors_headers
+from .http import body_preview, build_cors_headers, decode_json_body, read_body, read_json_body
 from .reasoning import apply_reasoning_to_message, build_reasoning_param, extract_reasoning_from_model_name
 from .session import ensure_session_id
+from .payload import encode_instructions
+from .rawjson import RawJSONObject
+from .translate import aggregate, relay
+from .transport import upstream_post
+from .usage import UsageSniffer
 from .upstream import normalize_model_name, start_upstream_request
 from .utils import (
     convert_chat_messages_to_responses_input,
@@ -45,19 +50,14 @@ def chat_completions() -> Response:
 
     if verbose:
         try:
-            body_preview = (request.get_data(cache=True, as_text=True) or "")[:2000]
-            print("IN POST /v1/chat/completions\n" + body_preview)
+            print("IN POST /v1/chat/completions\n" + body_preview())
         except Exception:
             pass
 
-    raw = request.get_data(cache=True, as_text=True) or ""
     try:
-        payload = json.loads(raw) if raw else {}
-    except Exception:
-        try:
-            payload = json.loads(raw.replace("\r", "").replace("\n", ""))
-        except Exception:
-            return jsonify({"error": {"message": "Invalid JSON body"}}), 400
+        payload = read_json_body()
+    except ValueError as e:
+        return jsonify({"error": {"message": f"Invalid JSON body: {e}"}}), 400
 
     requested_model = payload.get("model")
     model = normalize_model_name(requested_model, debug_model)
@@ -225,73 +225,12 @@ def chat_completions() -> Response:
             resp.headers.setdefault(k, v)
         return resp
 
-    full_text = ""
-    reasoning_summary_text = ""
-    reasoning_full_text = ""
-    response_id = "chatcmpl"
-    tool_calls: List[Dict[str, Any]] = []
-    error_message: str | None = None
-    usage_obj: Dict[str, int] | None = None
-
-    def _extract_usage(evt: Dict[str, Any]) -> Dict[str, int] | None:
-        try:
-            usage = (evt.get("response") or {}).get("usage")
-            if not isinstance(usage, dict):
-                return None
-            pt = int(usage.get("input_tokens") or 0)
-            ct = int(usage.get("output_tokens") or 0)
-            tt = int(usage.get("total_tokens") or (pt + ct))
-            return {"prompt_tokens": pt, "completion_tokens": ct, "total_tokens": tt}
-        except Exception:
-            return None
-    try:
-        for raw in upstream.iter_lines(decode_unicode=False):
-            if not raw:
-                continue
-            line = raw.decode("utf-8", errors="ignore") if isinstance(raw, (bytes, bytearray)) else raw
-            if not line.startswith("data: "):
-                continue
-            data = line[len("data: "):].strip()
-            if not data:
-                continue
-            if data == "[DONE]":
-                break
-            try:
-                evt = json.loads(data)
-            except Exception:
-                continue
-            kind = evt.get("type")
-            mu = _extract_usage(evt)
-            if mu:
-                usage_obj = mu
-            if isinstance(evt.get("response"), dict) and isinstance(evt["response"].get("id"), str):
-                response_id = evt["response"].get("id") or response_id
-            if kind == "response.output_text.delta":
-                full_text += evt.get("delta") or ""
-            elif kind == "response.reasoning_summary_text.delta":
-                reasoning_summary_text += evt.get("delta") or ""
-            elif kind == "response.reasoning_text.delta":
-                reasoning_full_text += evt.get("delta") or ""
-            elif kind == "response.output_item.done":
-                item = evt.get("item") or {}
-                if isinstance(item, dict) and item.get("type") == "function_call":
-                    call_id = item.get("call_id") or item.get("id") or ""
-                    name = item.get("name") or ""
-                    args = item.get("arguments") or ""
-                    if isinstance(call_id, str) and isinstance(name, str) and isinstance(args, str):
-                        tool_calls.append(
-                            {
-                                "id": call_id,
-                                "type": "function",
-                                "function": {"name": name, "arguments": args},
-                            }
-                        )
-            elif kind == "response.failed":
-                error_message = evt.get("response", {}).get("error", {}).get("message", "response.failed")
-            elif kind == "response.completed":
-                break
-    finally:
-        upstream.close()
+    result = aggregate(upstream, "chat.completions", "chatcmpl")
+    full_text = result.text
+    tool_calls = result.function_calls()
+    error_message = result.error
+    usage_obj = result.usage
+    response_id = result.response_id
 
     if error_message:
         resp = make_response(jsonify({"error": {"message": error_message}}), 502)
@@ -302,7 +241,7 @@ def chat_completions() -> Response:
     message: Dict[str, Any] = {"role": "assistant", "content": full_text if full_text else None}
     if tool_calls:
         message["tool_calls"] = tool_calls
-    message = apply_reasoning_to_message(message, reasoning_summary_text, reasoning_full_text, reasoning_compat)
+    message = apply_reasoning_to_message(message, result.reasoning_summary, result.reasoning_full, reasoning_compat)
     completion = {
         "id": response_id or "chatcmpl",
         "object": "chat.completion",
@@ -330,11 +269,10 @@ def completions() -> Response:
     reasoning_effort = current_app.config.get("REASONING_EFFORT", "medium")
     reasoning_summary = current_app.config.get("REASONING_SUMMARY", "auto")
 
-    raw = request.get_data(cache=True, as_text=True) or ""
     try:
-        payload = json.loads(raw) if raw else {}
-    except Exception:
-        return jsonify({"error": {"message": "Invalid JSON body"}}), 400
+        payload = read_json_body()
+    except ValueError as e:
+        return jsonify({"error": {"message": f"Invalid JSON body: {e}"}}), 400
 
     requested_model = payload.get("model")
     model = normalize_model_name(requested_model, debug_model)
@@ -393,48 +331,15 @@ def completions() -> Response:
             resp.headers.setdefault(k, v)
         return resp
 
-    full_text = ""
-    response_id = "cmpl"
-    usage_obj: Dict[str, int] | None = None
-    def _extract_usage(evt: Dict[str, Any]) -> Dict[str, int] | None:
-        try:
-            usage = (evt.get("response") or {}).get("usage")
-            if not isinstance(usage, dict):
-                return None
-            pt = int(usage.get("input_tokens") or 0)
-            ct = int(usage.get("output_tokens") or 0)
-            tt = int(usage.get("total_tokens") or (pt + ct))
-            return {"prompt_tokens": pt, "completion_tokens": ct, "total_tokens": tt}
-        except Exception:
-            return None
-    try:
-        for raw_line in upstream.iter_lines(decode_unicode=False):
-            if not raw_line:
-                continue
-            line = raw_line.decode("utf-8", errors="ignore") if isinstance(raw_line, (bytes, bytearray)) else raw_line
-            if not line.startswith("data: "):
-                continue
-            data = line[len("data: "):].strip()
-            if not data or data == "[DONE]":
-                if data == "[DONE]":
-                    break
-                continue
-            try:
-                evt = json.loads(data)
-            except Exception:
-                continue
-            if isinstance(evt.get("response"), dict) and isinstance(evt["response"].get("id"), str):
-                response_id = evt["response"].get("id") or response_id
-            mu = _extract_usage(evt)
-            if mu:
-                usage_obj = mu
-            kind = evt.get("type")
-            if kind == "response.output_text.delta":
-                full_text += evt.get("delta") or ""
-            elif kind == "response.completed":
-                break
-    finally:
-        upstream.close()
+    result = aggregate(upstream, "completions", "cmpl")
+    if result.too_large:
+        resp = make_response(jsonify({"error": {"message": result.error}}), 502)
+        for k, v in build_cors_headers().items():
+            resp.headers.setdefault(k, v)
+        return resp
+    full_text = result.text
+    response_id = result.response_id
+    usage_obj = result.usage
 
     completion = {
         "id": response_id or "cmpl",
@@ -463,26 +368,23 @@ def responses_passthrough() -> Response:
     """
     verbose = bool(current_app.config.get("VERBOSE"))
 
-    raw = request.get_data(cache=True, as_text=True) or ""
-    raw_for_upstream = raw
+    raw = read_body() or b"{}"
     if verbose:
         try:
-            body_preview = raw[:2000]
-            print("IN POST /v1/responses\n" + body_preview)
+            print("IN POST /v1/responses\n" + body_preview())
         except Exception:
             pass
 
-    # Minimal inspection: only to ensure valid JSON and to auto-fill instructions when absent/invalid
+    # Minimal inspection: the body is only validated and the few members below are patched in
+    # place; everything else goes upstream as the bytes the client sent.
     try:
-        payload = json.loads(raw) if raw else {}
-    except Exception:
+        body = RawJSONObject(raw)
+    except ValueError:
         try:
-            payload = json.loads(raw.replace("\r", "").replace("\n", ""))
-        except Exception:
-            return jsonify({"error": {"message": "Invalid JSON body"}}), 400
-
-    if not isinstance(payload, dict):
-        return jsonify({"error": {"message": "Request body must be a JSON object"}}), 400
+            payload = decode_json_body(raw)
+        except ValueError as e:
+            return jsonify({"error": {"message": f"Invalid JSON body: {e}"}}), 400
+        body = RawJSONObject(json.dumps(payload, ensure_ascii=False).encode("utf-8"))
 
     def _instructions_valid(val: Any) -> bool:
         if isinstance(val, str):
@@ -491,46 +393,39 @@ def responses_passthrough() -> Response:
             return len(val) > 0
         return False
 
-    default_instr = _instructions_for_model(payload.get("model") or "")
-    mutated = False
+    model = body.get("model")
+    default_instr = _instructions_for_model(model or "")
     # Always use default instructions; downstream-provided instructions are not supported/ignored
-    payload["instructions"] = default_instr
-    mutated = True
+    body.set_raw("instructions", encode_instructions(default_instr))
 
     # Compatibility: drop unsupported params that upstream rejects
     for _drop_key in ("temperature", "max_output_tokens", "previous_response_id"):
-        if _drop_key in payload:
-            payload.pop(_drop_key, None)
-            mutated = True
+        body.pop(_drop_key)
 
     # Compatibility: default store=False if absent
     # if "store" not in payload:
     #     payload["store"] = False
-    #     mutated = True
-    payload["store"] = False
-    mutated = True
+    body.set("store", False)
 
     # Compatibility: default stream=True if absent
-    if "stream" not in payload:
-        payload["stream"] = True
-        mutated = True
+    if "stream" not in body:
+        body.set("stream", True)
 
     # Compatibility: allow simple string input and normalize to Responses item list
-    if isinstance(payload.get("input"), str):
-        payload["input"] = [
-            {
-                "type": "message",
-                "role": "user",
-                "content": [{"type": "input_text", "text": payload["input"]}],
-            }
-        ]
-        mutated = True
+    raw_input = body.raw("input")
+    if raw_input is not None and raw_input.startswith(b'"'):
+        body.set(
+            "input",
+            [
+                {
+                    "type": "message",
+                    "role": "user",
+                    "content": [{"type": "input_text", "text": body.get("input")}],
+                }
+            ],
+        )
 
-    if mutated:
-        try:
-            raw_for_upstream = json.dumps(payload, ensure_ascii=False)
-        except Exception:
-            raw_for_upstream = raw  # fallback; should not happen
+    raw_for_upstream = body.tobytes()
 
     # Get authentication
     access_token, account_id = get_effective_chatgpt_auth()
@@ -586,9 +481,11 @@ def responses_passthrough() -> Response:
     request_timeout = 1800
     request_ctx = {
         "url": CHATGPT_RESPONSES_URL,
-        "payload": raw_for_upstream,
+        "body": raw_for_upstream,
         "headers": dict(upstream_headers),
         "timeout": request_timeout,
+        "session_id": client_session_id or body.get("prompt_cache_key"),
+        "model": model,
     }
 
     if verbose:
@@ -611,10 +508,10 @@ def responses_passthrough() -> Response:
             pass
 
     try:
-        upstream = requests.post(
+        upstream = upstream_post(
             CHATGPT_RESPONSES_URL,
             headers=upstream_headers,
-            data=raw_for_upstream.encode("utf-8"),
+            data=raw_for_upstream,
             stream=True,
             timeout=request_timeout,
         )
@@ -654,19 +551,18 @@ def responses_passthrough() -> Response:
             and bool(default_instr.strip())
         )
         if retry_for_instructions:
-            fallback_payload = payload.copy()
-            fallback_payload["instructions"] = default_instr
+            body.set_raw("instructions", encode_instructions(default_instr))
             try:
-                fallback_raw = json.dumps(fallback_payload, ensure_ascii=False)
+                fallback_raw = body.tobytes()
             except Exception:
                 fallback_raw = None
 
             if fallback_raw:
                 try:
-                    upstream_retry = requests.post(
+                    upstream_retry = upstream_post(
                         CHATGPT_RESPONSES_URL,
                         headers=upstream_headers,
-                        data=fallback_raw.encode("utf-8"),
+                        data=fallback_raw,
                         stream=True,
                         timeout=request_timeout,
                     )
@@ -680,7 +576,7 @@ def responses_passthrough() -> Response:
                     if upstream_retry.status_code < 400:
                         upstream = upstream_retry
                         raw_for_upstream = fallback_raw
-                        request_ctx["payload"] = fallback_raw
+                        request_ctx["body"] = fallback_raw
                         setattr(upstream, "_chatmock_request_ctx", request_ctx)
                     else:
                         body_bytes = upstream_retry.content or b""
@@ -719,13 +615,13 @@ def responses_passthrough() -> Response:
             upstream.close()
             return resp
 
+    blocks = relay(upstream)
+
     def generate():
-        try:
-            for chunk in upstream.iter_content(chunk_size=1024, decode_unicode=False):
-                if chunk:
-                    yield chunk
-        finally:
-            upstream.close()
+        sniffer = UsageSniffer(request_ctx)
+        for block in blocks:
+            sniffer.feed(block)
+            yield block
 
     resp = Response(generate(), status=upstream.status_code)
     content_type = upstream.headers.get("Content-Type")
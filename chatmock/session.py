@@ -2,88 +2,453 @@ from __future__ import annotations
 
 import hashlib
 import json
+import os
+import sqlite3
 import threading
+import time
 import uuid
-from typing import Any, Dict, List, Tuple
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, Tuple
 
+from .config import env_flag, env_float, env_int
+from .utils import eprint, get_home_dir
 
-_LOCK = threading.Lock()
-_FINGERPRINT_TO_UUID: Dict[str, str] = {}
-_ORDER: List[str] = []
-_MAX_ENTRIES = 10000
 
+DEFAULT_MAX_ENTRIES = env_int("CHATGPT_LOCAL_SESSION_CACHE_SIZE", 10000)
+DEFAULT_TTL_SECONDS = env_float("CHATGPT_LOCAL_SESSION_CACHE_TTL", 0.0)
+DEFAULT_PERSIST_SESSIONS = env_flag("CHATGPT_LOCAL_PERSIST_SESSIONS")
+_SHARD_COUNT = 16
+# SQLITE_BUSY and SQLITE_LOCKED: another process holds the database past the busy timeout.
+_BUSY_CODES = (5, 6)
 
-def _canonicalize_first_user_message(input_items: List[Dict[str, Any]]) -> Dict[str, Any] | None:
+
+# Images at least this long are fingerprinted from a fixed number of samples instead of in full.
+_IMAGE_SAMPLE_THRESHOLD = 4096
+_IMAGE_SAMPLES = 16
+_IMAGE_SAMPLE_BYTES = 64
+
+
+def _image_digest(url: str) -> bytes:
     """
-    Extract the first stable user message from Responses input items. Good use for a fingerprint for prompt caching.
+    Digest an image URL in constant time: its length plus evenly spaced samples. Two different
+    images of identical length and samples would share a prompt_cache_key, which only affects
+    upstream cache routing, never the content sent.
     """
-    for item in input_items:
-        if not isinstance(item, dict):
-            continue
-        if item.get("type") != "message":
-            continue
-        role = item.get("role")
-        if role != "user":
-            continue
-        content = item.get("content")
-        if not isinstance(content, list):
+    n = len(url)
+    if n < _IMAGE_SAMPLE_THRESHOLD:
+        return hashlib.sha256(url.encode("utf-8")).digest()
+    h = hashlib.sha256(n.to_bytes(8, "little"))
+    span = n - _IMAGE_SAMPLE_BYTES
+    for k in range(_IMAGE_SAMPLES):
+        off = span * k // (_IMAGE_SAMPLES - 1)
+        h.update(url[off : off + _IMAGE_SAMPLE_BYTES].encode("utf-8"))
+    return h.digest()
+
+
+def _hash_str(h: Any, tag: bytes, value: Any) -> None:
+    if not isinstance(value, str):
+        value = json.dumps(value, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+    data = value.encode("utf-8")
+    h.update(tag)
+    h.update(len(data).to_bytes(8, "little"))
+    h.update(data)
+
+
+def _content_parts(content: Any) -> List[Tuple[bytes, Any]]:
+    if isinstance(content, str):
+        return [(b"t", content)] if content else []
+    if not isinstance(content, list):
+        return []
+    parts: List[Tuple[bytes, Any]] = []
+    for part in content:
+        if not isinstance(part, dict):
             continue
-        norm_content = []
-        for part in content:
-            if not isinstance(part, dict):
-                continue
-            ptype = part.get("type")
-            if ptype == "input_text":
-                text = part.get("text") if isinstance(part.get("text"), str) else ""
-                if text:
-                    norm_content.append({"type": "input_text", "text": text})
-            elif ptype == "input_image":
-                url = part.get("image_url") if isinstance(part.get("image_url"), str) else None
-                if url:
-                    norm_content.append({"type": "input_image", "image_url": url})
-        if norm_content:
-            return {"type": "message", "role": "user", "content": norm_content}
-    return None
-
-
-def canonicalize_prefix(instructions: str | None, input_items: List[Dict[str, Any]]) -> str:
-    prefix: Dict[str, Any] = {}
+        ptype = part.get("type")
+        if ptype in ("input_text", "output_text", "text"):
+            text = part.get("text") if isinstance(part.get("text"), str) else ""
+            if text:
+                parts.append((b"t", text))
+        elif ptype == "input_image":
+            url = part.get("image_url") if isinstance(part.get("image_url"), str) else None
+            if url:
+                parts.append((b"i", url))
+    return parts
+
+
+def _hash_item(h: Any, item: Any) -> bool:
+    """
+    Feed the fields of one Responses input item that determine the upstream prompt prefix into
+    ``h``, without building an intermediate JSON document. Ids and other per-request metadata
+    are skipped so a resent history hashes the same. Returns False for items that carry nothing.
+    """
+    if not isinstance(item, dict):
+        return False
+    itype = item.get("type")
+    if itype == "message" or (itype is None and "role" in item):
+        parts = _content_parts(item.get("content"))
+        if not parts:
+            return False
+        _hash_str(h, b"m", item.get("role") or "")
+        for tag, value in parts:
+            if tag == b"i":
+                h.update(b"i")
+                h.update(_image_digest(value))
+            else:
+                _hash_str(h, tag, value)
+    elif itype == "function_call":
+        _hash_str(h, b"f", item.get("call_id") or "")
+        _hash_str(h, b"n", item.get("name") or "")
+        _hash_str(h, b"a", item.get("arguments") or "")
+    elif itype == "function_call_output":
+        _hash_str(h, b"o", item.get("call_id") or "")
+        _hash_str(h, b"r", item.get("output") or "")
+    else:
+        _hash_str(h, b"x", item)
+    return True
+
+
+def prefix_fingerprints(instructions: str | None, input_items: List[Dict[str, Any]]) -> List[str]:
+    """
+    Rolling fingerprints of the prompt prefix: entry ``i`` covers the instructions plus the
+    first ``i + 1`` input items, so two requests share entry ``i`` exactly when their first
+    ``i + 1`` items match.
+    """
+    h = hashlib.sha256()
     if isinstance(instructions, str) and instructions.strip():
-        prefix["instructions"] = instructions.strip()
-    first_user = _canonicalize_first_user_message(input_items)
-    if first_user is not None:
-        prefix["first_user_message"] = first_user
-    return json.dumps(prefix, sort_keys=True, separators=(",", ":"))
+        h.update(instructions.strip().encode("utf-8"))
+    digest = h.digest()
+    out: List[str] = []
+    for item in input_items or []:
+        h = hashlib.sha256(digest)
+        if not _hash_item(h, item):
+            continue
+        digest = h.digest()
+        out.append(h.hexdigest())
+    if not out:
+        out.append(digest.hex())
+    return out
 
 
-def _fingerprint(s: str) -> str:
-    return hashlib.sha256(s.encode("utf-8")).hexdigest()
+class _Shard:
+    __slots__ = ("lock", "entries", "max_entries", "evictions", "expirations")
 
+    def __init__(self, max_entries: int) -> None:
+        self.lock = threading.Lock()
+        # fingerprint -> (session id, last used); ordered oldest to most recently used
+        self.entries: "OrderedDict[str, Tuple[str, float]]" = OrderedDict()
+        self.max_entries = max_entries
+        self.evictions = 0
+        self.expirations = 0
 
-def _remember(fp: str, sid: str) -> None:
-    if fp in _FINGERPRINT_TO_UUID:
-        return
-    _FINGERPRINT_TO_UUID[fp] = sid
-    _ORDER.append(fp)
-    if len(_ORDER) > _MAX_ENTRIES:
-        oldest = _ORDER.pop(0)
-        _FINGERPRINT_TO_UUID.pop(oldest, None)
 
+def _is_busy(exc: sqlite3.Error) -> bool:
+    code = getattr(exc, "sqlite_errorcode", None)
+    if code is not None:
+        return code & 0xFF in _BUSY_CODES
+    message = str(exc).lower()
+    return "locked" in message or "busy" in message
 
-def ensure_session_id(
+
+class SessionStore:
+    """SQLite-backed fingerprint -> session id table shared by every process using the same home.
+
+    The in-memory map answers first; the store is consulted for prefixes longer than the memory
+    match, so a restarted (or sibling) worker reuses the session id a conversation already had
+    upstream.
+    """
+
+    _COMPACT_EVERY = 1000
+
+    def __init__(self, path: str, max_entries: int, ttl: float) -> None:
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._ready = False
+        self._failed = False
+        self._writes = 0
+        self.hits = 0
+        self.misses = 0
+        self.errors = 0
+        self.busy = 0
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            return conn
+        conn = sqlite3.connect(self.path, timeout=5.0, isolation_level=None)
+        conn.execute("PRAGMA busy_timeout=5000")
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        with self._lock:
+            if not self._ready:
+                conn.execute(
+                    "CREATE TABLE IF NOT EXISTS sessions ("
+                    "fingerprint TEXT PRIMARY KEY, session_id TEXT NOT NULL, last_used REAL NOT NULL)"
+                )
+                self._compact(conn)
+                self._ready = True
+        self._local.conn = conn
+        return conn
+
+    def _compact(self, conn: sqlite3.Connection) -> None:
+        if self.ttl:
+            conn.execute("DELETE FROM sessions WHERE last_used < ?", (time.time() - self.ttl,))
+        conn.execute(
+            "DELETE FROM sessions WHERE fingerprint NOT IN "
+            "(SELECT fingerprint FROM sessions ORDER BY last_used DESC LIMIT ?)",
+            (self.max_entries,),
+        )
+
+    def resolve(self, fps: List[str], matched: int, sid: str) -> Tuple[str, int]:
+        """Extend an in-memory match of ``matched`` levels with longer prefixes known to the store.
+
+        Records the full-length prefix under the resulting session id, so sibling workers and the
+        next restart agree on it. Returns ``(session_id, matched_levels)``.
+        """
+        if self._failed:
+            return sid, matched
+        try:
+            conn = self._connect()
+            now = time.time()
+            longer = fps[matched:]
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                found: Dict[str, Tuple[str, float]] = {}
+                for i in range(0, len(longer), 500):
+                    chunk = longer[i : i + 500]
+                    rows = conn.execute(
+                        "SELECT fingerprint, session_id, last_used FROM sessions WHERE fingerprint IN (%s)"
+                        % ",".join("?" * len(chunk)),
+                        chunk,
+                    ).fetchall()
+                    for fp, row_sid, last_used in rows:
+                        found[fp] = (row_sid, last_used)
+                extended = False
+                for level in range(len(fps), matched, -1):
+                    row = found.get(fps[level - 1])
+                    if row is not None and not (self.ttl and now - row[1] > self.ttl):
+                        sid, matched, extended = row[0], level, True
+                        break
+                if matched:
+                    conn.execute("UPDATE sessions SET last_used = ? WHERE fingerprint = ?", (now, fps[matched - 1]))
+                if matched < len(fps):
+                    conn.execute(
+                        "INSERT OR REPLACE INTO sessions (fingerprint, session_id, last_used) VALUES (?, ?, ?)",
+                        (fps[-1], sid, now),
+                    )
+                conn.execute("COMMIT")
+            except BaseException:
+                if conn.in_transaction:
+                    conn.execute("ROLLBACK")
+                raise
+            with self._lock:
+                if extended:
+                    self.hits += 1
+                else:
+                    self.misses += 1
+                self._writes += 1
+                compact = self._writes % self._COMPACT_EVERY == 0
+            if compact:
+                self._compact(conn)
+            return sid, matched
+        except sqlite3.Error as exc:
+            busy = _is_busy(exc)
+            with self._lock:
+                self.errors += 1
+                if busy:
+                    # Sibling workers share the file; only this request goes without the store.
+                    self.busy += 1
+                    return sid, matched
+                if not self._failed:
+                    eprint(f"ERROR: session store {self.path} unavailable, persistence disabled until restart: {exc}")
+                self._failed = True
+            return sid, matched
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "path": self.path,
+                "available": not self._failed,
+                "hits": self.hits,
+                "misses": self.misses,
+                "errors": self.errors,
+                "busy": self.busy,
+            }
+
+
+class SessionMap:
+    """LRU map of prompt-prefix fingerprints to session ids, sharded by fingerprint prefix.
+
+    Each request is assigned the session whose remembered prefix shares the longest run of
+    leading input items with it, then its own full prefix is remembered for the next turn.
+    Lookups refresh recency, so sessions that keep being used stay resident. Entries idle for
+    longer than ``ttl`` seconds are treated as misses (``ttl <= 0`` disables expiry).
+    """
+
+    def __init__(
+        self,
+        max_entries: int = DEFAULT_MAX_ENTRIES,
+        ttl: float = DEFAULT_TTL_SECONDS,
+        shards: int = _SHARD_COUNT,
+        store: SessionStore | None = None,
+    ) -> None:
+        self.max_entries = max(1, int(max_entries))
+        self.ttl = max(0.0, float(ttl))
+        self.store = store
+        shards = max(1, min(int(shards), self.max_entries))
+        per_shard = -(-self.max_entries // shards)
+        self._shards = [_Shard(per_shard) for _ in range(shards)]
+        self._stats_lock = threading.Lock()
+        self._requests = 0
+        self._hits = 0
+        self._misses = 0
+        self._matched_items = 0
+        self._input_items = 0
+
+    def _shard(self, fp: str) -> _Shard:
+        return self._shards[int(fp[:8], 16) % len(self._shards)]
+
+    def _get(self, fp: str, now: float, touch: bool = True) -> str | None:
+        shard = self._shard(fp)
+        with shard.lock:
+            entry = shard.entries.get(fp)
+            if entry is None:
+                return None
+            if self.ttl and now - entry[1] > self.ttl:
+                del shard.entries[fp]
+                shard.expirations += 1
+                return None
+            if touch:
+                shard.entries[fp] = (entry[0], now)
+                shard.entries.move_to_end(fp)
+            return entry[0]
+
+    def _put(self, fp: str, sid: str, now: float) -> None:
+        shard = self._shard(fp)
+        with shard.lock:
+            shard.entries[fp] = (sid, now)
+            shard.entries.move_to_end(fp)
+            if len(shard.entries) > shard.max_entries:
+                shard.entries.popitem(last=False)
+                shard.evictions += 1
+
+    def peek(self, fps: List[str]) -> Tuple[str | None, int]:
+        """
+        Longest in-memory match for ``fps`` without remembering anything or counting it; the
+        entries it finds keep their idle time and LRU position.
+        """
+        now = time.monotonic()
+        for level in range(len(fps), 0, -1):
+            sid = self._get(fps[level - 1], now, touch=False)
+            if sid is not None:
+                return sid, level
+        return None, 0
+
+    def resolve(self, fps: List[str], factory: Callable[[], str]) -> Tuple[str, int]:
+        """Return ``(session_id, matched_levels)`` for a request with prefix fingerprints ``fps``."""
+        now = time.monotonic()
+        sid: str | None = None
+        matched = 0
+        for level in range(len(fps), 0, -1):
+            sid = self._get(fps[level - 1], now)
+            if sid is not None:
+                matched = level
+                break
+        if sid is None:
+            sid = factory()
+        if self.store is not None and matched < len(fps):
+            sid, matched = self.store.resolve(fps, matched, sid)
+        if matched < len(fps):
+            self._put(fps[-1], sid, now)
+        with self._stats_lock:
+            self._requests += 1
+            if matched:
+                self._hits += 1
+            else:
+                self._misses += 1
+            self._matched_items += matched
+            self._input_items += len(fps)
+        return sid, matched
+
+    def stats(self) -> Dict[str, Any]:
+        totals = {"entries": 0, "evictions": 0, "expirations": 0}
+        for shard in self._shards:
+            with shard.lock:
+                totals["entries"] += len(shard.entries)
+                totals["evictions"] += shard.evictions
+                totals["expirations"] += shard.expirations
+        with self._stats_lock:
+            totals.update(
+                requests=self._requests,
+                hits=self._hits,
+                misses=self._misses,
+                matched_prefix_items=self._matched_items,
+                input_items=self._input_items,
+            )
+        out = {"max_entries": self.max_entries, "ttl_seconds": self.ttl, "shards": len(self._shards), **totals}
+        out["store"] = self.store.stats() if self.store is not None else None
+        return out
+
+
+_SESSIONS = SessionMap()
+
+
+def configure_session_cache(
+    max_entries: int | None = None, ttl: float | None = None, persist: bool = False
+) -> SessionMap:
+    """Resize the process-wide session map; a changed configuration drops in-memory fingerprints.
+
+    With ``persist`` the map is backed by ``sessions.sqlite3`` in the ChatMock home directory.
+    """
+    global _SESSIONS
+    max_entries = max(1, int(DEFAULT_MAX_ENTRIES if max_entries is None else max_entries))
+    ttl = max(0.0, float(DEFAULT_TTL_SECONDS if ttl is None else ttl))
+    path = os.path.join(get_home_dir(), "sessions.sqlite3") if persist else None
+    current_path = _SESSIONS.store.path if _SESSIONS.store is not None else None
+    if _SESSIONS.max_entries != max_entries or _SESSIONS.ttl != ttl or current_path != path:
+        store = None
+        if path is not None:
+            try:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+            except OSError as exc:
+                eprint(f"ERROR: unable to create session store directory: {exc}")
+            store = SessionStore(path, max_entries=max_entries, ttl=ttl)
+        _SESSIONS = SessionMap(max_entries=max_entries, ttl=ttl, store=store)
+    return _SESSIONS
+
+
+def session_cache_stats() -> Dict[str, Any]:
+    return _SESSIONS.stats()
+
+
+def resolve_session(
     instructions: str | None,
     input_items: List[Dict[str, Any]],
     client_supplied: str | None = None,
-) -> str:
+) -> Tuple[str, int, int]:
+    """Return ``(session_id, matched_items, total_items)`` for a request's prompt prefix."""
     if isinstance(client_supplied, str) and client_supplied.strip():
-        return client_supplied.strip()
+        return client_supplied.strip(), 0, 0
+
+    fps = prefix_fingerprints(instructions, input_items)
+    sid, matched = _SESSIONS.resolve(fps, lambda: str(uuid.uuid4()))
+    return sid, matched, len(fps)
 
-    canon = canonicalize_prefix(instructions, input_items)
-    fp = _fingerprint(canon)
-    with _LOCK:
-        if fp in _FINGERPRINT_TO_UUID:
-            return _FINGERPRINT_TO_UUID[fp]
-        sid = str(uuid.uuid4())
-        _remember(fp, sid)
-        return sid
 
+def peek_session(
+    instructions: str | None, input_items: List[Dict[str, Any]]
+) -> Tuple[str | None, int, int]:
+    """Like resolve_session, but only looks: no new session is created or recorded."""
+    fps = prefix_fingerprints(instructions, input_items)
+    sid, matched = _SESSIONS.peek(fps)
+    return sid, matched, len(fps)
+
+
+def ensure_session_id(
+    instructions: str | None,
+    input_items: List[Dict[str, Any]],
+    client_supplied: str | None = None,
+) -> str:
+    return resolve_session(instructions, input_items, client_supplied)[0]
@@ -0,0 +1,142 @@
+from __future__ import annotations
+
+import re
+from typing import Any, Dict, Iterable, Iterator, List
+
+from . import fastjson
+
+_READ_SIZE = 16384
+
+_TYPE_PREFIX = re.compile(rb'\{\s*"type"\s*:\s*"([^"\\]*)"')
+# Upstream envelopes start {"type":...,"sequence_number":N,"response":{"id":"..." -- anchored at the
+# start of the payload, so a "response" key nested deeper (or inside a string) cannot match.
+_ENVELOPE_ID = re.compile(
+    rb'\{\s*"type"\s*:\s*"[^"\\]*"\s*,(?:\s*"sequence_number"\s*:\s*\d+\s*,)?'
+    rb'\s*"response"\s*:\s*\{\s*"id"\s*:\s*"([^"\\]*)"'
+)
+
+
+class SSEEvent:
+    """
+    One ``data:`` payload from the upstream stream, decoded lazily.
+
+    ``type`` and ``response_id`` are sniffed from the raw bytes, so a consumer can drop the
+    events it does not handle -- including the response.created / in_progress envelopes that
+    echo the whole request -- without parsing them. ``decode()`` parses once and caches.
+    """
+
+    __slots__ = ("data", "_type", "_json")
+
+    def __init__(self, data: bytes) -> None:
+        self.data = data
+        self._type: str | None = None
+        self._json: Any = None
+
+    @property
+    def done(self) -> bool:
+        return self.data == b"[DONE]"
+
+    @property
+    def type(self) -> str | None:
+        if self._type is None:
+            m = _TYPE_PREFIX.match(self.data)
+            if m is not None:
+                self._type = m.group(1).decode("utf-8", errors="replace")
+            else:
+                try:
+                    evt = self.json()
+                except ValueError:
+                    evt = None
+                kind = evt.get("type") if isinstance(evt, dict) else None
+                self._type = kind if isinstance(kind, str) else ""
+        return self._type or None
+
+    def json(self) -> Any:
+        """Full parse of the payload; raises ValueError if it is not JSON."""
+        if self._json is None:
+            self._json = fastjson.loads(self.data)
+        return self._json
+
+    def decode(self) -> Dict[str, Any]:
+        """The event as a dict; raises ValueError if the payload is not a JSON object."""
+        evt = self.json()
+        if not isinstance(evt, dict):
+            raise ValueError("event is not an object")
+        return evt
+
+    @property
+    def response_id(self) -> str | None:
+        """``response.id`` of an envelope event, read without parsing the (large) response object."""
+        if self._json is None:
+            if b'"response"' not in self.data:
+                return None
+            m = _ENVELOPE_ID.match(self.data)
+            if m is not None:
+                return m.group(1).decode("utf-8", errors="replace")
+        try:
+            response = self.decode().get("response")
+        except ValueError:
+            return None
+        rid = response.get("id") if isinstance(response, dict) else None
+        return rid if isinstance(rid, str) else None
+
+    def mentions(self, keys: Iterable[bytes]) -> bool:
+        """Whether any of ``keys`` occurs as a quoted name in the raw payload; a cheap pre-filter."""
+        data = self.data
+        return any(key in data for key in keys)
+
+    def line(self) -> str:
+        return "data: " + self.data.decode("utf-8", errors="replace")
+
+
+class SSEParser:
+    """Incremental SSE parser fed raw body bytes (``bytes``/``bytearray``/``memoryview``)."""
+
+    def __init__(self) -> None:
+        self._buf = bytearray()
+        self._data: List[bytes] = []
+
+    def _lines(self, lines: List[bytes], out: List[SSEEvent]) -> None:
+        data = self._data
+        for line in lines:
+            if line.startswith(b"data:"):
+                data.append((line[6:] if line.startswith(b"data: ") else line[5:]).strip())
+            elif (not line or line == b"\r") and data:
+                out.append(SSEEvent(data[0] if len(data) == 1 else b"\n".join(data)))
+                data = self._data = []
+
+    def feed(self, chunk: bytes | bytearray | memoryview) -> List[SSEEvent]:
+        out: List[SSEEvent] = []
+        buf = self._buf
+        scan_from = len(buf)
+        buf += chunk
+        if buf.find(b"\n", scan_from) < 0:
+            return out
+        lines = bytes(buf).split(b"\n")
+        self._buf = bytearray(lines.pop())
+        self._lines(lines, out)
+        return out
+
+    def close(self) -> List[SSEEvent]:
+        """Events still pending at end of stream (a final event without its blank line)."""
+        out: List[SSEEvent] = []
+        if self._buf:
+            self._lines([bytes(self._buf)], out)
+            self._buf = bytearray()
+        if self._data:
+            out.append(SSEEvent(b"\n".join(self._data)))
+            self._data = []
+        return out
+
+
+def iter_chunk_events(chunks: Iterable[bytes]) -> Iterator[SSEEvent]:
+    parser = SSEParser()
+    for chunk in chunks:
+        if chunk:
+            yield from parser.feed(chunk)
+    yield from parser.close()
+
+
+def iter_sse_events(upstream: Any) -> Iterator[SSEEvent]:
+    """Events of a streaming upstream response, read as raw bytes rather than decoded lines."""
+    yield from iter_chunk_events(upstream.iter_content(chunk_size=_READ_SIZE, decode_unicode=False))
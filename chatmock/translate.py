@@ -0,0 +1,917 @@
+from __future__ import annotations
+
+import queue
+import threading
+import time
+from typing import Any, Callable, Dict, Iterable, Iterator, List
+
+import requests
+
+from .buffers import ByteQueue, stream_buffers
+from .config import env_float, env_int
+from .http import client_socket
+from .payload import resume_body
+from .pump import ClientDisconnected, peer_closed, pump_response
+from .sse import SSEEvent, SSEParser, iter_sse_events
+from .transport import upstream_post
+from .usage import extract_usage, record_usage
+
+KEEPALIVE_INTERVAL_SECONDS = 15.0
+MAX_RESUME_ATTEMPTS = 2
+# How often a stream the pump cannot watch checks whether its client hung up while idle.
+CLIENT_POLL_INTERVAL_SECONDS = 0.1
+
+TEXT_DELTA = "response.output_text.delta"
+SUMMARY_DELTA = "response.reasoning_summary_text.delta"
+REASONING_DELTA = "response.reasoning_text.delta"
+SUMMARY_PART_ADDED = "response.reasoning_summary_part.added"
+ITEM_ADDED = "response.output_item.added"
+ITEM_DONE = "response.output_item.done"
+ARGUMENTS_DELTA = "response.function_call_arguments.delta"
+REASONING_EVENTS = frozenset({SUMMARY_DELTA, REASONING_DELTA})
+TERMINAL_EVENTS = frozenset({"response.completed", "response.incomplete", "response.failed"})
+# Events that may join a coalesced run; any other handled event flushes it first.
+_COALESCED_EVENTS = frozenset({TEXT_DELTA, SUMMARY_DELTA, REASONING_DELTA, SUMMARY_PART_ADDED})
+
+# Coalescing is off unless a window is set; the byte cap applies once it is on.
+DEFAULT_STREAM_COALESCE_MS = env_float("CHATGPT_LOCAL_STREAM_COALESCE_MS", 0.0)
+DEFAULT_STREAM_COALESCE_BYTES = env_int("CHATGPT_LOCAL_STREAM_COALESCE_BYTES", 4096)
+DEFAULT_MAX_RESPONSE_BYTES = env_int("CHATGPT_LOCAL_MAX_RESPONSE_BYTES", 0)
+
+_coalesce_window = 0.0
+_coalesce_max_bytes = 0
+_max_response_bytes = 0
+
+
+class TextBuffer:
+    """
+    Text assembled from many small deltas.
+
+    Parts are kept in a list and joined once when the value is read, so collecting a long
+    answer stays linear; ``size`` is the running UTF-8 byte count. With a ``limit`` only the
+    last ``limit`` bytes are kept (trimmed once twice that has accumulated).
+    """
+
+    __slots__ = ("_parts", "size", "limit")
+
+    def __init__(self, limit: int = 0) -> None:
+        self._parts: List[str] = []
+        self.size = 0
+        self.limit = limit
+
+    def append(self, text: str) -> int:
+        """Add ``text``; returns its size in bytes."""
+        if not text:
+            return 0
+        self._parts.append(text)
+        n = len(text) if text.isascii() else len(text.encode("utf-8", errors="surrogatepass"))
+        self.size += n
+        if self.limit and self.size > 2 * self.limit:
+            self._keep_tail()
+        return n
+
+    def _keep_tail(self) -> None:
+        text = "".join(self._parts)
+        if text.isascii():
+            text = text[-self.limit :]
+            self.size = len(text)
+        else:
+            # A character cut in half at the start is dropped.
+            text = text.encode("utf-8", errors="surrogatepass")[-self.limit :].decode("utf-8", errors="ignore")
+            self.size = len(text.encode("utf-8", errors="surrogatepass"))
+        self._parts[:] = [text] if text else []
+
+    def getvalue(self) -> str:
+        if self.limit and self.size > self.limit:
+            self._keep_tail()
+        parts = self._parts
+        if len(parts) > 1:
+            parts[:] = ["".join(parts)]
+        return parts[0] if parts else ""
+
+    def __bool__(self) -> bool:
+        return bool(self._parts)
+
+
+class ResponseTooLarge(Exception):
+    """An aggregated response grew past the configured byte limit."""
+
+
+_RESUME_STATE_KEYS = (
+    b'"delta_range"',
+    b'"range_end_token"',
+    b'"range_start_token"',
+    b'"next_range_start_token"',
+    b'"cursor"',
+    b'"range"',
+)
+
+
+def function_call(item: Any) -> Dict[str, Any] | None:
+    """A finished ``function_call`` output item as an OpenAI ``tool_calls`` entry."""
+    if not (isinstance(item, dict) and item.get("type") == "function_call"):
+        return None
+    call_id = item.get("call_id") or item.get("id") or ""
+    name = item.get("name") or ""
+    args = item.get("arguments") or ""
+    if not (isinstance(call_id, str) and isinstance(name, str) and isinstance(args, str)):
+        return None
+    return {"id": call_id, "type": "function", "function": {"name": name, "arguments": args}}
+
+
+class ToolCall:
+    """A function call announced by ``output_item.added`` whose arguments are still streaming."""
+
+    __slots__ = ("call_id", "name", "arguments")
+
+    def __init__(self, call_id: str, name: str) -> None:
+        self.call_id = call_id
+        self.name = name
+        self.arguments = TextBuffer()
+
+    def remaining(self, final: Any) -> str | None:
+        """
+        What ``final`` (the complete arguments) adds to the fragments already sent: "" when they
+        cover it, None when they do not lead up to it (the final string is then authoritative).
+        """
+        if not isinstance(final, str):
+            return None
+        sent = self.arguments.getvalue()
+        return final[len(sent):] if final.startswith(sent) else None
+
+
+class StreamState:
+    """Everything the engine tracks for one upstream response, shared with the encoder."""
+
+    __slots__ = (
+        "response_id",
+        "usage",
+        "error",
+        "think_open",
+        "think_closed",
+        "saw_any_summary",
+        "pending_summary_paragraph",
+        "reasoning_cache",
+        "resume_token",
+        "tool_calls",
+    )
+
+    def __init__(self, response_id: str, reasoning_tail: int = 0) -> None:
+        self.response_id = response_id
+        self.usage: Dict[str, Any] | None = None
+        self.error: str | None = None
+        self.think_open = False
+        self.think_closed = False
+        self.saw_any_summary = False
+        self.pending_summary_paragraph = False
+        # All reasoning text so far, or only its last ``reasoning_tail`` bytes.
+        self.reasoning_cache = TextBuffer(reasoning_tail)
+        self.resume_token: str | None = None
+        # Streaming function calls by upstream item id.
+        self.tool_calls: Dict[str, ToolCall] = {}
+
+
+class Encoder:
+    """
+    Renders engine callbacks in one client wire format.
+
+    Each hook returns an iterable of frames (``bytes`` or ``str``, whatever the response body
+    uses); the defaults emit nothing. ``events`` lists the upstream event types the encoder
+    needs besides the terminal ones -- everything else is skipped without being parsed.
+    ``compat`` selects how reasoning is presented: "think-tags" turns it into ``content`` wrapped
+    in <think>...</think>, "o3" adds paragraph breaks between summary parts, anything else hands
+    each delta to ``reasoning`` unchanged.
+    """
+
+    name = "encoder"
+    events: frozenset = frozenset()
+    compat = "legacy"
+    default_response_id = "resp"
+    # Frame written while the upstream is idle, or None when the format has no such thing.
+    keepalive: Any = None
+    # Whether consecutive deltas may be merged into one frame (see configure_coalescing).
+    coalesce = True
+    # Whether the whole reasoning text is kept in state.reasoning_cache instead of its tail.
+    keep_reasoning = False
+
+    def wants(self, kind: str) -> bool:
+        """Extra event types beyond ``events``; routed to ``event()``."""
+        return False
+
+    def content(self, state: StreamState, text: str) -> Iterable[Any]:
+        return ()
+
+    def reasoning(self, state: StreamState, text: str, summary: bool) -> Iterable[Any]:
+        return ()
+
+    def item_done(self, state: StreamState, item: Any) -> Iterable[Any]:
+        """A finished output item; for a streamed call, ``state.tool_calls`` has what was sent."""
+        return ()
+
+    def tool_call_start(self, state: StreamState, call: ToolCall) -> Iterable[Any]:
+        """A function call began (needs ``response.output_item.added`` in ``events``)."""
+        return ()
+
+    def tool_call_arguments(self, state: StreamState, call: ToolCall, delta: str) -> Iterable[Any]:
+        """
+        A fragment of a call's arguments JSON, already appended to ``call.arguments`` (needs
+        ``response.function_call_arguments.delta`` in ``events``).
+        """
+        return ()
+
+    def event(self, state: StreamState, kind: str, evt: Dict[str, Any]) -> Iterable[Any]:
+        return ()
+
+    def completed(self, state: StreamState) -> Iterable[Any]:
+        return ()
+
+    def failed(self, state: StreamState, message: str) -> Iterable[Any]:
+        return ()
+
+    def upstream_done(self, state: StreamState) -> Iterable[Any]:
+        """The upstream sent ``data: [DONE]`` before a terminal event."""
+        return ()
+
+    def interrupted(self, state: StreamState, message: str) -> Iterable[Any]:
+        """The upstream connection broke and could not be resumed."""
+        return ()
+
+    def finish(self, state: StreamState) -> Iterable[Any]:
+        """Called once after the last upstream event, however the stream ended."""
+        return ()
+
+    def close_think(self, state: StreamState) -> Iterable[Any]:
+        if state.think_open and not state.think_closed:
+            state.think_open = False
+            state.think_closed = True
+            return self.content(state, "</think>")
+        return ()
+
+
+class _Stats:
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._values: Dict[str, Dict[str, int]] = {}
+
+    def add(self, name: str, counts: Dict[str, int]) -> None:
+        with self._lock:
+            bucket = self._values.setdefault(name, {})
+            for key, value in counts.items():
+                if value:
+                    bucket[key] = bucket.get(key, 0) + value
+
+    def snapshot(self) -> Dict[str, Dict[str, int]]:
+        with self._lock:
+            out = {name: dict(values) for name, values in self._values.items()}
+        for values in out.values():
+            cancelled, completed = values.get("cancelled", 0), values.get("completed", 0)
+            if cancelled and completed:
+                # A cancelled stream would have run to about the average completed length.
+                average = values.get("output_tokens", 0) / completed
+                saved = cancelled * average - values.get("cancelled_deltas", 0)
+                values["tokens_saved_estimate"] = max(int(saved), 0)
+        return out
+
+
+_STATS = _Stats()
+
+
+def translation_stats() -> Dict[str, Dict[str, int]]:
+    return _STATS.snapshot()
+
+
+def configure_response_limit(max_bytes: int = 0) -> None:
+    """Cap the text a non-streaming request may collect (answer plus reasoning); 0 means no cap."""
+    global _max_response_bytes
+    _max_response_bytes = max(int(max_bytes or 0), 0)
+
+
+def configure_coalescing(window_ms: float = 0.0, max_bytes: int = 0) -> None:
+    """
+    Merge consecutive text/reasoning deltas of a stream into one frame.
+
+    A run is written once ``window_ms`` has passed since its first delta or once it holds
+    ``max_bytes`` of UTF-8 text (0: no byte cap), and always before any other frame -- tool
+    calls, finish, errors -- so only deltas are ever delayed. ``window_ms`` 0 turns it off.
+    """
+    global _coalesce_window, _coalesce_max_bytes
+    _coalesce_window = max(float(window_ms or 0), 0.0) / 1000.0
+    _coalesce_max_bytes = max(int(max_bytes or 0), 0)
+
+
+def _update_resume_token(state: StreamState, evt: Dict[str, Any]) -> None:
+    resp = evt.get("response")
+    candidates: List[str] = []
+    if isinstance(resp, dict):
+        for key in (
+            "range_end_token",
+            "range_start_token",
+            "next_range_start_token",
+            "cursor",
+        ):
+            value = resp.get(key)
+            if isinstance(value, str):
+                candidates.append(value)
+        range_info = resp.get("range")
+        if isinstance(range_info, dict):
+            for key in ("end_token", "next_start_token", "end", "next_start"):
+                value = range_info.get(key)
+                if isinstance(value, str):
+                    candidates.append(value)
+    delta_range = evt.get("delta_range")
+    if isinstance(delta_range, dict):
+        for key in ("end", "token_end"):
+            value = delta_range.get(key)
+            if isinstance(value, str):
+                candidates.append(value)
+    for candidate in candidates:
+        if candidate:
+            state.resume_token = candidate
+            break
+
+
+class Translation:
+    """One pass over an upstream Responses stream, driving a single encoder."""
+
+    def __init__(
+        self,
+        upstream: Any,
+        encoder: Encoder,
+        *,
+        verbose: bool = False,
+        vlog: Callable[[str], Any] | None = None,
+    ) -> None:
+        self.upstream = upstream
+        self.encoder = encoder
+        tail = 0 if encoder.keep_reasoning else stream_buffers().reasoning_tail_bytes
+        self.state = StreamState(encoder.default_response_id, tail)
+        self.request_ctx: Dict[str, Any] | None = getattr(upstream, "_chatmock_request_ctx", None)
+        self.vlog = vlog if verbose else None
+        self.compat = (encoder.compat or "think-tags").strip().lower()
+        wanted = set(encoder.events) | TERMINAL_EVENTS
+        if wanted & REASONING_EVENTS and self.compat in ("think-tags", "o3"):
+            wanted.add(SUMMARY_PART_ADDED)
+        self._wanted = frozenset(wanted)
+        self._finished = False
+        self._window = _coalesce_window if encoder.coalesce else 0.0
+        self._max_bytes = _coalesce_max_bytes
+        # The pending run: None for content, else the ``summary`` flag of reasoning deltas.
+        self._pending: List[str] = []
+        self._pending_kind: bool | None = None
+        self._pending_size = 0
+        self._deadline = 0.0
+        self._client = client_socket()
+        self._cancelled = False
+        self._counts = {
+            "streams": 1,
+            "completed": 0,
+            "failed": 0,
+            "interrupted": 0,
+            "resumed": 0,
+            "events": 0,
+            "events_skipped": 0,
+            "keepalives": 0,
+            "frames_in": 0,
+            "frames_out": 0,
+            "output_tokens": 0,
+            "cancelled": 0,
+            "cancelled_deltas": 0,
+        }
+
+    # -- upstream reading -----------------------------------------------------------------
+
+    def _idle_timeout(self) -> float:
+        if self._pending:
+            return max(self._deadline - time.monotonic(), 0.0)
+        return KEEPALIVE_INTERVAL_SECONDS
+
+    def _poll_timeout(self) -> float:
+        return min(self._idle_timeout(), CLIENT_POLL_INTERVAL_SECONDS)
+
+    def _events(self, resp: Any) -> Iterator[tuple[str, Any]]:
+        """
+        Yield ("event", SSEEvent), ("idle", None), ("error", exc) and finally ("done", None), or
+        ("cancelled", None) once the client has hung up.
+        """
+        pumped = pump_response(resp)
+        if pumped is not None:
+            parser = SSEParser()
+            pumped.watch_client(self._client)
+            try:
+                for chunk in pumped.iter_chunks(self._idle_timeout):
+                    if chunk is None:
+                        yield ("idle", None)
+                        continue
+                    for event in parser.feed(chunk):
+                        yield ("event", event)
+                for event in parser.close():
+                    yield ("event", event)
+            except ClientDisconnected:
+                yield ("cancelled", None)
+                return
+            except Exception as exc:
+                yield ("error", exc)
+            finally:
+                pumped.close(drain=not self._cancelled)
+            yield ("done", None)
+            return
+
+        client = self._client
+        if client is None and self.encoder.keepalive is None and not self._window:
+            try:
+                for event in iter_sse_events(resp):
+                    yield ("event", event)
+            except Exception as exc:
+                yield ("error", exc)
+            yield ("done", None)
+            return
+
+        # Bodies the pump cannot watch (e.g. HTTP/2) are read on a helper thread so the
+        # response can still be kept alive, a coalesced run flushed, or the client checked for a
+        # hang-up while the upstream is idle.
+        timeout = self._idle_timeout if client is None else self._poll_timeout
+        # The queue is bounded by the stream buffers, so a slow client stops the reads upstream.
+        q = ByteQueue()
+
+        def _worker():
+            try:
+                for event in iter_sse_events(resp):
+                    if not q.put(("event", event), len(event.data)):
+                        break
+            except Exception as exc:
+                q.put(("error", exc))
+            finally:
+                q.put(("done", None))
+
+        thread = threading.Thread(target=_worker, daemon=True)
+        thread.start()
+        try:
+            while True:
+                try:
+                    msg = q.get(timeout=timeout())
+                except queue.Empty:
+                    if client is not None and peer_closed(client):
+                        yield ("cancelled", None)
+                        return
+                    yield ("idle", None)
+                    continue
+                yield msg
+                if msg[0] == "done":
+                    return
+        finally:
+            q.close()
+            if self._cancelled:
+                # Unblocks the worker's read, which would otherwise wait for the next event.
+                self._abort_upstream(resp)
+            thread.join(timeout=0.5)
+
+    def _cancel(self) -> None:
+        """The client is gone: count what it left behind and stop reading upstream at once."""
+        if self._cancelled:
+            return
+        self._cancelled = True
+        self._counts["cancelled"] += 1
+        self._counts["cancelled_deltas"] += self._counts["frames_in"]
+
+    @staticmethod
+    def _abort_upstream(resp: Any) -> None:
+        abort = getattr(resp, "abort", None) or resp.close
+        try:
+            abort()
+        except Exception:
+            pass
+
+    def _attempt_resume(self, attempt: int) -> bool:
+        request_ctx = self.request_ctx
+        vlog = self.vlog
+        if not request_ctx:
+            return False
+        resume_token = self.state.resume_token
+        body = request_ctx.get("body")
+        if body is None:
+            return False
+        headers = dict(request_ctx.get("headers") or {})
+        url = request_ctx.get("url") or getattr(getattr(self.upstream, "request", None), "url", None)
+        timeout = request_ctx.get("timeout", 600)
+        if not url:
+            return False
+        try:
+            new_resp = upstream_post(
+                url,
+                headers=headers,
+                data=resume_body(body, resume_token),
+                stream=True,
+                timeout=timeout,
+            )
+        except requests.RequestException as err:
+            if vlog:
+                vlog(f"Resume attempt #{attempt} failed: {err}")
+            return False
+        if new_resp.status_code >= 400:
+            if vlog:
+                vlog(f"Resume attempt #{attempt} failed with status {new_resp.status_code}")
+            return False
+        setattr(new_resp, "_chatmock_request_ctx", request_ctx)
+        try:
+            self.upstream.close()
+        except Exception:
+            pass
+        self.upstream = new_resp
+        self._counts["resumed"] += 1
+        if vlog:
+            token_preview = resume_token[:8] + "…" if isinstance(resume_token, str) and len(resume_token) > 8 else resume_token
+            vlog(f"Reconnected upstream stream (range_start_token={token_preview!r})")
+        return True
+
+    # -- event dispatch -------------------------------------------------------------------
+
+    def _handle(self, event: SSEEvent) -> Iterable[Any]:
+        state = self.state
+        encoder = self.encoder
+        response_id = event.response_id
+        if response_id:
+            state.response_id = response_id
+        kind = event.type
+        track_resume = event.mentions(_RESUME_STATE_KEYS)
+        if kind not in self._wanted and not (kind and encoder.wants(kind)):
+            self._counts["events_skipped"] += 1
+            if track_resume:
+                try:
+                    _update_resume_token(state, event.decode())
+                except ValueError:
+                    pass
+            return ()
+        try:
+            evt = event.decode()
+        except ValueError:
+            return ()
+        if track_resume:
+            _update_resume_token(state, evt)
+        if self._pending and kind not in _COALESCED_EVENTS:
+            return [*self._flush(), *self._dispatch(kind, evt)]
+        return self._dispatch(kind, evt)
+
+    def _dispatch(self, kind: str, evt: Dict[str, Any]) -> Iterable[Any]:
+        state = self.state
+        encoder = self.encoder
+        if kind == TEXT_DELTA:
+            delta = evt.get("delta") or ""
+            if self.compat == "think-tags" and state.think_open and not state.think_closed:
+                return [*self._flush(), *encoder.close_think(state), *self._delta(None, delta)]
+            return self._delta(None, delta)
+        if kind in REASONING_EVENTS:
+            return self._reasoning(kind, evt.get("delta") or "")
+        if kind == SUMMARY_PART_ADDED:
+            if self.compat in ("think-tags", "o3"):
+                if state.saw_any_summary:
+                    state.pending_summary_paragraph = True
+                else:
+                    state.saw_any_summary = True
+            return ()
+        if kind == ARGUMENTS_DELTA:
+            call = state.tool_calls.get(evt.get("item_id"))
+            delta = evt.get("delta")
+            if call is None or not isinstance(delta, str) or not delta:
+                return ()
+            call.arguments.append(delta)
+            return encoder.tool_call_arguments(state, call, delta)
+        if kind == ITEM_ADDED:
+            item = evt.get("item")
+            if not (isinstance(item, dict) and item.get("type") == "function_call"):
+                return ()
+            item_id, call_id, name = item.get("id"), item.get("call_id") or item.get("id"), item.get("name")
+            if not (isinstance(item_id, str) and isinstance(call_id, str) and isinstance(name, str) and name):
+                return ()
+            call = state.tool_calls[item_id] = ToolCall(call_id, name)
+            return encoder.tool_call_start(state, call)
+        if kind == ITEM_DONE:
+            return encoder.item_done(state, evt.get("item") or {})
+        if kind in TERMINAL_EVENTS:
+            self._finished = True
+            usage = extract_usage(evt)
+            if usage:
+                state.usage = usage
+                self._counts["output_tokens"] += usage["completion_tokens"]
+                record_usage(self.request_ctx, evt)
+            if kind == "response.failed":
+                self._counts["failed"] += 1
+                message = evt.get("response", {}).get("error", {}).get("message", "response.failed")
+                state.error = message
+                return encoder.failed(state, message)
+            self._counts["completed"] += 1
+            if self.compat == "think-tags":
+                return [*encoder.close_think(state), *encoder.completed(state)]
+            return encoder.completed(state)
+        return encoder.event(state, kind, evt)
+
+    def _reasoning(self, kind: str, delta: str) -> List[Any]:
+        state = self.state
+        summary = kind == SUMMARY_DELTA
+        if delta:
+            state.reasoning_cache.append(delta)
+        out: List[Any] = []
+        if self.compat == "think-tags":
+            if not state.think_open and not state.think_closed:
+                out.extend(self._delta(None, "<think>"))
+                state.think_open = True
+            if state.think_open and not state.think_closed:
+                if summary and state.pending_summary_paragraph:
+                    out.extend(self._delta(None, "\n"))
+                    state.pending_summary_paragraph = False
+                out.extend(self._delta(None, delta))
+            return out
+        if self.compat == "o3" and summary and state.pending_summary_paragraph:
+            out.extend(self._delta(True, "\n"))
+            state.pending_summary_paragraph = False
+        out.extend(self._delta(summary, delta))
+        return out
+
+    # -- coalescing -----------------------------------------------------------------------
+
+    def _render(self, kind: bool | None, text: str) -> Iterable[Any]:
+        self._counts["frames_out"] += 1
+        if kind is None:
+            return self.encoder.content(self.state, text)
+        return self.encoder.reasoning(self.state, text, kind)
+
+    def _delta(self, kind: bool | None, text: str) -> Iterable[Any]:
+        """A content (``kind`` None) or reasoning delta; joins the pending run when coalescing."""
+        self._counts["frames_in"] += 1
+        if not self._window:
+            return self._render(kind, text)
+        out: List[Any] = []
+        if self._pending and kind != self._pending_kind:
+            out.extend(self._flush())
+        if not self._pending:
+            self._pending_kind = kind
+            self._pending_size = 0
+            self._deadline = time.monotonic() + self._window
+        self._pending.append(text)
+        self._pending_size += len(text.encode("utf-8"))
+        if self._max_bytes and self._pending_size >= self._max_bytes:
+            out.extend(self._flush())
+        return out
+
+    def _flush(self) -> Iterable[Any]:
+        if not self._pending:
+            return ()
+        text = "".join(self._pending)
+        self._pending = []
+        return self._render(self._pending_kind, text)
+
+    # -- driver ---------------------------------------------------------------------------
+
+    def __iter__(self) -> Iterator[Any]:
+        encoder = self.encoder
+        keepalive = encoder.keepalive
+        vlog = self.vlog
+        counts = self._counts
+        resume_attempts = 0
+        events = None
+        try:
+            while True:
+                events = self._events(self.upstream)
+                connection_error: Exception | None = None
+                upstream_done = False
+                for msg_type, payload in events:
+                    if msg_type == "event":
+                        if vlog:
+                            vlog(payload.line())
+                        if not payload.data:
+                            continue
+                        if payload.done:
+                            upstream_done = True
+                            break
+                        counts["events"] += 1
+                        yield from self._handle(payload)
+                        if self._pending and time.monotonic() >= self._deadline:
+                            yield from self._flush()
+                        if self._finished:
+                            break
+                    elif msg_type == "idle":
+                        if self._pending:
+                            yield from self._flush()
+                        elif keepalive is not None:
+                            counts["keepalives"] += 1
+                            yield keepalive
+                    elif msg_type == "cancelled":
+                        self._cancel()
+                        break
+                    elif msg_type == "error":
+                        connection_error = payload if isinstance(payload, Exception) else RuntimeError("Upstream stream error")
+                        break
+                    elif msg_type == "done":
+                        connection_error = ConnectionError("Upstream stream closed before [DONE]")
+                        break
+                events.close()
+                if self._cancelled:
+                    if vlog:
+                        vlog("Client disconnected; cancelled the upstream stream")
+                    return
+                if upstream_done:
+                    yield from self._flush()
+                    yield from encoder.upstream_done(self.state)
+                    break
+                if connection_error is None:
+                    break
+                if vlog:
+                    vlog(f"Stream interrupted: {connection_error}")
+                if resume_attempts < MAX_RESUME_ATTEMPTS:
+                    resume_attempts += 1
+                    if self._attempt_resume(resume_attempts):
+                        continue
+                counts["interrupted"] += 1
+                message = "Reasoning stream interrupted, please retry."
+                if str(connection_error):
+                    message = f"{message} ({connection_error})"
+                self.state.error = message
+                yield from self._flush()
+                yield from encoder.interrupted(self.state, message)
+                break
+            yield from self._flush()
+            yield from encoder.finish(self.state)
+        except GeneratorExit:
+            # The server closes the generator when writing to the client failed.
+            if not self._finished:
+                self._cancel()
+            raise
+        finally:
+            if events is not None:
+                events.close()
+            if self._cancelled:
+                self._abort_upstream(self.upstream)
+            else:
+                try:
+                    self.upstream.close()
+                except Exception:
+                    pass
+            _STATS.add(encoder.name, counts)
+
+
+def translate(
+    upstream: Any,
+    encoder: Encoder,
+    *,
+    verbose: bool = False,
+    vlog: Callable[[str], Any] | None = None,
+) -> Iterator[Any]:
+    """Frames of ``encoder``'s wire format for the upstream Responses stream ``upstream``."""
+    return iter(Translation(upstream, encoder, verbose=verbose, vlog=vlog))
+
+
+# Relayed bodies are read in blocks of up to this size when the pump cannot take them over.
+_RELAY_READ_SIZE = 65536
+
+
+def _event_boundary(data: bytes) -> int:
+    """Offset just past the last complete SSE event in ``data`` (0 if there is none)."""
+    lf = data.rfind(b"\n\n")
+    crlf = data.rfind(b"\n\r\n")
+    return max(lf + 2 if lf >= 0 else 0, crlf + 3 if crlf >= 0 else 0)
+
+
+def _read_blocks(upstream: Any) -> Iterator[bytes]:
+    raw = getattr(upstream, "raw", None)
+    read1 = getattr(raw, "read1", None)
+    if read1 is None:
+        # HTTP/2 responses already yield whatever has arrived.
+        yield from upstream.iter_content(_RELAY_READ_SIZE)
+        return
+    while True:
+        block = read1(_RELAY_READ_SIZE, decode_content=True)
+        if not block:
+            return
+        yield block
+
+
+def relay(upstream: Any, name: str = "responses.passthrough") -> Iterator[bytes]:
+    """
+    The upstream SSE body unchanged, for routes that pass it straight through.
+
+    Whatever has arrived is written in one block, cut at the last complete event so a client
+    never receives half an event. Like a translated stream, the client socket is watched and the
+    upstream closed as soon as the client goes away.
+    """
+    client = client_socket()
+    pumped = pump_response(upstream)
+    if pumped is not None:
+        pumped.watch_client(client)
+    return _relay(upstream, pumped, name)
+
+
+def _relay(upstream: Any, pumped: Any, name: str) -> Iterator[bytes]:
+    counts = {"streams": 1, "completed": 0, "cancelled": 0, "bytes": 0, "frames_in": 0, "frames_out": 0}
+    cancelled = False
+    pending = b""
+    try:
+        if pumped is not None:
+            blocks: Iterable[bytes | None] = pumped.iter_chunks(KEEPALIVE_INTERVAL_SECONDS)
+        else:
+            blocks = _read_blocks(upstream)
+        for block in blocks:
+            if not block:
+                continue
+            counts["frames_in"] += 1
+            data = pending + block if pending else block
+            cut = _event_boundary(data)
+            if not cut:
+                pending = data
+                continue
+            if cut == len(data):
+                pending = b""
+            else:
+                data, pending = data[:cut], data[cut:]
+            counts["frames_out"] += 1
+            counts["bytes"] += len(data)
+            yield data
+        if pending:
+            counts["frames_out"] += 1
+            counts["bytes"] += len(pending)
+            yield pending
+        counts["completed"] += 1
+    except ClientDisconnected:
+        cancelled = True
+    except GeneratorExit:
+        cancelled = True
+        raise
+    finally:
+        counts["cancelled"] += int(cancelled)
+        if pumped is not None:
+            pumped.close(drain=not cancelled)
+        if cancelled:
+            Translation._abort_upstream(upstream)
+        else:
+            try:
+                upstream.close()
+            except Exception:
+                pass
+        _STATS.add(name, counts)
+
+
+class AggregateEncoder(Encoder):
+    """Collects a whole response for the non-streaming endpoints."""
+
+    events = frozenset({TEXT_DELTA, SUMMARY_DELTA, REASONING_DELTA, ITEM_DONE})
+    coalesce = False
+    keep_reasoning = True
+
+    def __init__(self, name: str, default_response_id: str, max_bytes: int = 0) -> None:
+        self.name = name
+        self.default_response_id = default_response_id
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.text = TextBuffer()
+        self.summary = TextBuffer()
+        self.reasoning_full = TextBuffer()
+        self.items: List[Dict[str, Any]] = []
+
+    def _collect(self, buf: TextBuffer, text: str) -> None:
+        self.size += buf.append(text)
+        if self.max_bytes and self.size > self.max_bytes:
+            raise ResponseTooLarge(f"Response exceeded the {self.max_bytes}-byte limit")
+
+    def content(self, state: StreamState, text: str) -> Iterable[Any]:
+        self._collect(self.text, text)
+        return ()
+
+    def reasoning(self, state: StreamState, text: str, summary: bool) -> Iterable[Any]:
+        self._collect(self.summary if summary else self.reasoning_full, text)
+        return ()
+
+    def item_done(self, state: StreamState, item: Any) -> Iterable[Any]:
+        if isinstance(item, dict):
+            self.items.append(item)
+        return ()
+
+
+class Aggregate:
+    """The collected result of a non-streaming request."""
+
+    def __init__(self, encoder: AggregateEncoder, state: StreamState, too_large: bool = False) -> None:
+        self.text = encoder.text.getvalue()
+        self.reasoning_summary = encoder.summary.getvalue()
+        self.reasoning_full = encoder.reasoning_full.getvalue()
+        # Both kinds of reasoning, in the order they arrived.
+        self.reasoning = state.reasoning_cache.getvalue()
+        self.items = encoder.items
+        self.response_id = state.response_id
+        self.usage = state.usage
+        self.error = state.error
+        self.size = encoder.size
+        self.too_large = too_large
+
+    def function_calls(self) -> List[Dict[str, Any]]:
+        return [call for call in map(function_call, self.items) if call is not None]
+
+
+def aggregate(upstream: Any, name: str, default_response_id: str) -> Aggregate:
+    """Read a whole upstream response and return what the non-streaming endpoints need."""
+    encoder = AggregateEncoder(name, default_response_id, _max_response_bytes)
+    translation = Translation(upstream, encoder)
+    try:
+        for _ in translation:
+            pass
+    except ResponseTooLarge as exc:
+        translation.state.error = str(exc)
+        return Aggregate(encoder, translation.state, too_large=True)
+    return Aggregate(encoder, translation.state)
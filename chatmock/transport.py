@@ -0,0 +1,674 @@
+from __future__ import annotations
+
+import json
+import socket
+import ssl
+import sys
+import threading
+import time
+from http.client import RemoteDisconnected
+from http.cookiejar import DefaultCookiePolicy
+from typing import Any, Dict, List, Tuple
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.exceptions import MaxRetryError, NewConnectionError, ProtocolError
+from urllib3.util import connection as urllib3_connection
+from urllib3.util.wait import wait_for_read
+
+from .config import env_flag, env_float, env_int
+
+
+# Flask's threaded server spawns one thread per in-flight request, so the pool is sized
+# for the number of concurrent upstream streams we expect rather than a fixed worker count.
+DEFAULT_POOL_SIZE = env_int("CHATGPT_LOCAL_UPSTREAM_POOL_SIZE", 64)
+DEFAULT_UPSTREAM_HTTP2 = env_flag("CHATGPT_LOCAL_UPSTREAM_HTTP2")
+DEFAULT_DNS_TTL = env_float("CHATGPT_LOCAL_UPSTREAM_DNS_TTL", 300.0)
+DEFAULT_PREWARM_CONNECTIONS = env_int("CHATGPT_LOCAL_UPSTREAM_PREWARM", 2)
+DEFAULT_PREWARM_INTERVAL = env_float("CHATGPT_LOCAL_UPSTREAM_PREWARM_INTERVAL", 60.0)
+_PREWARM_CONNECT_TIMEOUT = 10.0
+
+_KEEPALIVE_IDLE_SECONDS = 30
+_KEEPALIVE_INTERVAL_SECONDS = 10
+_KEEPALIVE_PROBES = 3
+
+# Finished streams usually leave only the terminating chunk unread. Draining it lets the
+# socket go back to the pool; anything slower or larger than this is closed instead.
+_DRAIN_TIMEOUT_SECONDS = 0.05
+_DRAIN_MAX_BYTES = 16384
+
+# A pooled socket the upstream closed while it sat idle fails like this on its next request,
+# before any response byte is read.
+_STALE_ERRORS = (RemoteDisconnected, ConnectionResetError, ConnectionAbortedError, BrokenPipeError)
+_fresh_connection = threading.local()
+
+
+def _keepalive_socket_options() -> List[Tuple[int, int, int]]:
+    options = list(HTTPConnection.default_socket_options)
+    options.append((socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1))
+    if hasattr(socket, "TCP_KEEPIDLE"):
+        options.append((socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, _KEEPALIVE_IDLE_SECONDS))
+    elif hasattr(socket, "TCP_KEEPALIVE"):
+        options.append((socket.IPPROTO_TCP, socket.TCP_KEEPALIVE, _KEEPALIVE_IDLE_SECONDS))
+    if hasattr(socket, "TCP_KEEPINTVL"):
+        options.append((socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, _KEEPALIVE_INTERVAL_SECONDS))
+    if hasattr(socket, "TCP_KEEPCNT"):
+        options.append((socket.IPPROTO_TCP, socket.TCP_KEEPCNT, _KEEPALIVE_PROBES))
+    return options
+
+
+class _Counters:
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._values: Dict[str, int] = {}
+
+    def incr(self, name: str, amount: int = 1) -> None:
+        with self._lock:
+            self._values[name] = self._values.get(name, 0) + amount
+
+    def snapshot(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(self._values)
+
+
+class _DNSCache:
+    """
+    Caches getaddrinfo results per (host, port) so reconnects to the upstream skip DNS.
+    """
+
+    def __init__(self, ttl: float, counters: _Counters) -> None:
+        self.ttl = ttl
+        self._counters = counters
+        self._lock = threading.Lock()
+        self._entries: Dict[Tuple[str, int], Tuple[float, List[str]]] = {}
+
+    def lookup(self, host: str, port: int) -> List[str]:
+        if self.ttl <= 0:
+            return []
+        key = (host, port)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > now:
+                self._counters.incr("dns_hits")
+                return entry[1]
+        self._counters.incr("dns_misses")
+        try:
+            infos = socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)
+        except OSError:
+            return []
+        addresses: List[str] = []
+        for info in infos:
+            address = info[4][0]
+            if isinstance(address, str) and address not in addresses:
+                addresses.append(address)
+        if addresses:
+            with self._lock:
+                self._entries[key] = (now + self.ttl, addresses)
+        return addresses
+
+    def forget(self, host: str, port: int) -> None:
+        with self._lock:
+            self._entries.pop((host, port), None)
+
+
+class _CachedDNSMixin:
+    """
+    Connects through the shared DNS cache while leaving ``host`` untouched so that the
+    Host header, SNI and certificate checks still use the real upstream hostname.
+    """
+
+    dns_cache: _DNSCache | None = None
+    counters: _Counters | None = None
+
+    def _new_conn(self) -> socket.socket:
+        cache = self.dns_cache
+        host = self._dns_host
+        addresses = cache.lookup(host, self.port) if cache is not None else []
+        if self.counters is not None:
+            self.counters.incr("connections_opened")
+        for address in addresses:
+            try:
+                return urllib3_connection.create_connection(
+                    (address, self.port),
+                    self.timeout,
+                    source_address=self.source_address,
+                    socket_options=self.socket_options,
+                )
+            except OSError:
+                continue
+        if cache is not None and addresses:
+            cache.forget(host, self.port)
+        return super()._new_conn()
+
+
+class _CountingPoolMixin:
+    counters: _Counters | None = None
+
+    def _get_conn(self, timeout: float | None = None):
+        conn = super()._get_conn(timeout)
+        if getattr(_fresh_connection, "active", False) and getattr(conn, "sock", None) is not None:
+            # Retrying after a stale socket: don't hand out another idle one.
+            conn.close()
+        if self.counters is not None:
+            self.counters.incr("pool_misses" if getattr(conn, "sock", None) is None else "pool_hits")
+        return conn
+
+
+def _failed_before_response(exc: requests.ConnectionError) -> bool:
+    """Whether ``exc`` came from a connection that died or never opened, before any response."""
+    reason = exc.args[0] if exc.args else None
+    if isinstance(reason, MaxRetryError):
+        reason = reason.reason
+    if isinstance(reason, NewConnectionError):
+        return True
+    if isinstance(reason, ProtocolError):
+        return any(isinstance(arg, _STALE_ERRORS) for arg in reason.args)
+    return False
+
+
+def _drain_for_reuse(raw: Any) -> bool:
+    conn = getattr(raw, "_connection", None)
+    sock = getattr(conn, "sock", None)
+    if sock is None:
+        return False
+    try:
+        previous_timeout = sock.gettimeout()
+        sock.settimeout(_DRAIN_TIMEOUT_SECONDS)
+    except OSError:
+        return False
+    try:
+        remaining = _DRAIN_MAX_BYTES
+        while remaining > 0:
+            data = raw.read(min(8192, remaining))
+            if not data:
+                sock.settimeout(previous_timeout)
+                return True
+            remaining -= len(data)
+    except Exception:
+        pass
+    return False
+
+
+def _consume_post_handshake(sock: Any) -> None:
+    """
+    TLS 1.3 servers send session tickets after the handshake. On a warm socket nobody reads
+    them, so urllib3 would see a readable idle socket and discard it as dropped.
+    """
+    if not isinstance(sock, ssl.SSLSocket):
+        return
+    previous_timeout = sock.gettimeout()
+    deadline = time.monotonic() + 0.2
+    try:
+        sock.settimeout(0.0)
+        while time.monotonic() < deadline:
+            if not wait_for_read(sock, timeout=0.05):
+                return
+            try:
+                data = sock.recv(1)
+            except ssl.SSLWantReadError:
+                continue
+            raise ConnectionError("upstream sent unexpected data on an idle connection" if data else "upstream closed warm connection")
+    finally:
+        sock.settimeout(previous_timeout)
+
+
+class _PooledResponse(requests.Response):
+    def close(self) -> None:
+        if not self._content_consumed and self.raw is not None and _drain_for_reuse(self.raw):
+            self._content_consumed = True
+        super().close()
+
+    def abort(self) -> None:
+        """Close the connection without reading the rest of the body (the client went away)."""
+        raw = self.raw
+        if not self._content_consumed and raw is not None:
+            # Shut the socket down first so a thread blocked reading the body wakes up now.
+            sock = getattr(getattr(raw, "_connection", None), "sock", None)
+            if sock is not None:
+                try:
+                    sock.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+            raw.close()
+            self._content_consumed = True
+        super().close()
+
+
+class _PooledAdapter(HTTPAdapter):
+    def __init__(self, *, pool_size: int, dns_cache: _DNSCache, counters: _Counters) -> None:
+        self._dns_cache = dns_cache
+        self._counters = counters
+        super().__init__(pool_connections=4, pool_maxsize=pool_size, pool_block=False, max_retries=0)
+
+    def init_poolmanager(self, connections, maxsize, block=False, **pool_kwargs):
+        pool_kwargs.setdefault("socket_options", _keepalive_socket_options())
+        super().init_poolmanager(connections, maxsize, block=block, **pool_kwargs)
+        attrs = {"dns_cache": self._dns_cache, "counters": self._counters}
+        http_conn = type("_UpstreamHTTPConnection", (_CachedDNSMixin, HTTPConnection), attrs)
+        https_conn = type("_UpstreamHTTPSConnection", (_CachedDNSMixin, HTTPSConnection), attrs)
+        self.poolmanager.pool_classes_by_scheme = {
+            "http": type(
+                "_UpstreamHTTPConnectionPool",
+                (_CountingPoolMixin, HTTPConnectionPool),
+                {"ConnectionCls": http_conn, "counters": self._counters},
+            ),
+            "https": type(
+                "_UpstreamHTTPSConnectionPool",
+                (_CountingPoolMixin, HTTPSConnectionPool),
+                {"ConnectionCls": https_conn, "counters": self._counters},
+            ),
+        }
+
+    def build_response(self, req, resp):
+        response = super().build_response(req, resp)
+        response.__class__ = _PooledResponse
+        return response
+
+
+class UpstreamClient:
+    """
+    Thread-safe keep-alive client shared by every request that talks to the ChatGPT backend.
+    """
+
+    def __init__(self, pool_size: int = DEFAULT_POOL_SIZE, dns_ttl: float = DEFAULT_DNS_TTL) -> None:
+        self.pool_size = max(1, int(pool_size))
+        self.dns_ttl = float(dns_ttl)
+        self._counters = _Counters()
+        self._dns_cache = _DNSCache(self.dns_ttl, self._counters)
+        session = requests.Session()
+        # Never replay cookies from one client's upstream response on another client's request.
+        session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+        adapter = _PooledAdapter(pool_size=self.pool_size, dns_cache=self._dns_cache, counters=self._counters)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        self._session = session
+        self.last_request_at = 0.0
+
+    def post(self, url: str, **kwargs: Any) -> requests.Response:
+        self._counters.incr("requests")
+        self.last_request_at = time.monotonic()
+        try:
+            return self._session.post(url, **kwargs)
+        except requests.ConnectionError as exc:
+            # Once headers arrive the response is returned, so nothing here has been answered;
+            # send it once more on a new connection. Bodies are bytes or re-iterable.
+            if not _failed_before_response(exc):
+                raise
+        self._counters.incr("connection_retries")
+        _fresh_connection.active = True
+        try:
+            return self._session.post(url, **kwargs)
+        finally:
+            _fresh_connection.active = False
+
+    def prewarm(self, url: str, connections: int) -> int:
+        """
+        Make sure ``connections`` idle sockets to the origin of ``url`` are connected (TCP+TLS)
+        and parked in the pool. Dropped idle sockets are reconnected. Returns the live count.
+        """
+        settings = self._session.merge_environment_settings(url, {}, None, None, None)
+        if connections <= 0 or settings.get("proxies"):
+            return 0
+        adapter = self._session.get_adapter(url)
+        # Resolve the pool exactly as a real request would so TLS settings (and thus the pool key) match.
+        prepared = requests.Request("POST", url).prepare()
+        if hasattr(adapter, "get_connection_with_tls_context"):
+            pool = adapter.get_connection_with_tls_context(prepared, settings.get("verify"), None, settings.get("cert"))
+        else:
+            pool = adapter.get_connection(url)
+        taken = []
+        live = 0
+        error: Exception | None = None
+        try:
+            for _ in range(connections):
+                try:
+                    # Bypass the counting mixin: warming is not a pool hit or miss.
+                    conn = HTTPConnectionPool._get_conn(pool, timeout=0)
+                except Exception:
+                    break
+                taken.append(conn)
+                if conn.is_closed:
+                    conn.timeout = _PREWARM_CONNECT_TIMEOUT
+                    try:
+                        conn.connect()
+                        _consume_post_handshake(conn.sock)
+                    except Exception as exc:
+                        error = error or exc
+                        conn.close()
+                        self._counters.incr("prewarm_failures")
+                        continue
+                    self._counters.incr("connections_prewarmed")
+                live += 1
+        finally:
+            for conn in reversed(taken):
+                pool._put_conn(conn)
+        if live == 0 and error is not None:
+            raise error
+        return live
+
+    def stats(self) -> Dict[str, Any]:
+        counters = self._counters.snapshot()
+        return {
+            "transport": "http/1.1",
+            "pool_size": self.pool_size,
+            "dns_ttl": self.dns_ttl,
+            "requests": counters.get("requests", 0),
+            "pool_hits": counters.get("pool_hits", 0),
+            "pool_misses": counters.get("pool_misses", 0),
+            "connections_opened": counters.get("connections_opened", 0),
+            "dns_hits": counters.get("dns_hits", 0),
+            "dns_misses": counters.get("dns_misses", 0),
+            "connections_prewarmed": counters.get("connections_prewarmed", 0),
+            "prewarm_failures": counters.get("prewarm_failures", 0),
+            "connection_retries": counters.get("connection_retries", 0),
+        }
+
+    def close(self) -> None:
+        self._session.close()
+
+
+class _HTTP2Response:
+    """
+    Presents an httpx streaming response through the subset of the requests.Response API
+    the routes and stream translators rely on.
+    """
+
+    def __init__(self, response: Any, httpx_module: Any) -> None:
+        self._response = response
+        self._httpx = httpx_module
+        self._content: bytes | None = None
+        self.status_code = response.status_code
+        self.headers = response.headers
+        self.request = response.request
+        self.url = str(response.url)
+
+    def iter_content(self, chunk_size: int | None = 1, decode_unicode: bool = False):
+        # chunk_size is ignored on purpose: SSE frames must be forwarded as soon as they arrive.
+        if self._content is not None:
+            yield self._content
+            return
+        try:
+            for chunk in self._response.iter_bytes():
+                if chunk:
+                    yield chunk
+        except self._httpx.HTTPError as exc:
+            raise requests.ConnectionError(str(exc)) from exc
+
+    def iter_lines(self, chunk_size: int = 512, decode_unicode: bool = False, delimiter: bytes | None = None):
+        pending: bytes | None = None
+        for chunk in self.iter_content(chunk_size):
+            if pending is not None:
+                chunk = pending + chunk
+            lines = chunk.splitlines()
+            if lines and lines[-1] and chunk and lines[-1][-1] == chunk[-1]:
+                pending = lines.pop()
+            else:
+                pending = None
+            yield from lines
+        if pending is not None:
+            yield pending
+
+    @property
+    def content(self) -> bytes:
+        if self._content is None:
+            try:
+                self._content = self._response.read()
+            except self._httpx.HTTPError as exc:
+                raise requests.ConnectionError(str(exc)) from exc
+        return self._content
+
+    @property
+    def text(self) -> str:
+        return self.content.decode(self._response.encoding or "utf-8", errors="replace")
+
+    def json(self) -> Any:
+        return json.loads(self.content)
+
+    def close(self) -> None:
+        self._response.close()
+
+    def abort(self) -> None:
+        """
+        Close without reading the rest of the body. A stream that fell back to HTTP/1.1 has its
+        socket shut down so a blocked reader wakes up; an HTTP/2 stream is released on its
+        shared connection (httpcore has no call to reset a single stream).
+        """
+        extensions = getattr(self._response, "extensions", None) or {}
+        network_stream = extensions.get("network_stream")
+        if extensions.get("http_version") != b"HTTP/2" and network_stream is not None:
+            sock = network_stream.get_extra_info("socket")
+            if sock is not None:
+                try:
+                    sock.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+        self._response.close()
+
+
+class HTTP2UpstreamClient:
+    """
+    Multiplexes concurrent upstream streams over a few HTTP/2 connections (requires httpx[http2]).
+    """
+
+    def __init__(self, pool_size: int = DEFAULT_POOL_SIZE) -> None:
+        import httpx
+
+        self._httpx = httpx
+        self.pool_size = max(1, int(pool_size))
+        self._counters = _Counters()
+        limits = httpx.Limits(
+            max_connections=self.pool_size,
+            max_keepalive_connections=self.pool_size,
+            keepalive_expiry=_KEEPALIVE_IDLE_SECONDS * 4,
+        )
+        self._client = httpx.Client(http2=True, limits=limits, timeout=None)
+        self.last_request_at = 0.0
+
+    def post(
+        self,
+        url: str,
+        *,
+        headers: Dict[str, str] | None = None,
+        json: Any = None,
+        data: Any = None,
+        stream: bool = True,
+        timeout: float | None = None,
+    ) -> _HTTP2Response:
+        self._counters.incr("requests")
+        self.last_request_at = time.monotonic()
+        if json is not None:
+            body = _json_body(json)
+        elif isinstance(data, str):
+            body = data.encode("utf-8")
+        else:
+            body = data
+        if body is not None and not isinstance(body, bytes) and hasattr(body, "__len__"):
+            # httpx sends other iterables chunked; a sized body keeps its Content-Length.
+            headers = {**(headers or {}), "Content-Length": str(len(body))}
+        request = self._client.build_request(
+            "POST", url, headers=headers, content=body, timeout=self._httpx.Timeout(timeout)
+        )
+        try:
+            response = self._client.send(request, stream=True)
+        except self._httpx.HTTPError as exc:
+            raise requests.ConnectionError(str(exc)) from exc
+        wrapped = _HTTP2Response(response, self._httpx)
+        if not stream:
+            try:
+                wrapped.content
+            finally:
+                wrapped.close()
+        return wrapped
+
+    def prewarm(self, url: str, connections: int) -> int:
+        # httpx has no way to open a connection without sending a request; a single HTTP/2
+        # connection is shared by every stream anyway, so only the first request pays the handshake.
+        return 0
+
+    def _open_connections(self) -> int | None:
+        pool = getattr(getattr(self._client, "_transport", None), "_pool", None)
+        connections = getattr(pool, "connections", None)
+        return len(connections) if isinstance(connections, list) else None
+
+    def stats(self) -> Dict[str, Any]:
+        counters = self._counters.snapshot()
+        return {
+            "transport": "http/2",
+            "pool_size": self.pool_size,
+            "requests": counters.get("requests", 0),
+            "open_connections": self._open_connections(),
+        }
+
+    def close(self) -> None:
+        self._client.close()
+
+
+class UpstreamWarmer:
+    """
+    Keeps a few upstream connections warm: once at startup and again whenever the server has
+    been idle for a full interval, so the next request skips DNS, TCP and TLS.
+    """
+
+    def __init__(self, url: str, connections: int, interval: float) -> None:
+        self.url = url
+        self.connections = max(0, int(connections))
+        self.interval = max(1.0, float(interval))
+        self._stop = threading.Event()
+        self._thread: threading.Thread | None = None
+        self._lock = threading.Lock()
+        self._warm = 0
+        self._rounds = 0
+        self._last_warmed_at: float | None = None
+        self._last_error: str | None = None
+
+    def start(self) -> None:
+        if self.connections <= 0 or self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, name="chatmock-upstream-warmer", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+
+    def warm_once(self) -> int:
+        try:
+            warm = get_upstream_client().prewarm(self.url, self.connections)
+            error = None
+        except Exception as exc:
+            warm = 0
+            error = str(exc)
+        with self._lock:
+            self._warm = warm
+            self._rounds += 1
+            self._last_warmed_at = time.time()
+            self._last_error = error
+        return warm
+
+    def _run(self) -> None:
+        self.warm_once()
+        while not self._stop.wait(self.interval):
+            idle_for = time.monotonic() - get_upstream_client().last_request_at
+            if idle_for >= self.interval:
+                self.warm_once()
+
+    def state(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "enabled": self.connections > 0,
+                "target": self.connections,
+                "warm": self._warm,
+                "interval_seconds": self.interval,
+                "rounds": self._rounds,
+                "last_warmed_at": self._last_warmed_at,
+                "last_error": self._last_error,
+            }
+
+
+def _json_body(payload: Any) -> bytes:
+    # Same encoding requests applies for json=..., so both transports send identical bodies.
+    return json.dumps(payload, allow_nan=False).encode("utf-8")
+
+
+def _http2_available() -> bool:
+    try:
+        import h2  # noqa: F401
+        import httpx  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+_CLIENT: UpstreamClient | HTTP2UpstreamClient | None = None
+_CLIENT_LOCK = threading.Lock()
+_WARMER: UpstreamWarmer | None = None
+
+
+def configure_upstream_client(
+    pool_size: int | None = None,
+    dns_ttl: float | None = None,
+    http2: bool = False,
+) -> UpstreamClient | HTTP2UpstreamClient:
+    global _CLIENT
+    pool_size = pool_size if isinstance(pool_size, int) and pool_size > 0 else DEFAULT_POOL_SIZE
+    client: UpstreamClient | HTTP2UpstreamClient
+    if http2 and _http2_available():
+        client = HTTP2UpstreamClient(pool_size=pool_size)
+    else:
+        if http2:
+            print(
+                "WARNING: --upstream-http2 requires 'httpx[http2]'; falling back to HTTP/1.1.",
+                file=sys.stderr,
+            )
+        client = UpstreamClient(
+            pool_size=pool_size,
+            dns_ttl=dns_ttl if isinstance(dns_ttl, (int, float)) and dns_ttl >= 0 else DEFAULT_DNS_TTL,
+        )
+    with _CLIENT_LOCK:
+        previous, _CLIENT = _CLIENT, client
+    if previous is not None:
+        previous.close()
+    return client
+
+
+def get_upstream_client() -> UpstreamClient | HTTP2UpstreamClient:
+    global _CLIENT
+    client = _CLIENT
+    if client is not None:
+        return client
+    with _CLIENT_LOCK:
+        if _CLIENT is None:
+            _CLIENT = UpstreamClient()
+        return _CLIENT
+
+
+def upstream_post(url: str, **kwargs: Any) -> requests.Response | _HTTP2Response:
+    return get_upstream_client().post(url, **kwargs)
+
+
+def upstream_client_stats() -> Dict[str, Any]:
+    return get_upstream_client().stats()
+
+
+def start_upstream_warmer(
+    url: str,
+    connections: int = DEFAULT_PREWARM_CONNECTIONS,
+    interval: float = DEFAULT_PREWARM_INTERVAL,
+) -> UpstreamWarmer:
+    global _WARMER
+    warmer = UpstreamWarmer(url, connections, interval)
+    with _CLIENT_LOCK:
+        previous, _WARMER = _WARMER, warmer
+    if previous is not None:
+        previous.stop()
+    warmer.start()
+    return warmer
+
+
+def upstream_warm_state() -> Dict[str, Any]:
+    warmer = _WARMER
+    if warmer is None:
+        return {"enabled": False}
+    return warmer.state()
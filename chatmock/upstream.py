@@ -2,7 +2,6 @@ from __future__ import annotations
 
 import json
 import time
-from copy import deepcopy
 from typing import Any, Dict, List, Tuple
 
 import requests
@@ -10,8 +9,10 @@ from flask import Response, jsonify, make_response
 
 from .config import CHATGPT_RESPONSES_URL
 from .http import build_cors_headers
-from .session import ensure_session_id
-from flask import request as flask_request
+from .payload import encode_payload
+from .session import resolve_session
+from flask import current_app, request as flask_request
+from .transport import upstream_post
 from .utils import get_effective_chatgpt_auth
 
 
@@ -100,7 +101,9 @@ def start_upstream_request(
         )
     except Exception:
         client_session_id = None
-    session_id = ensure_session_id(instructions, input_items, client_session_id)
+    session_id, matched_items, total_items = resolve_session(instructions, input_items, client_session_id)
+    if not client_session_id and current_app.config.get("VERBOSE"):
+        print(f"[session] {session_id} matched {matched_items}/{total_items} prefix items")
 
     responses_payload = {
         "model": model,
@@ -131,18 +134,22 @@ def start_upstream_request(
     }
 
     request_timeout = 1800
+    body = encode_payload(responses_payload)
     request_ctx = {
         "url": CHATGPT_RESPONSES_URL,
-        "payload": deepcopy(responses_payload),
+        # The encoded body is the request snapshot; resumes splice their token onto it.
+        "body": body,
         "headers": dict(headers),
         "timeout": request_timeout,
+        "session_id": session_id,
+        "model": model,
     }
 
     try:
-        upstream = requests.post(
+        upstream = upstream_post(
             CHATGPT_RESPONSES_URL,
             headers=headers,
-            json=responses_payload,
+            data=body,
             stream=True,
             timeout=request_timeout,
         )
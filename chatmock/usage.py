@@ -0,0 +1,180 @@
+from __future__ import annotations
+
+import threading
+from collections import OrderedDict
+from typing import Any, Dict
+
+from .sse import SSEEvent
+
+_MAX_TRACKED_SESSIONS = 1000
+_STATS_RECENT_SESSIONS = 50
+
+
+def _upstream_usage(evt: Dict[str, Any]) -> Dict[str, Any] | None:
+    try:
+        usage = (evt.get("response") or {}).get("usage")
+    except Exception:
+        return None
+    return usage if isinstance(usage, dict) else None
+
+
+def _cached_tokens(usage: Dict[str, Any]) -> int | None:
+    details = usage.get("input_tokens_details")
+    if not isinstance(details, dict) or "cached_tokens" not in details:
+        return None
+    try:
+        return int(details.get("cached_tokens") or 0)
+    except (TypeError, ValueError):
+        return None
+
+
+def extract_usage(evt: Dict[str, Any]) -> Dict[str, Any] | None:
+    """OpenAI chat-style usage from a Responses event, with cached input tokens when reported."""
+    usage = _upstream_usage(evt)
+    if usage is None:
+        return None
+    try:
+        pt = int(usage.get("input_tokens") or 0)
+        ct = int(usage.get("output_tokens") or 0)
+        tt = int(usage.get("total_tokens") or (pt + ct))
+    except (TypeError, ValueError):
+        return None
+    out: Dict[str, Any] = {"prompt_tokens": pt, "completion_tokens": ct, "total_tokens": tt}
+    cached = _cached_tokens(usage)
+    if cached is not None:
+        out["prompt_tokens_details"] = {"cached_tokens": cached}
+    return out
+
+
+class _Totals:
+    __slots__ = ("requests", "input_tokens", "cached_tokens", "output_tokens")
+
+    def __init__(self) -> None:
+        self.requests = 0
+        self.input_tokens = 0
+        self.cached_tokens = 0
+        self.output_tokens = 0
+
+    def add(self, input_tokens: int, cached_tokens: int, output_tokens: int) -> None:
+        self.requests += 1
+        self.input_tokens += input_tokens
+        self.cached_tokens += cached_tokens
+        self.output_tokens += output_tokens
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {
+            "requests": self.requests,
+            "input_tokens": self.input_tokens,
+            "cached_input_tokens": self.cached_tokens,
+            "uncached_input_tokens": self.input_tokens - self.cached_tokens,
+            "output_tokens": self.output_tokens,
+            "cache_hit_rate": round(self.cached_tokens / self.input_tokens, 4) if self.input_tokens else None,
+        }
+
+
+class UsageTracker:
+    """Aggregates upstream prompt-cache usage overall, per model and per prompt_cache_key."""
+
+    def __init__(self, max_sessions: int = _MAX_TRACKED_SESSIONS) -> None:
+        self._lock = threading.Lock()
+        self._max_sessions = max_sessions
+        self._total = _Totals()
+        self._models: Dict[str, _Totals] = {}
+        # session id -> (totals, input tokens of the latest request); most recent last
+        self._sessions: "OrderedDict[str, tuple[_Totals, int]]" = OrderedDict()
+
+    def record(self, session_id: str | None, model: str | None, usage: Dict[str, Any]) -> None:
+        try:
+            input_tokens = int(usage.get("input_tokens") or 0)
+            output_tokens = int(usage.get("output_tokens") or 0)
+        except (TypeError, ValueError):
+            return
+        cached_tokens = _cached_tokens(usage) or 0
+        with self._lock:
+            self._total.add(input_tokens, cached_tokens, output_tokens)
+            model_key = model if isinstance(model, str) and model else "unknown"
+            model_totals = self._models.get(model_key)
+            if model_totals is None:
+                model_totals = self._models[model_key] = _Totals()
+            model_totals.add(input_tokens, cached_tokens, output_tokens)
+            if isinstance(session_id, str) and session_id:
+                entry = self._sessions.pop(session_id, None)
+                session_totals = entry[0] if entry is not None else _Totals()
+                session_totals.add(input_tokens, cached_tokens, output_tokens)
+                self._sessions[session_id] = (session_totals, input_tokens)
+                if len(self._sessions) > self._max_sessions:
+                    self._sessions.popitem(last=False)
+
+    def last_input_tokens(self, session_id: str) -> int | None:
+        with self._lock:
+            entry = self._sessions.get(session_id)
+            return entry[1] if entry is not None else None
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            recent = list(self._sessions.items())[-_STATS_RECENT_SESSIONS:]
+            return {
+                "total": self._total.as_dict(),
+                "models": {name: totals.as_dict() for name, totals in self._models.items()},
+                "tracked_sessions": len(self._sessions),
+                "recent_sessions": {sid: totals.as_dict() for sid, (totals, _) in reversed(recent)},
+            }
+
+
+_TRACKER = UsageTracker()
+
+
+def record_usage(request_ctx: Dict[str, Any] | None, evt: Dict[str, Any]) -> None:
+    """Account a terminal Responses event's usage against the request it belongs to."""
+    usage = _upstream_usage(evt)
+    if usage is None:
+        return
+    ctx = request_ctx if isinstance(request_ctx, dict) else {}
+    _TRACKER.record(ctx.get("session_id"), ctx.get("model"), usage)
+
+
+def last_session_input_tokens(session_id: str) -> int | None:
+    return _TRACKER.last_input_tokens(session_id)
+
+
+def usage_stats() -> Dict[str, Any]:
+    return _TRACKER.stats()
+
+
+class UsageSniffer:
+    """Watches a relayed Responses SSE byte stream for the usage block of its terminal event."""
+
+    _TERMINAL = (b'"response.completed"', b'"response.incomplete"', b'"response.failed"')
+
+    def __init__(self, request_ctx: Dict[str, Any] | None) -> None:
+        self._ctx = request_ctx
+        self._buf = bytearray()
+        self._scanned = 0
+        self._done = False
+
+    def feed(self, chunk: bytes) -> None:
+        if self._done:
+            return
+        buf = self._buf
+        buf += chunk
+        start = 0
+        while True:
+            idx = buf.find(b"\n", max(start, self._scanned))
+            if idx < 0:
+                break
+            line = bytes(buf[start:idx])
+            start = idx + 1
+            self._scanned = start
+            if line.startswith(b"data:") and b'"usage"' in line and any(m in line for m in self._TERMINAL):
+                try:
+                    evt = SSEEvent(line[5:].strip()).decode()
+                except ValueError:
+                    continue
+                if _upstream_usage(evt) is not None:
+                    record_usage(self._ctx, evt)
+                    self._done = True
+                    buf.clear()
+                    return
+        if start:
+            del buf[:start]
+        self._scanned = len(buf)
@@ -7,15 +7,26 @@ import json
 import os
 import secrets
 import sys
-import queue
 import threading
 import time
-from copy import deepcopy
+from contextlib import contextmanager
+from dataclasses import dataclass
 from typing import Any, Dict, List, Optional, Tuple
 
 import requests
 
-from .config import CLIENT_ID_DEFAULT, OAUTH_TOKEN_URL
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+try:
+    import msvcrt
+except ImportError:
+    msvcrt = None
+
+from .config import CLIENT_ID_DEFAULT, OAUTH_TOKEN_URL, env_flag, env_float
+from .fastjson import get_codec
+from .translate import Encoder, StreamState, ToolCall, translate
 
 
 def eprint(*args, **kwargs) -> None:
@@ -29,16 +40,21 @@ def get_home_dir() -> str:
     return home
 
 
-def read_auth_file() -> Dict[str, Any] | None:
+def _auth_file_candidates() -> List[str]:
+    paths: List[str] = []
     for base in [
         os.getenv("CHATGPT_LOCAL_HOME"),
         os.getenv("CODEX_HOME"),
         os.path.expanduser("~/.chatgpt-local"),
         os.path.expanduser("~/.codex"),
     ]:
-        if not base:
-            continue
-        path = os.path.join(base, "auth.json")
+        if base:
+            paths.append(os.path.join(base, "auth.json"))
+    return paths
+
+
+def read_auth_file() -> Dict[str, Any] | None:
+    for path in _auth_file_candidates():
         try:
             with open(path, "r", encoding="utf-8") as f:
                 return json.load(f)
@@ -57,14 +73,21 @@ def write_auth_file(auth: Dict[str, Any]) -> bool:
         eprint(f"ERROR: unable to create auth home directory {home}: {exc}")
         return False
     path = os.path.join(home, "auth.json")
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
     try:
-        with open(path, "w", encoding="utf-8") as fp:
+        with open(tmp_path, "w", encoding="utf-8") as fp:
             if hasattr(os, "fchmod"):
                 os.fchmod(fp.fileno(), 0o600)
             json.dump(auth, fp, indent=2)
+        os.replace(tmp_path, path)
+        invalidate_auth_cache()
         return True
     except Exception as exc:
         eprint(f"ERROR: unable to write auth file: {exc}")
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
         return False
 
 
@@ -285,63 +308,310 @@ def convert_tools_chat_to_responses(tools: Any) -> List[Dict[str, Any]]:
     return out
 
 
+# How long a parsed auth.json is trusted before its inode/mtime is checked again. Within
+# this window the request hot path never touches the filesystem.
+_AUTH_CACHE_REVALIDATE_SECONDS = env_float("CHATGPT_LOCAL_AUTH_CACHE_SECONDS", 2.0)
+
+
+@dataclass
+class _CachedAuth:
+    path: str | None
+    file_key: Tuple[int, int, int] | None
+    # Higher-priority candidates passed over (missing or unreadable) and their file keys then.
+    skipped: Tuple[Tuple[str, Tuple[int, int, int] | None], ...]
+    auth: Dict[str, Any] | None
+    tokens: Dict[str, Any]
+    access_token: str | None
+    account_id: str | None
+    id_token: str | None
+    refresh_token: str | None
+    last_refresh: Any
+    access_exp: float | None
+    checked_at: float
+
+
+_AUTH_CACHE_LOCK = threading.Lock()
+_AUTH_CACHE: _CachedAuth | None = None
+
+
+def _file_key(st: os.stat_result) -> Tuple[int, int, int]:
+    return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+
+def _stat_key(path: str) -> Tuple[int, int, int] | None:
+    try:
+        return _file_key(os.stat(path))
+    except OSError:
+        return None
+
+
+def _token_exp(token: Any) -> float | None:
+    if not isinstance(token, str) or not token:
+        return None
+    claims = parse_jwt_claims(token) or {}
+    exp = claims.get("exp") if isinstance(claims, dict) else None
+    return float(exp) if isinstance(exp, (int, float)) else None
+
+
+def _parse_cached_auth(
+    path: str | None,
+    file_key: Tuple[int, int, int] | None,
+    auth: Any,
+    skipped: Tuple[Tuple[str, Tuple[int, int, int] | None], ...] = (),
+) -> _CachedAuth:
+    auth = auth if isinstance(auth, dict) else None
+    tokens = auth.get("tokens") if auth is not None and isinstance(auth.get("tokens"), dict) else {}
+    access_token = tokens.get("access_token")
+    id_token = tokens.get("id_token")
+    account_id = tokens.get("account_id")
+    if not isinstance(account_id, str) or not account_id:
+        account_id = _derive_account_id(id_token)
+    return _CachedAuth(
+        path=path,
+        file_key=file_key,
+        skipped=skipped,
+        auth=auth,
+        tokens=tokens,
+        access_token=access_token if isinstance(access_token, str) and access_token else None,
+        account_id=account_id if isinstance(account_id, str) and account_id else None,
+        id_token=id_token if isinstance(id_token, str) and id_token else None,
+        refresh_token=tokens.get("refresh_token") if isinstance(tokens.get("refresh_token"), str) else None,
+        last_refresh=auth.get("last_refresh") if auth is not None else None,
+        access_exp=_token_exp(access_token),
+        checked_at=time.monotonic(),
+    )
+
+
+def _load_cached_auth() -> _CachedAuth:
+    skipped: List[Tuple[str, Tuple[int, int, int] | None]] = []
+    for path in _auth_file_candidates():
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                file_key = _file_key(os.fstat(f.fileno()))
+                auth = json.load(f)
+        except Exception:
+            skipped.append((path, _stat_key(path)))
+            continue
+        return _parse_cached_auth(path, file_key, auth, tuple(skipped))
+    return _parse_cached_auth(None, None, None, tuple(skipped))
+
+
+def _auth_files_unchanged(cached: _CachedAuth) -> bool:
+    """
+    Whether the auth.json that was loaded, and every higher-priority candidate passed over for
+    it, still look as they did; a login under CHATGPT_LOCAL_HOME then takes over from ~/.codex.
+    """
+    expected = [path for path, _ in cached.skipped]
+    if cached.path is not None:
+        expected.append(cached.path)
+    if _auth_file_candidates()[: len(expected)] != expected:
+        return False
+    if any(_stat_key(path) != key for path, key in cached.skipped):
+        return False
+    return cached.path is None or _stat_key(cached.path) == cached.file_key
+
+
+def _get_cached_auth() -> _CachedAuth:
+    global _AUTH_CACHE
+    cached = _AUTH_CACHE
+    now = time.monotonic()
+    if cached is not None and now - cached.checked_at < _AUTH_CACHE_REVALIDATE_SECONDS:
+        return cached
+    with _AUTH_CACHE_LOCK:
+        cached = _AUTH_CACHE
+        if cached is not None and now - cached.checked_at < _AUTH_CACHE_REVALIDATE_SECONDS:
+            return cached
+        if cached is not None and _auth_files_unchanged(cached):
+            cached.checked_at = now
+            return cached
+        _AUTH_CACHE = _load_cached_auth()
+        return _AUTH_CACHE
+
+
+def invalidate_auth_cache() -> None:
+    """Drop the parsed auth.json so the next request re-reads it (after login or refresh)."""
+    global _AUTH_CACHE
+    with _AUTH_CACHE_LOCK:
+        _AUTH_CACHE = None
+
+
+def _needs_refresh(cached: _CachedAuth) -> bool:
+    if not cached.refresh_token or not CLIENT_ID_DEFAULT:
+        return False
+    if not cached.access_token:
+        return True
+    return _should_refresh_at(cached.access_exp, cached.last_refresh)
+
+
+@contextmanager
+def _auth_file_lock():
+    """Serialize token refreshes across processes sharing the same auth home."""
+    home = get_home_dir()
+    fp = None
+    try:
+        os.makedirs(home, exist_ok=True)
+        fp = open(os.path.join(home, "auth.json.lock"), "a+")
+    except OSError:
+        fp = None
+    try:
+        if fp is not None:
+            try:
+                if fcntl is not None:
+                    fcntl.flock(fp.fileno(), fcntl.LOCK_EX)
+                elif msvcrt is not None:
+                    fp.seek(0)
+                    msvcrt.locking(fp.fileno(), msvcrt.LK_LOCK, 1)
+            except OSError:
+                pass
+        yield
+    finally:
+        if fp is not None:
+            try:
+                if fcntl is not None:
+                    fcntl.flock(fp.fileno(), fcntl.LOCK_UN)
+                elif msvcrt is not None:
+                    fp.seek(0)
+                    msvcrt.locking(fp.fileno(), msvcrt.LK_UNLCK, 1)
+            except OSError:
+                pass
+            fp.close()
+
+
+_REFRESH_LOCK = threading.Lock()
+# After a failed refresh, threads queued behind it reuse the current token for a short while
+# instead of each repeating the OAuth call in turn.
+_REFRESH_FAILURE_COOLDOWN_SECONDS = 10.0
+_LAST_REFRESH_FAILURE = [float("-inf")]
+
+
+def _refresh_cached_auth() -> _CachedAuth:
+    """Refresh the tokens at most once, however many threads or workers ask at the same time.
+
+    Callers queue on an in-process lock and then on a file lock next to auth.json. Whoever gets
+    in first performs the OAuth call; everyone after re-reads auth.json and finds fresh tokens.
+    """
+    global _AUTH_CACHE
+    with _REFRESH_LOCK:
+        current = _get_cached_auth()
+        if not _needs_refresh(current):
+            return current
+        if time.monotonic() - _LAST_REFRESH_FAILURE[0] < _REFRESH_FAILURE_COOLDOWN_SECONDS:
+            return current
+        with _auth_file_lock():
+            current = _load_cached_auth()
+            with _AUTH_CACHE_LOCK:
+                _AUTH_CACHE = current
+            if current.auth is None or not _needs_refresh(current):
+                return current
+
+            refreshed = _refresh_chatgpt_tokens(current.refresh_token or "", CLIENT_ID_DEFAULT)
+            if not refreshed:
+                _LAST_REFRESH_FAILURE[0] = time.monotonic()
+                return current
+
+            updated_tokens = dict(current.tokens)
+            for key in ("access_token", "id_token", "refresh_token", "account_id"):
+                value = refreshed.get(key)
+                if isinstance(value, str) and value:
+                    updated_tokens[key] = value
+
+            persisted = _persist_refreshed_auth(current.auth, updated_tokens)
+            if persisted is not None:
+                return _get_cached_auth()
+            updated_auth = dict(current.auth)
+            updated_auth["tokens"] = updated_tokens
+            fallback = _parse_cached_auth(current.path, current.file_key, updated_auth, current.skipped)
+            with _AUTH_CACHE_LOCK:
+                _AUTH_CACHE = fallback
+            return fallback
+
+
 def load_chatgpt_tokens(ensure_fresh: bool = True) -> tuple[str | None, str | None, str | None]:
-    auth = read_auth_file()
-    if not isinstance(auth, dict):
+    cached = _get_cached_auth()
+    if cached.auth is None:
         return None, None, None
 
-    tokens = auth.get("tokens") if isinstance(auth.get("tokens"), dict) else {}
-    access_token: Optional[str] = tokens.get("access_token")
-    account_id: Optional[str] = tokens.get("account_id")
-    id_token: Optional[str] = tokens.get("id_token")
-    refresh_token: Optional[str] = tokens.get("refresh_token")
-    last_refresh = auth.get("last_refresh")
-
-    if ensure_fresh and isinstance(refresh_token, str) and refresh_token and CLIENT_ID_DEFAULT:
-        needs_refresh = _should_refresh_access_token(access_token, last_refresh)
-        if needs_refresh or not (isinstance(access_token, str) and access_token):
-            refreshed = _refresh_chatgpt_tokens(refresh_token, CLIENT_ID_DEFAULT)
-            if refreshed:
-                access_token = refreshed.get("access_token") or access_token
-                id_token = refreshed.get("id_token") or id_token
-                refresh_token = refreshed.get("refresh_token") or refresh_token
-                account_id = refreshed.get("account_id") or account_id
-
-                updated_tokens = dict(tokens)
-                if isinstance(access_token, str) and access_token:
-                    updated_tokens["access_token"] = access_token
-                if isinstance(id_token, str) and id_token:
-                    updated_tokens["id_token"] = id_token
-                if isinstance(refresh_token, str) and refresh_token:
-                    updated_tokens["refresh_token"] = refresh_token
-                if isinstance(account_id, str) and account_id:
-                    updated_tokens["account_id"] = account_id
-
-                persisted = _persist_refreshed_auth(auth, updated_tokens)
-                if persisted is not None:
-                    auth, tokens = persisted
+    if ensure_fresh and _needs_refresh(cached):
+        cached = _refresh_cached_auth()
+
+    return cached.access_token, cached.account_id, cached.id_token
+
+
+# Seconds before `exp` at which the background refresher renews the access token; matches the
+# skew used by _should_refresh_at so in-request refreshes rarely trigger.
+_REFRESH_AHEAD_SECONDS = 5 * 60
+DEFAULT_BACKGROUND_TOKEN_REFRESH = not env_flag("CHATGPT_LOCAL_DISABLE_TOKEN_REFRESHER")
+_REFRESHER_MAX_SLEEP_SECONDS = 15 * 60
+_REFRESHER_RETRY_SECONDS = 30.0
+
+
+class TokenRefresher:
+    """Daemon thread that renews the access token shortly before it expires."""
+
+    def __init__(self) -> None:
+        self._stop = threading.Event()
+        self._thread: threading.Thread | None = None
+        self.refreshes = 0
+        self.failures = 0
+
+    def start(self) -> None:
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="chatmock-token-refresher", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+
+    def _next_delay(self, cached: _CachedAuth) -> float:
+        if cached.auth is None or not cached.refresh_token:
+            return _REFRESHER_MAX_SLEEP_SECONDS
+        if _needs_refresh(cached):
+            return 0.0
+        if cached.access_exp is None:
+            return _REFRESHER_MAX_SLEEP_SECONDS
+        delay = cached.access_exp - _REFRESH_AHEAD_SECONDS - time.time()
+        return max(0.0, min(delay, _REFRESHER_MAX_SLEEP_SECONDS))
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            try:
+                cached = _get_cached_auth()
+                delay = self._next_delay(cached)
+                if delay > 0:
+                    self._stop.wait(delay)
+                    continue
+                after = _refresh_cached_auth()
+                if _needs_refresh(after):
+                    self.failures += 1
+                    self._stop.wait(_REFRESHER_RETRY_SECONDS)
                 else:
-                    tokens = updated_tokens
+                    self.refreshes += 1
+            except Exception as exc:
+                self.failures += 1
+                eprint(f"ERROR: background token refresh failed: {exc}")
+                self._stop.wait(_REFRESHER_RETRY_SECONDS)
 
-    if not isinstance(account_id, str) or not account_id:
-        account_id = _derive_account_id(id_token)
 
-    access_token = access_token if isinstance(access_token, str) and access_token else None
-    id_token = id_token if isinstance(id_token, str) and id_token else None
-    account_id = account_id if isinstance(account_id, str) and account_id else None
-    return access_token, account_id, id_token
+_REFRESHER: TokenRefresher | None = None
+_REFRESHER_LOCK = threading.Lock()
 
 
-def _should_refresh_access_token(access_token: Optional[str], last_refresh: Any) -> bool:
-    if not isinstance(access_token, str) or not access_token:
-        return True
+def start_token_refresher() -> TokenRefresher:
+    global _REFRESHER
+    with _REFRESHER_LOCK:
+        if _REFRESHER is None:
+            _REFRESHER = TokenRefresher()
+        _REFRESHER.start()
+        return _REFRESHER
 
-    claims = parse_jwt_claims(access_token) or {}
-    exp = claims.get("exp") if isinstance(claims, dict) else None
+
+def _should_refresh_at(exp: float | None, last_refresh: Any) -> bool:
     now = datetime.datetime.now(datetime.timezone.utc)
-    if isinstance(exp, (int, float)):
+    if exp is not None:
         try:
-            expiry = datetime.datetime.fromtimestamp(float(exp), datetime.timezone.utc)
+            expiry = datetime.datetime.fromtimestamp(exp, datetime.timezone.utc)
         except (OverflowError, OSError, ValueError):
             expiry = None
         if expiry is not None:
@@ -440,6 +710,271 @@ def get_effective_chatgpt_auth() -> tuple[str | None, str | None]:
     return access_token, account_id
 
 
+def _serialize_tool_args(eff_args: Any) -> str:
+    """
+    Serialize tool call arguments with proper JSON handling.
+
+    Args:
+        eff_args: Arguments to serialize (dict, list, str, or other)
+
+    Returns:
+        JSON string representation of the arguments
+    """
+    if isinstance(eff_args, (dict, list)):
+        return json.dumps(eff_args)
+    elif isinstance(eff_args, str):
+        try:
+            parsed = json.loads(eff_args)
+            if isinstance(parsed, (dict, list)):
+                return json.dumps(parsed)
+            else:
+                return json.dumps({"query": eff_args})
+        except (json.JSONDecodeError, ValueError):
+            return json.dumps({"query": eff_args})
+    else:
+        return "{}"
+
+
+class ChunkTemplate:
+    """
+    Pre-rendered bytes of one stream's OpenAI chunks.
+
+    ``id``/``object``/``created``/``model`` are constant for a stream, so they are rendered once
+    per response id and each frame only serializes its own value (the delta or text). Frames are
+    byte-identical to what the selected JSON codec makes of the equivalent dict.
+    """
+
+    __slots__ = ("codec", "key_sep", "item_sep", "_head", "_finish", "_tail", "_response_id", "_prefix")
+
+    def __init__(self, obj: str, created: int, model: str, field: str) -> None:
+        codec = self.codec = get_codec()
+        k, i = codec.key_sep, codec.item_sep
+        self.key_sep = k.encode()
+        self.item_sep = i.encode()
+        self._head = (
+            f'{i}"object"{k}{codec.dumps(obj)}{i}"created"{k}{codec.dumps(created)}{i}"model"{k}{codec.dumps(model)}'
+            f'{i}"choices"{k}[{{"index"{k}0{i}"{field}"{k}'
+        ).encode("utf-8")
+        self._finish = f'{i}"finish_reason"{k}'.encode()
+        self._tail = self._finish + b"null}]}\n\n"
+        self._response_id: Any = None
+        self._prefix: bytes | None = None
+
+    def _prefix_for(self, response_id: Any) -> bytes:
+        if self._prefix is None or response_id != self._response_id:
+            self._response_id = response_id
+            self._prefix = b'data: {"id"' + self.key_sep + self.codec.dumpb(response_id) + self._head
+        return self._prefix
+
+    def frame(self, response_id: Any, value: bytes) -> bytes:
+        """The common case: ``value`` (already serialized), no finish_reason, no extras."""
+        return self._prefix_for(response_id) + value + self._tail
+
+    def frame_with(self, response_id: Any, value: bytes, finish_reason: str | None, extra: Dict[str, Any]) -> bytes:
+        codec = self.codec
+        parts = [self._prefix_for(response_id), value, self._finish, codec.dumpb(finish_reason), b"}]"]
+        for key, item in extra.items():
+            parts += (self.item_sep, codec.quote(key), self.key_sep, codec.dumpb(item))
+        parts.append(b"}\n\n")
+        return b"".join(parts)
+
+
+class ChatCompletionStreamEncoder(Encoder):
+    """OpenAI ``chat.completion.chunk`` server-sent events."""
+
+    name = "chat.completions/stream"
+    events = frozenset(
+        {
+            "response.output_text.delta",
+            "response.output_item.added",
+            "response.function_call_arguments.delta",
+            "response.output_item.done",
+            "response.reasoning_summary_text.delta",
+            "response.reasoning_text.delta",
+        }
+    )
+    default_response_id = "chatcmpl-stream"
+    keepalive = b": keepalive\n\n"
+
+    def __init__(
+        self,
+        model: str,
+        created: int,
+        reasoning_compat: str = "think-tags",
+        *,
+        include_usage: bool = False,
+        verbose: bool = False,
+        vlog=None,
+    ) -> None:
+        self.model = model
+        self.created = created
+        self.compat = (reasoning_compat or "think-tags").strip().lower()
+        self.include_usage = include_usage
+        self.vlog = vlog if verbose else None
+        self.ws_state: dict[str, Any] = {}
+        self.ws_index: dict[str, int] = {}
+        self.ws_next_index = 0
+        template = self.template = ChunkTemplate("chat.completion.chunk", created, model, "delta")
+        self._quote = template.codec.quote
+        k, i = template.codec.key_sep, template.codec.item_sep
+        # Delta objects of the per-token frames, split around the escaped text.
+        self._content_delta = (f'{{"content"{k}'.encode(), b"}")
+        self._o3_delta = (f'{{"reasoning"{k}{{"content"{k}[{{"type"{k}"text"{i}"text"{k}'.encode(), b"}]}}")
+        self._summary_delta = (f'{{"reasoning_summary"{k}'.encode(), f'{i}"reasoning"{k}'.encode(), b"}")
+        self._reasoning_delta = (f'{{"reasoning"{k}'.encode(), b"}")
+
+    def _frame(self, state: StreamState, delta: Dict[str, Any], finish_reason: str | None = None, **extra: Any) -> bytes:
+        value = self.template.codec.dumpb(delta)
+        if finish_reason is None and not extra:
+            return self.template.frame(state.response_id, value)
+        return self.template.frame_with(state.response_id, value, finish_reason, extra)
+
+    def _tool_call_index(self, call_id: Any) -> int:
+        if call_id not in self.ws_index:
+            self.ws_index[call_id] = self.ws_next_index
+            self.ws_next_index += 1
+        return self.ws_index.get(call_id, 0)
+
+    def _tool_call(self, state: StreamState, index: int, call_id: str, name: str, args: str) -> bytes:
+        tool_call = {"index": index, "id": call_id, "type": "function", "function": {"name": name, "arguments": args}}
+        return self._frame(state, {"tool_calls": [tool_call]})
+
+    def wants(self, kind: str) -> bool:
+        return "web_search_call" in kind
+
+    def content(self, state: StreamState, text: str) -> List[bytes]:
+        head, tail = self._content_delta
+        return [self.template.frame(state.response_id, head + self._quote(text) + tail)]
+
+    def reasoning(self, state: StreamState, text: str, summary: bool) -> List[bytes]:
+        quoted = self._quote(text)
+        if self.compat == "o3":
+            head, tail = self._o3_delta
+            delta = head + quoted + tail
+        elif summary:
+            head, mid, tail = self._summary_delta
+            delta = head + quoted + mid + quoted + tail
+        else:
+            head, tail = self._reasoning_delta
+            delta = head + quoted + tail
+        return [self.template.frame(state.response_id, delta)]
+
+    def event(self, state: StreamState, kind: str, evt: Dict[str, Any]) -> List[bytes]:
+        # response.web_search_call.* progress events
+        vlog = self.vlog
+        out: List[bytes] = []
+        try:
+            call_id = evt.get("item_id") or "ws_call"
+            if vlog:
+                try:
+                    vlog(f"CM_TOOLS {kind} id={call_id} -> tool_calls(web_search)")
+                except Exception:
+                    pass
+            item = evt.get("item") if isinstance(evt.get("item"), dict) else {}
+            ws_state = self.ws_state
+            params_dict = ws_state.setdefault(call_id, {}) if isinstance(ws_state.get(call_id), dict) else {}
+
+            def _merge_from(src):
+                if not isinstance(src, dict):
+                    return
+                for whole in ("parameters", "args", "arguments", "input"):
+                    if isinstance(src.get(whole), dict):
+                        params_dict.update(src.get(whole))
+                if isinstance(src.get("query"), str):
+                    params_dict.setdefault("query", src.get("query"))
+                if isinstance(src.get("q"), str):
+                    params_dict.setdefault("query", src.get("q"))
+                for rk in ("recency", "time_range", "days"):
+                    if src.get(rk) is not None and rk not in params_dict:
+                        params_dict[rk] = src.get(rk)
+                for dk in ("domains", "include_domains", "include"):
+                    if isinstance(src.get(dk), list) and "domains" not in params_dict:
+                        params_dict["domains"] = src.get(dk)
+                for mk in ("max_results", "topn", "limit"):
+                    if src.get(mk) is not None and "max_results" not in params_dict:
+                        params_dict["max_results"] = src.get(mk)
+
+            _merge_from(item)
+            _merge_from(evt if isinstance(evt, dict) else None)
+            params = params_dict if params_dict else None
+            if isinstance(params, dict):
+                try:
+                    ws_state.setdefault(call_id, {}).update(params)
+                except Exception:
+                    pass
+            eff_params = ws_state.get(call_id, params if isinstance(params, (dict, list, str)) else {})
+            args_str = _serialize_tool_args(eff_params)
+            out.append(self._tool_call(state, self._tool_call_index(call_id), call_id, "web_search", args_str))
+            if kind.endswith(".completed") or kind.endswith(".done"):
+                out.append(self._frame(state, {}, "tool_calls"))
+        except Exception:
+            pass
+        return out
+
+    def tool_call_start(self, state: StreamState, call: ToolCall) -> List[bytes]:
+        return [self._tool_call(state, self._tool_call_index(call.call_id), call.call_id, call.name, "")]
+
+    def tool_call_arguments(self, state: StreamState, call: ToolCall, delta: str) -> List[bytes]:
+        index = self._tool_call_index(call.call_id)
+        return [self._frame(state, {"tool_calls": [{"index": index, "function": {"arguments": delta}}]})]
+
+    def item_done(self, state: StreamState, item: Any) -> List[bytes]:
+        if not (isinstance(item, dict) and item.get("type") in ("function_call", "web_search_call")):
+            return []
+        call = state.tool_calls.get(item.get("id")) if item.get("type") == "function_call" else None
+        if call is not None:
+            # Arguments went out as fragments; send only what they are missing.
+            rest = call.remaining(item.get("arguments"))
+            if rest is None and self.vlog:
+                self.vlog(f"CM_TOOLS final arguments of {call.call_id} do not extend the streamed fragments")
+            out = [self._frame(state, {}, "tool_calls")]
+            if rest:
+                index = self._tool_call_index(call.call_id)
+                out.insert(0, self._frame(state, {"tool_calls": [{"index": index, "function": {"arguments": rest}}]}))
+            return out
+        call_id = item.get("call_id") or item.get("id") or ""
+        name = item.get("name") or ("web_search" if item.get("type") == "web_search_call" else "")
+        raw_args = item.get("arguments") or item.get("parameters")
+        if isinstance(raw_args, dict):
+            try:
+                self.ws_state.setdefault(call_id, {}).update(raw_args)
+            except Exception:
+                pass
+        eff_args = self.ws_state.get(call_id, raw_args if isinstance(raw_args, (dict, list, str)) else {})
+        try:
+            args = _serialize_tool_args(eff_args)
+        except Exception:
+            args = "{}"
+        if item.get("type") == "web_search_call" and self.vlog:
+            try:
+                self.vlog(f"CM_TOOLS response.output_item.done web_search_call id={call_id} has_args={bool(args)}")
+            except Exception:
+                pass
+        index = self._tool_call_index(call_id)
+        if not (isinstance(call_id, str) and isinstance(name, str) and isinstance(args, str)):
+            return []
+        return [self._tool_call(state, index, call_id, name, args), self._frame(state, {}, "tool_calls")]
+
+    def completed(self, state: StreamState) -> List[bytes]:
+        out: List[bytes] = []
+        if self.include_usage and state.usage:
+            try:
+                out.append(self._frame(state, {}, usage=state.usage))
+            except Exception:
+                pass
+        out.append(b"data: [DONE]\n\n")
+        return out
+
+    def failed(self, state: StreamState, message: str) -> List[bytes]:
+        return [self._frame(state, {}, "error", error={"message": message}), b"data: [DONE]\n\n"]
+
+    def interrupted(self, state: StreamState, message: str) -> List[bytes]:
+        payload: Dict[str, Any] = {"error": {"message": message}}
+        if state.reasoning_cache:
+            payload["partial_reasoning"] = state.reasoning_cache.getvalue()
+        return [b"data: " + self.template.codec.dumpb(payload) + b"\n\n", b"data: [DONE]\n\n"]
+
+
 def sse_translate_chat(
     upstream,
     model: str,
@@ -450,637 +985,50 @@ def sse_translate_chat(
     *,
     include_usage: bool = False,
 ):
-    response_id = "chatcmpl-stream"
-    compat = (reasoning_compat or "think-tags").strip().lower()
-    think_open = False
-    think_closed = False
-    saw_output = False
-    saw_any_summary = False
-    pending_summary_paragraph = False
-    upstream_usage = None
-    ws_state: dict[str, Any] = {}
-    ws_index: dict[str, int] = {}
-    ws_next_index: int = 0
-    request_ctx: Dict[str, Any] | None = getattr(upstream, "_chatmock_request_ctx", None)
-    max_resume_attempts = 2
-    resume_attempts = 0
-    resume_token: str | None = None
-    keepalive_interval = 15.0
-    keepalive_frame = b": keepalive\n\n"
-    reasoning_cache: List[str] = []
-
-    def _serialize_tool_args(eff_args: Any) -> str:
-        """
-        Serialize tool call arguments with proper JSON handling.
-        
-        Args:
-            eff_args: Arguments to serialize (dict, list, str, or other)
-            
-        Returns:
-            JSON string representation of the arguments
-        """
-        if isinstance(eff_args, (dict, list)):
-            return json.dumps(eff_args)
-        elif isinstance(eff_args, str):
-            try:
-                parsed = json.loads(eff_args)
-                if isinstance(parsed, (dict, list)):
-                    return json.dumps(parsed) 
-                else:
-                    return json.dumps({"query": eff_args})  
-            except (json.JSONDecodeError, ValueError):
-                return json.dumps({"query": eff_args})
-        else:
-            return "{}"
-    
-    def _extract_usage(evt: Dict[str, Any]) -> Dict[str, int] | None:
-        try:
-            usage = (evt.get("response") or {}).get("usage")
-            if not isinstance(usage, dict):
-                return None
-            pt = int(usage.get("input_tokens") or 0)
-            ct = int(usage.get("output_tokens") or 0)
-            tt = int(usage.get("total_tokens") or (pt + ct))
-            return {"prompt_tokens": pt, "completion_tokens": ct, "total_tokens": tt}
-        except Exception:
-            return None
-    def _record_reasoning(delta_txt: str) -> None:
-        if isinstance(delta_txt, str) and delta_txt:
-            reasoning_cache.append(delta_txt)
-
-    def _update_resume_state(evt: Dict[str, Any]) -> None:
-        nonlocal resume_token
-        resp = evt.get("response")
-        candidates: List[str] = []
-        if isinstance(resp, dict):
-            for key in (
-                "range_end_token",
-                "range_start_token",
-                "next_range_start_token",
-                "cursor",
-            ):
-                value = resp.get(key)
-                if isinstance(value, str):
-                    candidates.append(value)
-            range_info = resp.get("range")
-            if isinstance(range_info, dict):
-                for key in ("end_token", "next_start_token", "end", "next_start"):
-                    value = range_info.get(key)
-                    if isinstance(value, str):
-                        candidates.append(value)
-        delta_range = evt.get("delta_range")
-        if isinstance(delta_range, dict):
-            for key in ("end", "token_end"):
-                value = delta_range.get(key)
-                if isinstance(value, str):
-                    candidates.append(value)
-        for candidate in candidates:
-            if candidate:
-                resume_token = candidate
-                break
-
-    def _clone_payload() -> Dict[str, Any]:
-        base_payload = {}
-        if isinstance(request_ctx, dict):
-            base_payload = request_ctx.get("payload") or {}
-        return deepcopy(base_payload) if isinstance(base_payload, dict) else {}
-
-    def _attempt_resume(exc: Exception) -> bool:
-        nonlocal upstream, resume_attempts
-        if not request_ctx or resume_attempts >= max_resume_attempts:
-            return False
-        resume_attempts += 1
-        payload = _clone_payload()
-        if resume_token:
-            payload["range_start_token"] = resume_token
-        else:
-            payload.pop("range_start_token", None)
-        headers = dict(request_ctx.get("headers") or {})
-        url = request_ctx.get("url") or getattr(getattr(upstream, "request", None), "url", None)
-        timeout = request_ctx.get("timeout", 600)
-        if not url:
-            return False
-        try:
-            new_resp = requests.post(
-                url,
-                headers=headers,
-                json=payload,
-                stream=True,
-                timeout=timeout,
-            )
-        except requests.RequestException as err:
-            if verbose and vlog:
-                vlog(f"Resume attempt #{resume_attempts} failed: {err}")
-            return False
-        if new_resp.status_code >= 400:
-            if verbose and vlog:
-                vlog(f"Resume attempt #{resume_attempts} failed with status {new_resp.status_code}")
-            return False
-        setattr(new_resp, "_chatmock_request_ctx", request_ctx)
-        try:
-            upstream.close()
-        except Exception:
-            pass
-        upstream = new_resp
-        if verbose and vlog:
-            token_preview = resume_token[:8] + "…" if isinstance(resume_token, str) and len(resume_token) > 8 else resume_token
-            vlog(f"Reconnected upstream stream (range_start_token={token_preview!r})")
-        return True
+    encoder = ChatCompletionStreamEncoder(
+        model, created, reasoning_compat, include_usage=include_usage, verbose=verbose, vlog=vlog
+    )
+    return translate(upstream, encoder, verbose=verbose, vlog=vlog)
 
-    def _emit_stream_failure(message: str):
-        payload: Dict[str, Any] = {"error": {"message": message}}
-        if reasoning_cache:
-            payload["partial_reasoning"] = "".join(reasoning_cache)
-        yield f"data: {json.dumps(payload)}\n\n".encode("utf-8")
-        yield b"data: [DONE]\n\n"
 
-    def _start_worker(resp):
-        q: queue.Queue = queue.Queue()
-        stop_flag = threading.Event()
+class TextCompletionStreamEncoder(Encoder):
+    """OpenAI ``text_completion.chunk`` server-sent events."""
 
-        def _worker():
-            try:
-                for raw_line in resp.iter_lines(decode_unicode=False):
-                    if stop_flag.is_set():
-                        break
-                    q.put(("line", raw_line))
-            except Exception as exc:
-                q.put(("error", exc))
-            finally:
-                q.put(("done", None))
+    name = "completions/stream"
+    events = frozenset({"response.output_text.delta", "response.output_text.done"})
+    default_response_id = "cmpl-stream"
+    keepalive = b": keepalive\n\n"
 
-        thread = threading.Thread(target=_worker, daemon=True)
-        thread.start()
-        return q, stop_flag, thread
+    def __init__(self, model: str, created: int, *, include_usage: bool = False) -> None:
+        self.model = model
+        self.created = created
+        self.include_usage = include_usage
+        self.template = ChunkTemplate("text_completion.chunk", created, model, "text")
 
-    try:
-        stream_complete = False
-        last_error_message: str | None = None
-        while not stream_complete:
-            line_queue, stop_flag, worker_thread = _start_worker(upstream)
-            connection_error: Exception | None = None
-            graceful_shutdown = False
-            while True:
-                try:
-                    msg_type, payload = line_queue.get(timeout=keepalive_interval)
-                except queue.Empty:
-                    yield keepalive_frame
-                    continue
-                if msg_type == "line":
-                    raw = payload
-                    if not raw:
-                        continue
-                    line = (
-                        raw.decode("utf-8", errors="ignore")
-                        if isinstance(raw, (bytes, bytearray))
-                        else raw
-                    )
-                    if verbose and vlog:
-                        vlog(line)
-                    if not line.startswith("data: "):
-                        continue
-                    data = line[len("data: ") :].strip()
-                    if not data:
-                        continue
-                    if data == "[DONE]":
-                        graceful_shutdown = True
-                        stream_complete = True
-                        break
-                    try:
-                        evt = json.loads(data)
-                    except (json.JSONDecodeError, UnicodeDecodeError):
-                        continue
-                    kind = evt.get("type")
-                    _update_resume_state(evt)
-                    if isinstance(evt.get("response"), dict) and isinstance(evt["response"].get("id"), str):
-                        response_id = evt["response"].get("id") or response_id
-
-                    if isinstance(kind, str) and ("web_search_call" in kind):
-                        try:
-                            call_id = evt.get("item_id") or "ws_call"
-                            if verbose and vlog:
-                                try:
-                                    vlog(f"CM_TOOLS {kind} id={call_id} -> tool_calls(web_search)")
-                                except Exception:
-                                    pass
-                            item = evt.get("item") if isinstance(evt.get("item"), dict) else {}
-                            params_dict = ws_state.setdefault(call_id, {}) if isinstance(ws_state.get(call_id), dict) else {}
-
-                            def _merge_from(src):
-                                if not isinstance(src, dict):
-                                    return
-                                for whole in ("parameters", "args", "arguments", "input"):
-                                    if isinstance(src.get(whole), dict):
-                                        params_dict.update(src.get(whole))
-                                if isinstance(src.get("query"), str):
-                                    params_dict.setdefault("query", src.get("query"))
-                                if isinstance(src.get("q"), str):
-                                    params_dict.setdefault("query", src.get("q"))
-                                for rk in ("recency", "time_range", "days"):
-                                    if src.get(rk) is not None and rk not in params_dict:
-                                        params_dict[rk] = src.get(rk)
-                                for dk in ("domains", "include_domains", "include"):
-                                    if isinstance(src.get(dk), list) and "domains" not in params_dict:
-                                        params_dict["domains"] = src.get(dk)
-                                for mk in ("max_results", "topn", "limit"):
-                                    if src.get(mk) is not None and "max_results" not in params_dict:
-                                        params_dict["max_results"] = src.get(mk)
-
-                            _merge_from(item)
-                            _merge_from(evt if isinstance(evt, dict) else None)
-                            params = params_dict if params_dict else None
-                            if isinstance(params, dict):
-                                try:
-                                    ws_state.setdefault(call_id, {}).update(params)
-                                except Exception:
-                                    pass
-                            eff_params = ws_state.get(call_id, params if isinstance(params, (dict, list, str)) else {})
-                            args_str = _serialize_tool_args(eff_params)
-                            if call_id not in ws_index:
-                                ws_index[call_id] = ws_next_index
-                                ws_next_index += 1
-                            _idx = ws_index.get(call_id, 0)
-                            delta_chunk = {
-                                "id": response_id,
-                                "object": "chat.completion.chunk",
-                                "created": created,
-                                "model": model,
-                                "choices": [
-                                    {
-                                        "index": 0,
-                                        "delta": {
-                                            "tool_calls": [
-                                                {
-                                                    "index": _idx,
-                                                    "id": call_id,
-                                                    "type": "function",
-                                                    "function": {"name": "web_search", "arguments": args_str},
-                                                }
-                                            ]
-                                        },
-                                        "finish_reason": None,
-                                    }
-                                ],
-                            }
-                            yield f"data: {json.dumps(delta_chunk)}\n\n".encode("utf-8")
-                            if kind.endswith(".completed") or kind.endswith(".done"):
-                                finish_chunk = {
-                                    "id": response_id,
-                                    "object": "chat.completion.chunk",
-                                    "created": created,
-                                    "model": model,
-                                    "choices": [
-                                        {"index": 0, "delta": {}, "finish_reason": "tool_calls"}
-                                    ],
-                                }
-                                yield f"data: {json.dumps(finish_chunk)}\n\n".encode("utf-8")
-                        except Exception:
-                            pass
-
-                    if kind == "response.output_text.delta":
-                        delta = evt.get("delta") or ""
-                        if compat == "think-tags" and think_open and not think_closed:
-                            close_chunk = {
-                                "id": response_id,
-                                "object": "chat.completion.chunk",
-                                "created": created,
-                                "model": model,
-                                "choices": [{"index": 0, "delta": {"content": "</think>"}, "finish_reason": None}],
-                            }
-                            yield f"data: {json.dumps(close_chunk)}\n\n".encode("utf-8")
-                            think_open = False
-                            think_closed = True
-                        saw_output = True
-                        chunk = {
-                            "id": response_id,
-                            "object": "chat.completion.chunk",
-                            "created": created,
-                            "model": model,
-                            "choices": [{"index": 0, "delta": {"content": delta}, "finish_reason": None}],
-                        }
-                        yield f"data: {json.dumps(chunk)}\n\n".encode("utf-8")
-                    elif kind == "response.output_item.done":
-                        item = evt.get("item") or {}
-                        if isinstance(item, dict) and (
-                            item.get("type") == "function_call" or item.get("type") == "web_search_call"
-                        ):
-                            call_id = item.get("call_id") or item.get("id") or ""
-                            name = item.get("name") or ("web_search" if item.get("type") == "web_search_call" else "")
-                            raw_args = item.get("arguments") or item.get("parameters")
-                            if isinstance(raw_args, dict):
-                                try:
-                                    ws_state.setdefault(call_id, {}).update(raw_args)
-                                except Exception:
-                                    pass
-                            eff_args = ws_state.get(call_id, raw_args if isinstance(raw_args, (dict, list, str)) else {})
-                            try:
-                                args = _serialize_tool_args(eff_args)
-                            except Exception:
-                                args = "{}"
-                            if item.get("type") == "web_search_call" and verbose and vlog:
-                                try:
-                                    vlog(f"CM_TOOLS response.output_item.done web_search_call id={call_id} has_args={bool(args)}")
-                                except Exception:
-                                    pass
-                            if call_id not in ws_index:
-                                ws_index[call_id] = ws_next_index
-                                ws_next_index += 1
-                            _idx = ws_index.get(call_id, 0)
-                            if isinstance(call_id, str) and isinstance(name, str) and isinstance(args, str):
-                                delta_chunk = {
-                                    "id": response_id,
-                                    "object": "chat.completion.chunk",
-                                    "created": created,
-                                    "model": model,
-                                    "choices": [
-                                        {
-                                            "index": 0,
-                                            "delta": {
-                                                "tool_calls": [
-                                                    {
-                                                        "index": _idx,
-                                                        "id": call_id,
-                                                        "type": "function",
-                                                        "function": {"name": name, "arguments": args},
-                                                    }
-                                                ]
-                                            },
-                                            "finish_reason": None,
-                                        }
-                                    ],
-                                }
-                                yield f"data: {json.dumps(delta_chunk)}\n\n".encode("utf-8")
-
-                                finish_chunk = {
-                                    "id": response_id,
-                                    "object": "chat.completion.chunk",
-                                    "created": created,
-                                    "model": model,
-                                    "choices": [{"index": 0, "delta": {}, "finish_reason": "tool_calls"}],
-                                }
-                                yield f"data: {json.dumps(finish_chunk)}\n\n".encode("utf-8")
-                    elif kind == "response.reasoning_summary_part.added":
-                        if compat in ("think-tags", "o3"):
-                            if saw_any_summary:
-                                pending_summary_paragraph = True
-                            else:
-                                saw_any_summary = True
-                    elif kind in ("response.reasoning_summary_text.delta", "response.reasoning_text.delta"):
-                        delta_txt = evt.get("delta") or ""
-                        _record_reasoning(delta_txt)
-                        if compat == "o3":
-                            if kind == "response.reasoning_summary_text.delta" and pending_summary_paragraph:
-                                nl_chunk = {
-                                    "id": response_id,
-                                    "object": "chat.completion.chunk",
-                                    "created": created,
-                                    "model": model,
-                                    "choices": [
-                                        {
-                                            "index": 0,
-                                            "delta": {"reasoning": {"content": [{"type": "text", "text": "\n"}]}},
-                                            "finish_reason": None,
-                                        }
-                                    ],
-                                }
-                                yield f"data: {json.dumps(nl_chunk)}\n\n".encode("utf-8")
-                                pending_summary_paragraph = False
-                            chunk = {
-                                "id": response_id,
-                                "object": "chat.completion.chunk",
-                                "created": created,
-                                "model": model,
-                                "choices": [
-                                    {
-                                        "index": 0,
-                                        "delta": {"reasoning": {"content": [{"type": "text", "text": delta_txt}]}},
-                                        "finish_reason": None,
-                                    }
-                                ],
-                            }
-                            yield f"data: {json.dumps(chunk)}\n\n".encode("utf-8")
-                        elif compat == "think-tags":
-                            if not think_open and not think_closed:
-                                open_chunk = {
-                                    "id": response_id,
-                                    "object": "chat.completion.chunk",
-                                    "created": created,
-                                    "model": model,
-                                    "choices": [{"index": 0, "delta": {"content": "<think>"}, "finish_reason": None}],
-                                }
-                                yield f"data: {json.dumps(open_chunk)}\n\n".encode("utf-8")
-                                think_open = True
-                            if think_open and not think_closed:
-                                if kind == "response.reasoning_summary_text.delta" and pending_summary_paragraph:
-                                    nl_chunk = {
-                                        "id": response_id,
-                                        "object": "chat.completion.chunk",
-                                        "created": created,
-                                        "model": model,
-                                        "choices": [{"index": 0, "delta": {"content": "\n"}, "finish_reason": None}],
-                                    }
-                                    yield f"data: {json.dumps(nl_chunk)}\n\n".encode("utf-8")
-                                    pending_summary_paragraph = False
-                                content_chunk = {
-                                    "id": response_id,
-                                    "object": "chat.completion.chunk",
-                                    "created": created,
-                                    "model": model,
-                                    "choices": [{"index": 0, "delta": {"content": delta_txt}, "finish_reason": None}],
-                                }
-                                yield f"data: {json.dumps(content_chunk)}\n\n".encode("utf-8")
-                        else:
-                            if kind == "response.reasoning_summary_text.delta":
-                                chunk = {
-                                    "id": response_id,
-                                    "object": "chat.completion.chunk",
-                                    "created": created,
-                                    "model": model,
-                                    "choices": [
-                                        {
-                                            "index": 0,
-                                            "delta": {"reasoning_summary": delta_txt, "reasoning": delta_txt},
-                                            "finish_reason": None,
-                                        }
-                                    ],
-                                }
-                                yield f"data: {json.dumps(chunk)}\n\n".encode("utf-8")
-                            else:
-                                chunk = {
-                                    "id": response_id,
-                                    "object": "chat.completion.chunk",
-                                    "created": created,
-                                    "model": model,
-                                    "choices": [
-                                        {"index": 0, "delta": {"reasoning": delta_txt}, "finish_reason": None}
-                                    ],
-                                }
-                                yield f"data: {json.dumps(chunk)}\n\n".encode("utf-8")
-                    elif isinstance(kind, str) and kind.endswith(".done"):
-                        pass
-                    elif kind == "response.output_text.done":
-                        chunk = {
-                            "id": response_id,
-                            "object": "chat.completion.chunk",
-                            "created": created,
-                            "model": model,
-                            "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}],
-                        }
-                        yield f"data: {json.dumps(chunk)}\n\n".encode("utf-8")
-                    elif kind == "response.failed":
-                        err = evt.get("response", {}).get("error", {}).get("message", "response.failed")
-                        chunk = {
-                            "id": response_id,
-                            "object": "chat.completion.chunk",
-                            "created": created,
-                            "model": model,
-                            "choices": [{"index": 0, "delta": {}, "finish_reason": "error"}],
-                            "error": {"message": err},
-                        }
-                        yield f"data: {json.dumps(chunk)}\n\n".encode("utf-8")
-                        yield b"data: [DONE]\n\n"
-                        stream_complete = True
-                        graceful_shutdown = True
-                        break
-                    elif kind == "response.completed":
-                        m = _extract_usage(evt)
-                        if m:
-                            upstream_usage = m
-                        if compat == "think-tags" and think_open and not think_closed:
-                            close_chunk = {
-                                "id": response_id,
-                                "object": "chat.completion.chunk",
-                                "created": created,
-                                "model": model,
-                                "choices": [{"index": 0, "delta": {"content": "</think>"}, "finish_reason": None}],
-                            }
-                            yield f"data: {json.dumps(close_chunk)}\n\n".encode("utf-8")
-                            think_open = False
-                            think_closed = True
-                        if include_usage and upstream_usage:
-                            try:
-                                usage_chunk = {
-                                    "id": response_id,
-                                    "object": "chat.completion.chunk",
-                                    "created": created,
-                                    "model": model,
-                                    "choices": [{"index": 0, "delta": {}, "finish_reason": None}],
-                                    "usage": upstream_usage,
-                                }
-                                yield f"data: {json.dumps(usage_chunk)}\n\n".encode("utf-8")
-                            except Exception:
-                                pass
-                        yield b"data: [DONE]\n\n"
-                        stream_complete = True
-                        graceful_shutdown = True
-                        break
-                elif msg_type == "error":
-                    connection_error = payload if isinstance(payload, Exception) else RuntimeError("Upstream stream error")
-                    break
-                elif msg_type == "done":
-                    if graceful_shutdown:
-                        break
-                    connection_error = ConnectionError("Upstream stream closed before [DONE]")
-                    break
-            stop_flag.set()
-            worker_thread.join(timeout=0.5)
-            if connection_error:
-                last_error_message = str(connection_error)
-                if verbose and vlog:
-                    vlog(f"Stream interrupted: {connection_error}")
-                if not _attempt_resume(connection_error):
-                    message = "Reasoning stream interrupted, please retry."
-                    if last_error_message:
-                        message = f"{message} ({last_error_message})"
-                    yield from _emit_stream_failure(message)
-                    return
-                continue
-            if stream_complete:
-                break
-    finally:
-        upstream.close()
+    def _frame(self, state: StreamState, text: str, finish_reason: str | None = None, **extra: Any) -> bytes:
+        return self.template.frame_with(state.response_id, self.template.codec.quote(text), finish_reason, extra)
 
+    def content(self, state: StreamState, text: str) -> List[bytes]:
+        return [self.template.frame(state.response_id, self.template.codec.quote(text))]
 
-def sse_translate_text(upstream, model: str, created: int, verbose: bool = False, vlog=None, *, include_usage: bool = False):
-    response_id = "cmpl-stream"
-    upstream_usage = None
-    
-    def _extract_usage(evt: Dict[str, Any]) -> Dict[str, int] | None:
-        try:
-            usage = (evt.get("response") or {}).get("usage")
-            if not isinstance(usage, dict):
-                return None
-            pt = int(usage.get("input_tokens") or 0)
-            ct = int(usage.get("output_tokens") or 0)
-            tt = int(usage.get("total_tokens") or (pt + ct))
-            return {"prompt_tokens": pt, "completion_tokens": ct, "total_tokens": tt}
-        except Exception:
-            return None
-    try:
-        for raw_line in upstream.iter_lines(decode_unicode=False):
-            if not raw_line:
-                continue
-            line = raw_line.decode("utf-8", errors="ignore") if isinstance(raw_line, (bytes, bytearray)) else raw_line
-            if verbose and vlog:
-                vlog(line)
-            if not line.startswith("data: "):
-                continue
-            data = line[len("data: "):].strip()
-            if not data or data == "[DONE]":
-                if data == "[DONE]":
-                    chunk = {
-                        "id": response_id,
-                        "object": "text_completion.chunk",
-                        "created": created,
-                        "model": model,
-                        "choices": [{"index": 0, "text": "", "finish_reason": "stop"}],
-                    }
-                    yield f"data: {json.dumps(chunk)}\n\n".encode("utf-8")
-                continue
+    def event(self, state: StreamState, kind: str, evt: Dict[str, Any]) -> List[bytes]:
+        # response.output_text.done
+        return [self._frame(state, "", "stop")]
+
+    def upstream_done(self, state: StreamState) -> List[bytes]:
+        return [self._frame(state, "", "stop")]
+
+    def completed(self, state: StreamState) -> List[bytes]:
+        out: List[bytes] = []
+        if self.include_usage and state.usage:
             try:
-                evt = json.loads(data)
+                out.append(self._frame(state, "", usage=state.usage))
             except Exception:
-                continue
-            kind = evt.get("type")
-            if isinstance(evt.get("response"), dict) and isinstance(evt["response"].get("id"), str):
-                response_id = evt["response"].get("id") or response_id
-            if kind == "response.output_text.delta":
-                delta_text = evt.get("delta") or ""
-                chunk = {
-                    "id": response_id,
-                    "object": "text_completion.chunk",
-                    "created": created,
-                    "model": model,
-                    "choices": [{"index": 0, "text": delta_text, "finish_reason": None}],
-                }
-                yield f"data: {json.dumps(chunk)}\n\n".encode("utf-8")
-            elif kind == "response.output_text.done":
-                chunk = {
-                    "id": response_id,
-                    "object": "text_completion.chunk",
-                    "created": created,
-                    "model": model,
-                    "choices": [{"index": 0, "text": "", "finish_reason": "stop"}],
-                }
-                yield f"data: {json.dumps(chunk)}\n\n".encode("utf-8")
-            elif kind == "response.completed":
-                m = _extract_usage(evt)
-                if m:
-                    upstream_usage = m
-                if include_usage and upstream_usage:
-                    try:
-                        usage_chunk = {
-                            "id": response_id,
-                            "object": "text_completion.chunk",
-                            "created": created,
-                            "model": model,
-                            "choices": [{"index": 0, "text": "", "finish_reason": None}],
-                            "usage": upstream_usage,
-                        }
-                        yield f"data: {json.dumps(usage_chunk)}\n\n".encode("utf-8")
-                    except Exception:
-                        pass
-                yield b"data: [DONE]\n\n"
-                break
-    finally:
-        upstream.close()
+                pass
+        out.append(b"data: [DONE]\n\n")
+        return out
+
+
+def sse_translate_text(upstream, model: str, created: int, verbose: bool = False, vlog=None, *, include_usage: bool = False):
+    encoder = TextCompletionStreamEncoder(model, created, include_usage=include_usage)
+    return translate(upstream, encoder, verbose=verbose, vlog=vlog)
@@ -13,7 +13,7 @@ from chatmock.utils import load_chatgpt_tokens, parse_jwt_claims
 
 
 def run_server(host: str, port: int, reasoning_effort: str = "medium", reasoning_summary: str = "auto") -> None:
-    app = create_app(reasoning_effort=reasoning_effort, reasoning_summary=reasoning_summary)
+    app = create_app(reasoning_effort=reasoning_effort, reasoning_summary=reasoning_summary, background_token_refresh=True)
     app.run(host=host, port=port, debug=False, use_reloader=False, threaded=True)
 
 